@@ -0,0 +1,1176 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for vibesInventory
+Seeds a throwaway SQLite database (or BENCHMARK_DATABASE_URL) and times each scenario
+
+Usage: python benchmark.py [scenario ...]
+"""
+
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import logging
+import tempfile
+import threading
+import time
+import statistics
+import tracemalloc
+import random
+from io import BytesIO
+from datetime import datetime, timedelta
+
+# Point the app at a scratch database before it creates its engine
+BENCH_DIR = tempfile.mkdtemp(prefix="vibes-bench-")
+os.environ["DATABASE_URL"] = os.getenv("BENCHMARK_DATABASE_URL", f"sqlite:///{BENCH_DIR}/bench.db")
+
+from sqlalchemy import event, func, update  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+from openpyxl import Workbook, load_workbook  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+import vibesInventory as vi  # noqa: E402
+
+client = TestClient(vi.app)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class QueryCounter:
+    """Counts statements sent to the database while active"""
+
+    def __init__(self):
+        self.count = 0
+        event.listen(vi.engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+
+query_counter = QueryCounter()
+
+
+def report(label, timings, queries=None):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1] if len(timings_ms) >= 20 else timings_ms[-1]
+    line = f"  {label:<28} mean {statistics.mean(timings_ms):8.2f} ms   p95 {p95:8.2f} ms"
+    if queries is not None:
+        line += f"   {queries / len(timings):6.1f} queries/op"
+    print(line)
+
+
+def reset_database():
+    vi.Base.metadata.drop_all(bind=vi.engine)
+    vi.Base.metadata.create_all(bind=vi.engine)
+
+
+def seed_dish(db, dish_name, ingredient_count, batches_per_ingredient):
+    """One dish with `ingredient_count` ingredients, each stocked in several kg batches"""
+    dish_type = vi.DishType(name=f"{dish_name} type")
+    db.add(dish_type)
+    db.flush()
+    dish = vi.Dish(name=dish_name, type_id=dish_type.id)
+    db.add(dish)
+    db.flush()
+
+    start = datetime(2024, 1, 1)
+    for i in range(ingredient_count):
+        ingredient_name = f"{dish_name} ingredient {i}"
+        db.add(vi.DishIngredient(dish_id=dish.id, ingredient_name=ingredient_name, quantity_required=50, unit="gm"))
+        for b in range(batches_per_ingredient):
+            db.add(vi.Inventory(
+                name=ingredient_name, quantity=1000.0, unit="kg", price_per_unit=40.0,
+                total_cost=40000.0, type="Bench", date_added=start + timedelta(days=b)
+            ))
+    db.flush()
+    vi.refresh_ingredient_stock(db, {vi.normalize_name_key(f"{dish_name} ingredient {i}")
+                                     for i in range(ingredient_count)})
+    db.commit()
+
+
+# --- Legacy implementations kept for comparison ---
+
+def legacy_prepare_dish(db, dish_name, quantity):
+    """The pre-allocator prepare_dish: two ilike queries per ingredient and per-batch conversions"""
+    prepare_date = datetime.utcnow()
+    dish = db.query(vi.Dish).filter(vi.Dish.name.ilike(dish_name.strip())).first()
+    dish_ingredients = db.query(vi.DishIngredient).filter(vi.DishIngredient.dish_id == dish.id).all()
+
+    for ingredient in dish_ingredients:
+        required_qty = ingredient.quantity_required * quantity
+        recipe_unit = ingredient.unit.strip().lower()
+        inventory_batches = db.query(vi.Inventory).filter(
+            vi.Inventory.name.ilike(ingredient.ingredient_name),
+            vi.Inventory.quantity > 0
+        ).order_by(vi.Inventory.date_added.asc()).all()
+        total_available = sum(
+            vi.convert_to_base_unit(batch.quantity, batch.unit.strip().lower(), recipe_unit)
+            for batch in inventory_batches
+        )
+        if total_available < required_qty:
+            raise RuntimeError(f"Insufficient {ingredient.ingredient_name}")
+
+    for ingredient in dish_ingredients:
+        required_qty = ingredient.quantity_required * quantity
+        recipe_unit = ingredient.unit.strip().lower()
+        inventory_batches = db.query(vi.Inventory).filter(
+            vi.Inventory.name.ilike(ingredient.ingredient_name),
+            vi.Inventory.quantity > 0
+        ).order_by(vi.Inventory.date_added.asc()).all()
+
+        remaining_required = required_qty
+        for batch in inventory_batches:
+            if remaining_required <= 0:
+                break
+            batch_unit = batch.unit.strip().lower()
+            batch_qty = vi.convert_to_base_unit(batch.quantity, batch_unit, recipe_unit)
+            deduct = min(batch_qty, remaining_required)
+            batch.quantity = max(0, batch.quantity - vi.convert_from_base_unit(deduct, batch_unit, recipe_unit))
+            db.add(vi.InventoryLog(ingredient_id=batch.id, quantity_left=batch.quantity, date=prepare_date))
+            remaining_required -= deduct
+
+    db.commit()
+
+
+def legacy_convert_to_base_unit(quantity, from_unit, to_unit):
+    """The pre-registry converter: rebuilds its unit tables on every call"""
+    from_unit = from_unit.lower()
+    to_unit = to_unit.lower()
+    if from_unit == to_unit:
+        return quantity
+    weight_units = {
+        'gm': 1, 'g': 1, 'grams': 1,
+        'kg': 1000, 'kilogram': 1000, 'kilograms': 1000,
+        'oz': 28.3495, 'ounce': 28.3495, 'ounces': 28.3495,
+        'lb': 453.592, 'pound': 453.592, 'pounds': 453.592
+    }
+    volume_units = {
+        'ml': 1, 'milliliter': 1, 'milliliters': 1,
+        'l': 1000, 'liter': 1000, 'liters': 1000, 'litre': 1000, 'litres': 1000,
+        'cup': 240, 'cups': 240,
+        'tablespoon': 15, 'tablespoons': 15, 'tbsp': 15,
+        'teaspoon': 5, 'teaspoons': 5, 'tsp': 5
+    }
+    count_units = {
+        'piece': 1, 'pieces': 1, 'pc': 1, 'pcs': 1,
+        'item': 1, 'items': 1, 'unit': 1, 'units': 1,
+        'pack': 1, 'packs': 1, 'packet': 1, 'packets': 1
+    }
+    if from_unit in weight_units and to_unit in weight_units:
+        return quantity * weight_units[from_unit] / weight_units[to_unit]
+    elif from_unit in volume_units and to_unit in volume_units:
+        return quantity * volume_units[from_unit] / volume_units[to_unit]
+    elif from_unit in count_units and to_unit in count_units:
+        return quantity
+    else:
+        vi.logger.warning(f"Cannot convert from {from_unit} to {to_unit} - incompatible unit types")
+        return quantity
+
+
+def legacy_inventory_on_date(db, date_parsed):
+    """The pre-window-function report: one latest-log query and one batch lookup per ingredient"""
+    response = []
+    for (ingredient_id,) in db.query(vi.InventoryLog.ingredient_id).distinct().all():
+        latest_log = db.query(vi.InventoryLog).filter(
+            vi.InventoryLog.ingredient_id == ingredient_id,
+            vi.InventoryLog.date <= date_parsed
+        ).order_by(vi.InventoryLog.date.desc()).first()
+        if latest_log:
+            inventory_item = db.query(vi.Inventory).filter(vi.Inventory.id == ingredient_id).first()
+            response.append((ingredient_id, inventory_item.name, latest_log.quantity_left))
+    return response
+
+
+def legacy_prepare_dish_check(db, dish_name, quantity):
+    """The pre-stock-table availability check: every positive batch of every ingredient is loaded"""
+    dish = db.query(vi.Dish).filter(vi.Dish.name.ilike(dish_name)).first()
+    can_prepare = True
+    for ingredient in db.query(vi.DishIngredient).filter(vi.DishIngredient.dish_id == dish.id).all():
+        required_qty = ingredient.quantity_required * quantity
+        recipe_unit = vi.get_recipe_unit(ingredient)
+        total_available = sum(
+            vi.convert_to_base_unit(batch.quantity, batch.unit, recipe_unit, ingredient.ingredient_name)
+            for batch in db.query(vi.Inventory).filter(
+                vi.Inventory.name_key == vi.normalize_name_key(ingredient.ingredient_name),
+                vi.Inventory.quantity > 0
+            ).all()
+        )
+        can_prepare = can_prepare and total_available >= required_qty
+    return can_prepare
+
+
+def legacy_upload_inventory(db, contents):
+    """The pre-index upload loop: one duplicate query and one flush per spreadsheet row"""
+    sheet = load_workbook(filename=BytesIO(contents)).active
+    for row in sheet.iter_rows(min_row=2, values_only=True):
+        name, quantity, unit, price_per_unit, date_added = row[:5]
+        total_cost = quantity * price_per_unit
+        existing = db.query(vi.Inventory).filter(
+            vi.Inventory.name == name,
+            vi.Inventory.unit == unit,
+            func.abs(vi.Inventory.quantity - quantity) < 0.001,
+            func.abs(vi.Inventory.total_cost - total_cost) < 0.01
+        ).first()
+        if existing:
+            continue
+        db.add(vi.Inventory(name=name, quantity=quantity, unit=unit, price_per_unit=price_per_unit,
+                            total_cost=total_cost, type="Bench", date_added=date_added))
+        db.add(vi.Expense(item_name=name, quantity=quantity, total_cost=total_cost, date=date_added))
+        db.flush()
+    db.commit()
+
+
+# --- Scenarios ---
+
+def bench_prepare_dish(orders=200, ingredient_count=25, batches_per_ingredient=4):
+    """Per-order latency of /prepare_dish, legacy query pattern vs the FIFO allocator"""
+    print(f"prepare_dish: {orders} orders, {ingredient_count} ingredients x {batches_per_ingredient} batches")
+    reset_database()
+    db = vi.SessionLocal()
+    seed_dish(db, "Legacy Curry", ingredient_count, batches_per_ingredient)
+    seed_dish(db, "Allocator Curry", ingredient_count, batches_per_ingredient)
+
+    for label, run in (
+        ("legacy", lambda: legacy_prepare_dish(db, "Legacy Curry", 1)),
+        ("fifo allocator", lambda: vi.prepare_dish(dish_name="Allocator Curry", quantity=1, date=None, db=db)),
+    ):
+        timings = []
+        query_counter.reset()
+        for _ in range(orders):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        report(label, timings, query_counter.count)
+
+    db.close()
+
+
+def bench_prepare_dish_check(checks=200, ingredient_count=25, batches_per_ingredient=200):
+    """/prepare_dish_check on heavily restocked ingredients, batch scan vs the ingredient_stock lookup"""
+    print(f"prepare_dish_check: {checks} checks, {ingredient_count} ingredients x {batches_per_ingredient} batches")
+    reset_database()
+    db = vi.SessionLocal()
+    seed_dish(db, "Stocked Curry", ingredient_count, batches_per_ingredient)
+
+    for label, run in (
+        ("batch scan", lambda: legacy_prepare_dish_check(db, "Stocked Curry", 1)),
+        ("ingredient_stock", lambda: vi.prepare_dish_check(dish_name="Stocked Curry", quantity=1, db=db)),
+    ):
+        timings = []
+        query_counter.reset()
+        for _ in range(checks):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        report(label, timings, query_counter.count)
+
+    db.close()
+
+
+def bench_menu_feasibility(dish_count=300, ingredients_per_dish=12, ingredient_count=1000, calls=20):
+    """Whole-menu feasibility, prepare_dish_check per dish vs the cached requirement matrix"""
+    print(f"menu feasibility: {dish_count} dishes x {ingredients_per_dish} ingredients over {ingredient_count} items")
+    reset_database()
+    db = vi.SessionLocal()
+    rng = random.Random(14)
+    db.bulk_insert_mappings(vi.Inventory, [{
+        "name": f"Item {i}", "quantity": rng.uniform(1, 20), "unit": "kg", "price_per_unit": 1.0,
+        "total_cost": 10.0, "type": "Bench", "date_added": datetime(2024, 1, 1) + timedelta(days=b)
+    } for i in range(ingredient_count) for b in range(3)])
+    dish_type = vi.DishType(name="Bench")
+    db.add(dish_type)
+    db.flush()
+    db.bulk_insert_mappings(vi.Dish, [{"name": f"Dish {d}", "type_id": dish_type.id} for d in range(dish_count)])
+    db.flush()
+    db.bulk_insert_mappings(vi.DishIngredient, [{
+        "dish_id": dish_id, "ingredient_name": f"Item {i}", "quantity_required": rng.uniform(10, 500), "unit": "gm"
+    } for (dish_id,) in db.query(vi.Dish.id).all() for i in rng.sample(range(ingredient_count), ingredients_per_dish)])
+    vi.rebuild_ingredient_stock(db)
+    db.commit()
+    dish_names = [f"Dish {d}" for d in range(dish_count)]
+
+    def per_dish_checks():
+        for dish_name in dish_names:
+            vi.prepare_dish_check(dish_name=dish_name, quantity=1, db=db)
+
+    def cold_matrix():
+        vi.menu_matrix_cache["loaded_version"] = None
+        vi.menu_feasibility(servings=1, db=db)
+
+    for label, run, runs in (
+        ("prepare_dish_check x menu", per_dish_checks, 3),
+        ("matrix, rebuilt", cold_matrix, calls),
+        ("matrix, cached", lambda: vi.menu_feasibility(servings=1, db=db), calls),
+    ):
+        timings = []
+        query_counter.reset()
+        for _ in range(runs):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        report(label, timings, query_counter.count)
+
+    db.close()
+
+
+def legacy_dish_cost(db, dish_id):
+    """The pre-batch /dishes/{id}/cost: one latest-batch query per ingredient"""
+    total_cost = 0.0
+    for di in db.query(vi.DishIngredient).filter(vi.DishIngredient.dish_id == dish_id).all():
+        inventory_item = db.query(vi.Inventory).filter(
+            vi.Inventory.name_key == vi.normalize_name_key(di.ingredient_name)
+        ).order_by(vi.Inventory.date_added.desc()).first()
+        total_cost += di.quantity_required * inventory_item.price_per_unit
+    return round(total_cost, 2)
+
+
+CONTENTION_RECIPES = {
+    "Cake": {"flour": 100.0, "sugar": 50.0, "butter": 30.0},
+    "Cookie": {"flour": 50.0, "butter": 20.0},
+}
+
+
+def unchecked_prepare_dish(db, dish_name):
+    """The pre-version /prepare_dish: read the batches, then overwrite their quantities unconditionally"""
+    for ingredient, required in CONTENTION_RECIPES[dish_name].items():
+        batches = db.query(vi.Inventory.id, vi.Inventory.quantity).filter(
+            vi.Inventory.name_key == ingredient, vi.Inventory.quantity > 0
+        ).order_by(vi.Inventory.date_added, vi.Inventory.id).all()
+        if sum(quantity for _, quantity in batches) < required:
+            raise HTTPException(status_code=400, detail=f"Insufficient {ingredient}")
+        for batch_id, quantity in batches:
+            deduct = min(quantity, required)
+            db.execute(update(vi.Inventory.__table__).where(vi.Inventory.id == batch_id).values(
+                quantity=quantity - deduct))
+            required -= deduct
+            if required <= 0:
+                break
+    db.commit()
+
+
+def contention_worker(args):
+    """One gunicorn-like worker process placing `orders` single-serving orders"""
+    mode, orders, seed = args
+    vi.engine.dispose(close=False)  # Don't share the parent's pooled connections across the fork
+    if mode != "writer":
+        vi.sqlite_writer = None
+    vi.stock_conflict_stats.update(retried=0, gave_up=0)
+    rng = random.Random(seed)
+    counts = {"prepared": {dish_name: 0 for dish_name in CONTENTION_RECIPES}, "rejected": 0, "conflicts": 0}
+    for _ in range(orders):
+        dish_name = rng.choice(list(CONTENTION_RECIPES))
+        db = vi.SessionLocal()
+        try:
+            if mode == "unchecked":
+                unchecked_prepare_dish(db, dish_name)
+            else:
+                vi.prepare_dish(dish_name=dish_name, quantity=1, date=None, db=db)
+            counts["prepared"][dish_name] += 1
+        except HTTPException as e:
+            counts["rejected" if e.status_code == 400 else "conflicts"] += 1
+        finally:
+            db.close()
+    counts["retries"] = vi.stock_conflict_stats["retried"]
+    return counts
+
+
+def bench_stock_contention(workers=4, orders_per_worker=100, batches=25):
+    """Concurrent /prepare_dish from several processes, reporting throughput and any stock that went missing.
+    tests/test_stock_contention.py is what checks that no deduction is ever lost"""
+    print(f"stock contention: {workers} processes x {orders_per_worker} orders over {batches} batches per ingredient")
+    modes = [("read-then-write, unchecked", "unchecked"), ("versioned, with retries", "versioned")]
+    if vi.sqlite_writer is not None:
+        modes.append(("sqlite writer queue", "writer"))
+    for label, mode in modes:
+        legacy = mode == "unchecked"
+        reset_database()
+        db = vi.SessionLocal()
+        # Enough stock for roughly two thirds of the orders, so workers race for the last batches too
+        batch_quantity = orders_per_worker * workers * 55.0 / batches
+        initial = {}
+        for ingredient in ("flour", "sugar", "butter"):
+            initial[ingredient] = batch_quantity * batches
+            db.bulk_insert_mappings(vi.Inventory, [{
+                "name": ingredient, "quantity": batch_quantity, "unit": "gm", "price_per_unit": 0.01,
+                "total_cost": batch_quantity * 0.01, "type": "Bench",
+                "date_added": datetime(2024, 1, 1) + timedelta(hours=b)
+            } for b in range(batches)])
+        db.commit()
+        db.close()
+        for dish_name, recipe in CONTENTION_RECIPES.items():
+            client.post("/add_dish", json={"name": dish_name, "type": "Bench", "ingredients": [
+                {"name": ingredient, "quantity_required": quantity, "unit": "gm"}
+                for ingredient, quantity in recipe.items()
+            ]})
+        session = vi.SessionLocal()
+        vi.rebuild_ingredient_stock(session)
+        session.commit()
+        session.close()
+
+        started = time.perf_counter()
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            results = pool.map(contention_worker, [(mode, orders_per_worker, w) for w in range(workers)])
+        elapsed = time.perf_counter() - started
+
+        prepared = {dish_name: sum(r["prepared"][dish_name] for r in results) for dish_name in CONTENTION_RECIPES}
+        session = vi.SessionLocal()
+        remaining = dict(session.query(vi.Inventory.name_key, func.sum(vi.Inventory.quantity)).group_by(
+            vi.Inventory.name_key).all())
+        negative = session.query(vi.Inventory.id).filter(vi.Inventory.quantity < -1e-9).count()
+        stock_drift = len(vi.check_ingredient_stock(session)) if not legacy else None
+        session.close()
+
+        lost = sum(
+            abs(initial[ingredient] - remaining[ingredient] - sum(
+                prepared[dish_name] * recipe.get(ingredient, 0.0) for dish_name, recipe in CONTENTION_RECIPES.items()
+            ))
+            for ingredient in initial
+        )
+        total_orders = workers * orders_per_worker
+        print(f"  {label:<28} {total_orders / elapsed:7.1f} orders/s   prepared {sum(prepared.values())}"
+              f"   rejected {sum(r['rejected'] for r in results)}   409s {sum(r['conflicts'] for r in results)}"
+              f"   retries {sum(r['retries'] for r in results)}")
+        print(f"  {'':<28} unaccounted stock {lost:.1f} gm   negative batches {negative}"
+              + (f"   ingredient_stock mismatches {stock_drift}" if stock_drift is not None else ""))
+
+
+def bench_concurrent_prepare(threads=16, orders_per_thread=25, ingredient_count=10, batches_per_ingredient=4):
+    """/prepare_dish from many request threads at once, each committing on its own vs the SQLite writer queue"""
+    print(f"concurrent prepare: {threads} threads x {orders_per_thread} orders, "
+          f"{ingredient_count} ingredients x {batches_per_ingredient} batches")
+    if vi.sqlite_writer is None:
+        print("  skipped: the SQLite writer queue is off for this database")
+        return
+    writer = vi.sqlite_writer
+
+    for label, mode_writer in (("own transaction per request", None), ("sqlite writer queue", writer)):
+        reset_database()
+        db = vi.SessionLocal()
+        seed_dish(db, "Rush Curry", ingredient_count, batches_per_ingredient)
+        db.close()
+        vi.sqlite_writer = mode_writer
+        writer.stats.update(groups=0, jobs=0)
+
+        timings = []
+        failures = []
+        timings_lock = threading.Lock()
+
+        def place_orders():
+            for _ in range(orders_per_thread):
+                session = vi.SessionLocal()
+                started = time.perf_counter()
+                try:
+                    vi.prepare_dish(dish_name="Rush Curry", quantity=1, date=None, db=session)
+                except Exception as e:
+                    with timings_lock:
+                        failures.append(type(e).__name__)
+                finally:
+                    session.close()
+                with timings_lock:
+                    timings.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=place_orders) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        report(label, timings)
+        line = f"  {'':<28} {len(timings) / elapsed:7.1f} orders/s   failed {len(failures)}"
+        if mode_writer is not None:
+            line += f"   {writer.stats['jobs'] / max(writer.stats['groups'], 1):.1f} jobs per commit"
+        print(line)
+
+    vi.sqlite_writer = writer
+
+
+def bench_pool_sizing(threads=16, requests_per_thread=100, stocked_rows=2000, pool_sizes=(2, 8, 16)):
+    """Short read requests from many threads, a connection per checkout vs queue pools of several sizes"""
+    print(f"pool sizing: {threads} threads x {requests_per_thread} reads of 100 rows out of {stocked_rows}")
+    reset_database()
+    db = vi.SessionLocal()
+    db.add_all(vi.Inventory(name=f"Pool item {i}", quantity=10.0, unit="kg", price_per_unit=5.0, total_cost=50.0,
+                            type="Bench", date_added=datetime(2024, 1, 1)) for i in range(stocked_rows))
+    db.commit()
+    db.close()
+
+    connect_args = {"check_same_thread": False} if vi.DATABASE_URL.startswith("sqlite") else {}
+    variants = [("connection per checkout", {"poolclass": vi.MeteredNullPool})]
+    variants += [(f"queue pool of {size}", {"poolclass": vi.MeteredQueuePool, "pool_size": size, "max_overflow": 0})
+                 for size in pool_sizes]
+    for label, options in variants:
+        engine = vi.create_engine(vi.DATABASE_URL, connect_args=connect_args, **options)
+        vi.SessionLocal.configure(bind=engine)
+        vi.pool_metrics.reset()
+        timings = []
+        timings_lock = threading.Lock()
+
+        def read_rows():
+            for _ in range(requests_per_thread):
+                started = time.perf_counter()
+                session = vi.SessionLocal()
+                try:
+                    session.query(vi.Inventory).order_by(vi.Inventory.id.desc()).limit(100).all()
+                finally:
+                    session.close()
+                with timings_lock:
+                    timings.append(time.perf_counter() - started)
+
+        workers = [threading.Thread(target=read_rows) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        vi.SessionLocal.configure(bind=vi.engine)
+        engine.dispose()
+
+        metrics = vi.pool_metrics.snapshot()
+        report(label, timings)
+        print(f"  {'':<28} pool wait mean {metrics['wait_ms']['mean']:6.2f} ms   max {metrics['wait_ms']['max']:7.2f} ms"
+              f"   connects {metrics['connects']}   peak checked out {metrics['peak_checked_out']}")
+    vi.pool_metrics.reset()
+
+
+ASYNC_READ_REQUESTS = (
+    ("GET", "/inventory", {"limit": 100}),
+    ("GET", "/inventory/changes", {"limit": 100}),
+    ("GET", "/dishes", {}),
+)
+
+
+def start_server(port, extra_env):
+    """A uvicorn process serving the app on the benchmark database, once it answers /health"""
+    env = dict(os.environ, **extra_env)
+    # A longer keep-alive, or connections idling behind slow responses are closed under the client's feet
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "vibesInventory:app", "--port", str(port), "--log-level", "warning", "--timeout-keep-alive", "60"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    import httpx
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("uvicorn did not come up")
+
+
+async def read_load(base_url, concurrency, total):
+    """`total` requests cycling through ASYNC_READ_REQUESTS from `concurrency` clients, returns (elapsed, timings)"""
+    import httpx
+    timings = []
+    failures = 0
+    remaining = iter(range(total))
+
+    async def client_loop(http):
+        nonlocal failures
+        for n in remaining:
+            method, path, params = ASYNC_READ_REQUESTS[n % len(ASYNC_READ_REQUESTS)]
+            started = time.perf_counter()
+            response = await http.request(method, path, params=params)
+            timings.append(time.perf_counter() - started)
+            failures += response.status_code != 200
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*[client_loop(http) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+    if failures:
+        print(f"  {failures} request(s) failed")
+    return elapsed, timings
+
+
+def bench_async_reads(concurrency_levels=(16, 64, 256), requests_per_level=2000, stocked_rows=5000):
+    """Load test of the hot read endpoints on a uvicorn worker, threadpool (sync) vs event loop (ASYNC_DATABASE)"""
+    print(f"async reads: {requests_per_level} requests per level over {len(ASYNC_READ_REQUESTS)} endpoints, "
+          f"{stocked_rows} inventory rows")
+    reset_database()
+    db = vi.SessionLocal()
+    db.bulk_insert_mappings(vi.Inventory, [{
+        "name": f"Item {i % 500}", "quantity": 5.0, "unit": "kg", "price_per_unit": 1.0 + i % 7,
+        "total_cost": 5.0 + i % 7, "type": "Bench", "date_added": datetime(2024, 1, 1) + timedelta(hours=i)
+    } for i in range(stocked_rows)])
+    vi.rebuild_expense_rollup(db)
+    seed_dish(db, "Load Curry", 10, 4)
+    db.close()
+
+    for label, extra_env in (("sync, threadpool", {"ASYNC_DATABASE": "false"}),
+                             ("async engine", {"ASYNC_DATABASE": "true"})):
+        server = start_server(8765, extra_env)
+        try:
+            asyncio.run(read_load("http://127.0.0.1:8765", 8, 100))  # Warm up connections and caches
+            for concurrency in concurrency_levels:
+                elapsed, timings = asyncio.run(read_load("http://127.0.0.1:8765", concurrency, requests_per_level))
+                report(f"{label}, {concurrency} clients", timings)
+                print(f"  {'':<28} {len(timings) / elapsed:7.1f} requests/s")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def seed_costed_menu(db, dish_count, ingredients_per_dish, ingredient_count, rng):
+    """`dish_count` dishes over `ingredient_count` items, each bought in five batches at random prices"""
+    db.bulk_insert_mappings(vi.Inventory, [{
+        "name": f"Item {i}", "quantity": rng.uniform(1, 20), "unit": "kg", "price_per_unit": rng.uniform(1, 50),
+        "total_cost": 10.0, "type": "Bench", "date_added": datetime(2024, 1, 1) + timedelta(days=b)
+    } for i in range(ingredient_count) for b in range(5)])
+    dish_type = vi.DishType(name="Bench")
+    db.add(dish_type)
+    db.flush()
+    db.bulk_insert_mappings(vi.Dish, [{"name": f"Dish {d}", "type_id": dish_type.id} for d in range(dish_count)])
+    db.flush()
+    db.bulk_insert_mappings(vi.DishIngredient, [{
+        "dish_id": dish_id, "ingredient_name": f"Item {i}", "quantity_required": rng.uniform(0.1, 2), "unit": "kg"
+    } for (dish_id,) in db.query(vi.Dish.id).all() for i in rng.sample(range(ingredient_count), ingredients_per_dish)])
+    db.commit()
+
+
+def bench_dish_costs(dish_count=300, ingredients_per_dish=12, ingredient_count=1000, calls=20):
+    """Whole-menu costing, per-dish latest-price queries vs /dishes/costs over the cached price map"""
+    print(f"dish costs: {dish_count} dishes x {ingredients_per_dish} ingredients over {ingredient_count} items")
+    reset_database()
+    db = vi.SessionLocal()
+    seed_costed_menu(db, dish_count, ingredients_per_dish, ingredient_count, random.Random(19))
+    dish_ids = [dish_id for (dish_id,) in db.query(vi.Dish.id).order_by(vi.Dish.id).all()]
+
+    def per_dish_costs():
+        for dish_id in dish_ids:
+            legacy_dish_cost(db, dish_id)
+
+    def cold_prices():
+        vi.ingredient_price_cache["loaded_version"] = None
+        vi.get_dish_costs(dish_ids=None, name=None, type=None, db=db)
+
+    for label, run, runs in (
+        ("get_dish_cost x menu", per_dish_costs, 3),
+        ("/dishes/costs, prices loaded", cold_prices, calls),
+        ("/dishes/costs, prices cached", lambda: vi.get_dish_costs(dish_ids=None, name=None, type=None, db=db),
+         calls),
+    ):
+        timings = []
+        query_counter.reset()
+        for _ in range(runs):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        report(label, timings, query_counter.count)
+
+    db.close()
+
+
+def bench_dish_cost_propagation(dish_count=2000, ingredients_per_dish=12, ingredient_count=1000, writes=50):
+    """A batch price change, whole dish_cost rebuild vs recomputing the dishes using the ingredient"""
+    print(f"dish cost propagation: {writes} price changes over {dish_count} dishes x {ingredients_per_dish} "
+          f"ingredients")
+    reset_database()
+    db = vi.SessionLocal()
+    rng = random.Random(20)
+    seed_costed_menu(db, dish_count, ingredients_per_dish, ingredient_count, rng)
+    vi.rebuild_dish_costs(db)
+    db.commit()
+    db.close()
+
+    def price_change(session):
+        vi.add_item(db=session, name=f"Item {rng.randrange(ingredient_count)}", quantity=1.0, unit="kg",
+                    price_per_unit=rng.uniform(1, 50), total_cost=None, type="Bench", date_added=datetime(2025, 1, 1))
+
+    def full_rebuild(session):
+        vi.rebuild_dish_costs(session)
+        session.commit()
+
+    for label, run in (
+        ("whole table rebuilt", full_rebuild),
+        ("add_item, affected dishes", price_change),
+        ("/dishes/costs after a write", lambda session: (price_change(session), client.get("/dishes/costs"))),
+        ("/menu/costs after a write", lambda session: (price_change(session), client.get("/menu/costs"))),
+    ):
+        timings = []
+        for _ in range(writes):
+            session = vi.SessionLocal()
+            started = time.perf_counter()
+            run(session)
+            timings.append(time.perf_counter() - started)
+            session.close()
+        report(label, timings)
+
+    session = vi.SessionLocal()
+    assert not vi.check_dish_costs(session), "dish_cost drifted from the recipes"
+    session.close()
+
+
+def legacy_get_inventory(db):
+    """The pre-pagination /inventory: every batch ever bought, loaded as entities and formatted in Python"""
+    return [
+        {
+            "id": item.id, "name": item.name, "price_per_unit": item.price_per_unit, "unit": item.unit,
+            "quantity": item.quantity, "total_cost": item.total_cost, "type": item.type,
+            "date_added": item.date_added.strftime("%Y-%m-%d %H:%M:%S")
+        }
+        for item in db.query(vi.Inventory).all()
+    ]
+
+
+def bench_inventory_page(stocked_rows=100000, in_stock_share=0.1, page_size=100, calls=20):
+    """GUI inventory refresh, the whole purchase history vs one page of in-stock batches"""
+    print(f"inventory page: {stocked_rows} rows, {in_stock_share:.0%} in stock, pages of {page_size}")
+    reset_database()
+    db = vi.SessionLocal()
+    rng = random.Random(15)
+    start = datetime(2024, 1, 1)
+    db.bulk_insert_mappings(vi.Inventory, [{
+        "name": f"Item {i % 500}", "quantity": 5.0 if rng.random() < in_stock_share else 0.0, "unit": "kg",
+        "price_per_unit": 1.0, "total_cost": 5.0, "type": "Bench", "date_added": start + timedelta(minutes=i)
+    } for i in range(stocked_rows)])
+    db.commit()
+
+    for label, run in (
+        ("full history, legacy", lambda: legacy_get_inventory(db)),
+        ("full history, projected", lambda: client.get("/inventory")),
+        ("first in-stock page", lambda: client.get("/inventory", params={"only_in_stock": True, "limit": page_size})),
+    ):
+        timings = []
+        for _ in range(calls):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+            db.expire_all()
+        report(label, timings)
+
+    db.close()
+
+
+def legacy_add_item(db, **values):
+    """The pre-version /add_item response: the new row plus the whole inventory table"""
+    vi.add_item(db=db, **values)
+    return jsonable_encoder({"message": "Item added successfully!", "inventory": db.query(vi.Inventory).all()})
+
+
+def bench_inventory_writes(sizes=(1000, 10000, 50000), writes=50):
+    """/add_item latency as the inventory table grows, full-table response vs affected row plus version"""
+    print(f"inventory writes: {writes} add_item calls at each of {', '.join(map(str, sizes))} rows")
+    for size in sizes:
+        reset_database()
+        db = vi.SessionLocal()
+        db.bulk_insert_mappings(vi.Inventory, [{
+            "name": f"Item {i % 500}", "quantity": 5.0, "unit": "kg", "price_per_unit": 1.0,
+            "total_cost": 5.0, "type": "Bench", "date_added": datetime(2024, 1, 1) + timedelta(minutes=i)
+        } for i in range(size)])
+        db.commit()
+
+        db.close()
+
+        values = dict(name="Bench item", quantity=1.0, unit="kg", price_per_unit=1.0, total_cost=None,
+                      type="Bench", date_added=datetime(2024, 6, 1))
+        for label, run in (
+            (f"{size} rows, full table", lambda session: legacy_add_item(session, **values)),
+            (f"{size} rows, versioned", lambda session: vi.add_item(db=session, **values)),
+        ):
+            timings = []
+            for _ in range(writes):
+                session = vi.SessionLocal()  # A request's session, so loaded rows don't pile up
+                started = time.perf_counter()
+                run(session)
+                timings.append(time.perf_counter() - started)
+                session.close()
+            report(label, timings)
+
+
+def bench_change_feed(clients=20, writes=50, stocked_rows=5000, page_size=100):
+    """Keeping `clients` screens current after each write, every client re-fetching vs one /events fan-out"""
+    print(f"change feed: {clients} clients, {writes} writes over {stocked_rows} rows")
+    reset_database()
+    db = vi.SessionLocal()
+    db.bulk_insert_mappings(vi.Inventory, [{
+        "name": f"Item {i % 500}", "quantity": 5.0, "unit": "kg", "price_per_unit": 1.0,
+        "total_cost": 5.0, "type": "Bench", "date_added": datetime(2024, 1, 1) + timedelta(minutes=i)
+    } for i in range(stocked_rows)])
+    db.commit()
+    db.close()
+
+    def write():
+        session = vi.SessionLocal()
+        vi.add_item(db=session, name="Bench item", quantity=1.0, unit="kg", price_per_unit=1.0, total_cost=None,
+                    type="Bench", date_added=datetime(2024, 6, 1))
+        session.close()
+
+    # Polling: every client reloads its inventory page and the dish list after a write
+    timings = []
+    query_counter.reset()
+    for _ in range(writes):
+        write()
+        started = time.perf_counter()
+        for _ in range(clients):
+            client.get("/inventory", params={"only_in_stock": True, "limit": page_size})
+            client.get("/dishes")
+        timings.append(time.perf_counter() - started)
+    report("re-fetch per client", timings, query_counter.count)
+
+    # Change feed: subscribers on their own event loop, timed from commit to the last delivery
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    async def subscribe():
+        return vi.change_feed.subscribe()
+
+    subscribers = [asyncio.run_coroutine_threadsafe(subscribe(), loop).result() for _ in range(clients)]
+    session = vi.SessionLocal()
+    vi.change_feed.start_from(vi.current_inventory_version(session))
+    session.close()
+
+    async def receive_all():
+        for subscriber in subscribers:
+            await subscriber.queue.get()
+
+    timings = []
+    query_counter.reset()
+    for _ in range(writes):
+        write()
+        started = time.perf_counter()
+        asyncio.run_coroutine_threadsafe(receive_all(), loop).result()
+        timings.append(time.perf_counter() - started)
+    report("change feed fan-out", timings, query_counter.count)
+
+    for subscriber in subscribers:
+        vi.change_feed.unsubscribe(subscriber)
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def bench_conditional_get(stocked_rows=5000, dish_count=300, calls=200):
+    """Repeat GETs from a client that already has the data, full responses vs If-None-Match"""
+    print(f"conditional get: {calls} calls per endpoint, {stocked_rows} inventory rows, {dish_count} dishes")
+    reset_database()
+    db = vi.SessionLocal()
+    db.bulk_insert_mappings(vi.Inventory, [{
+        "name": f"Item {i % 500}", "quantity": 5.0, "unit": "kg", "price_per_unit": 1.0,
+        "total_cost": 5.0, "type": "Bench", "date_added": datetime(2024, 1, 1) + timedelta(minutes=i)
+    } for i in range(stocked_rows)])
+    dish_type = vi.DishType(name="Bench")
+    db.add(dish_type)
+    db.flush()
+    db.bulk_insert_mappings(vi.Dish, [{"name": f"Dish {d}", "type_id": dish_type.id} for d in range(dish_count)])
+    db.commit()
+    db.close()
+
+    for path in ("/inventory", "/dishes", "/dish_types", "/search_inventory"):
+        etag = client.get(path).headers["ETag"]
+        for label, headers in ((f"{path}", {}), (f"{path} if-none-match", {"If-None-Match": etag})):
+            timings = []
+            query_counter.reset()
+            for _ in range(calls):
+                started = time.perf_counter()
+                client.get(path, headers=headers)
+                timings.append(time.perf_counter() - started)
+            report(label, timings, query_counter.count)
+
+
+def bench_idempotent_replay(ingredient_count=25, batches_per_ingredient=4, calls=100):
+    """/prepare_dish retried by a client, executing every time vs replaying the stored response"""
+    print(f"idempotent replay: {calls} retried orders, {ingredient_count} ingredients x {batches_per_ingredient} batches")
+    reset_database()
+    db = vi.SessionLocal()
+    seed_dish(db, "Replay Curry", ingredient_count, batches_per_ingredient)
+    db.commit()
+    db.close()
+
+    params = {"dish_name": "Replay Curry", "quantity": 1}
+    for label, headers_for in (
+        ("no key, executed", lambda call: {}),
+        ("new key, executed", lambda call: {"Idempotency-Key": f"order-{call}"}),
+        ("retried key, replayed", lambda call: {"Idempotency-Key": "order-0"}),
+    ):
+        timings = []
+        query_counter.reset()
+        for call in range(calls):
+            started = time.perf_counter()
+            response = client.post("/prepare_dish", params=params, headers=headers_for(call))
+            timings.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.text
+        report(label, timings, query_counter.count)
+
+
+def inventory_workbook(rows, item_count, seed):
+    """Supplier-invoice style workbook with `rows` lines spread over `item_count` items"""
+    rng = random.Random(seed)
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(["name", "quantity", "unit", "price_per_unit", "date_added", "type"])
+    start = datetime(2024, 1, 1)
+    for _ in range(rows):
+        sheet.append([
+            f"Item {rng.randrange(item_count)}", rng.randint(1, 500) / 10, "kg",
+            rng.randint(10, 900) / 10, start + timedelta(days=rng.randrange(365)), "Bench"
+        ])
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def bench_upload_inventory(rows=5000, item_count=300, existing_rows=5000):
+    """/upload_inventory_excel on a large invoice, per-row duplicate queries vs the in-memory index"""
+    print(f"upload_inventory_excel: {rows} rows over {item_count} items, {existing_rows} rows already stocked")
+    existing = inventory_workbook(existing_rows, item_count, seed=1)
+    invoice = inventory_workbook(rows, item_count, seed=2)
+
+    reset_database()
+    db = vi.SessionLocal()
+    legacy_upload_inventory(db, existing)
+    query_counter.reset()
+    started = time.perf_counter()
+    legacy_upload_inventory(db, invoice)
+    report("legacy", [time.perf_counter() - started], query_counter.count)
+    db.close()
+
+    reset_database()
+    client.post("/upload_inventory_excel", files={"file": ("existing.xlsx", existing)})
+    query_counter.reset()
+    started = time.perf_counter()
+    response = client.post("/upload_inventory_excel", files={"file": ("invoice.xlsx", invoice)})
+    report("duplicate index", [time.perf_counter() - started], query_counter.count)
+    print(f"  accepted {response.json()['summary']['successful']} of {rows} rows")
+
+
+def peak_memory(run):
+    """Peak Python heap allocated while `run` executes, in MB"""
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def bench_ingest_memory(sizes=(2000, 8000, 32000)):
+    """Peak memory of reading an inventory workbook, full in-memory load vs the streaming pipeline"""
+    print(f"ingest memory: inventory workbooks of {', '.join(str(size) for size in sizes)} rows")
+    path = os.path.join(BENCH_DIR, "ingest.xlsx")
+
+    def full_load(contents):
+        sheet = load_workbook(filename=BytesIO(contents)).active
+        for _ in sheet.iter_rows(min_row=2, values_only=True):
+            pass
+
+    def streamed(path):
+        with vi.open_excel_rows(path) as (headers, rows):
+            for _ in vi.chunked(rows, vi.INGEST_CHUNK_SIZE):
+                pass
+
+    for size in sizes:
+        contents = inventory_workbook(size, 300, seed=3)
+        with open(path, "wb") as spooled:
+            spooled.write(contents)
+        legacy_mb = peak_memory(lambda: full_load(contents))
+        streamed_mb = peak_memory(lambda: streamed(path))
+        print(f"  {size:>6} rows   full load {legacy_mb:8.1f} MB   streamed {streamed_mb:8.1f} MB")
+
+
+def bench_background_upload(rows=20000, item_count=300, samples=200):
+    """Latency of a cheap read endpoint on its own and while a large background import runs"""
+    print(f"background upload: /dish_types latency during a {rows}-row queued inventory import")
+    reset_database()
+    invoice = inventory_workbook(rows, item_count, seed=4)
+
+    def sample(count):
+        timings = []
+        for _ in range(count):
+            started = time.perf_counter()
+            client.get("/dish_types")
+            timings.append(time.perf_counter() - started)
+        return timings
+
+    report("idle", sample(samples))
+
+    started = time.perf_counter()
+    job_id = client.post(
+        "/upload_inventory_excel", params={"background": True}, files={"file": ("invoice.xlsx", invoice)}
+    ).json()["job_id"]
+    report("enqueue", [time.perf_counter() - started])
+
+    timings = []
+    while client.get(f"/jobs/{job_id}").json()["status"] in ("queued", "running"):
+        timings.extend(sample(10))
+    report("during import", timings)
+
+    job = client.get(f"/jobs/{job_id}").json()
+    print(f"  job {job['status']} after {time.perf_counter() - started:.1f} s, "
+          f"{job['rows_processed']} rows in {job['chunks_processed']} chunks")
+
+
+def bench_unit_conversion(calls=200000):
+    """Raw conversion cost, per-call unit tables vs the cached registry factors"""
+    print(f"unit conversion: {calls} calls over a mix of unit pairs")
+    pairs = [("kg", "gm"), ("gm", "kg"), ("l", "ml"), ("tbsp", "ml"), ("pcs", "piece"), ("lb", "oz"), ("gm", "gm")]
+    workload = [(float(i % 97) + 0.5,) + pairs[i % len(pairs)] for i in range(calls)]
+
+    for label, convert in (
+        ("legacy", legacy_convert_to_base_unit),
+        ("registry", vi.convert_to_base_unit),
+    ):
+        started = time.perf_counter()
+        for quantity, from_unit, to_unit in workload:
+            convert(quantity, from_unit, to_unit)
+        elapsed = time.perf_counter() - started
+        print(f"  {label:<28} {elapsed * 1e9 / calls:8.1f} ns/call")
+
+
+def bench_ingredient_lookup(stocked_rows=50000, item_count=2000, lookups=500):
+    """Per-ingredient batch lookup, ilike scan vs equality on the indexed name_key"""
+    print(f"ingredient lookup: {lookups} lookups against {stocked_rows} rows over {item_count} items")
+    reset_database()
+    db = vi.SessionLocal()
+    start = datetime(2024, 1, 1)
+    db.bulk_insert_mappings(vi.Inventory, [{
+        "name": f"Item {i % item_count}", "quantity": 10.0, "unit": "kg", "price_per_unit": 1.0,
+        "total_cost": 10.0, "type": "Bench", "date_added": start + timedelta(minutes=i)
+    } for i in range(stocked_rows)])
+    db.commit()
+
+    names = [f"item {random.randrange(item_count)}" for _ in range(lookups)]
+    for label, condition in (
+        ("ilike", lambda name: vi.Inventory.name.ilike(name)),
+        ("name_key", lambda name: vi.Inventory.name_key == vi.normalize_name_key(name)),
+    ):
+        timings = []
+        for name in names:
+            started = time.perf_counter()
+            db.query(vi.Inventory).filter(condition(name), vi.Inventory.quantity > 0).all()
+            timings.append(time.perf_counter() - started)
+        report(label, timings)
+
+    db.close()
+
+
+def seed_inventory_log(db, log_rows, ingredient_count, rng, date_count):
+    """A year of random preparation logs over `ingredient_count` batches, returns random query dates"""
+    reset_database()
+    db.bulk_insert_mappings(vi.Inventory, [{
+        "name": f"Item {i}", "quantity": 10.0, "unit": "kg", "price_per_unit": 1.0,
+        "total_cost": 10.0, "type": "Bench", "date_added": datetime(2024, 1, 1)
+    } for i in range(ingredient_count)])
+    db.commit()
+
+    start = datetime(2024, 1, 1)
+    with vi.engine.begin() as connection:
+        for offset in range(0, log_rows, 50000):
+            connection.execute(vi.InventoryLog.__table__.insert(), [{
+                "ingredient_id": rng.randint(1, ingredient_count),
+                "quantity_left": rng.random() * 10,
+                "date": start + timedelta(minutes=rng.randrange(365 * 24 * 60))
+            } for _ in range(min(50000, log_rows - offset))])
+
+    return [(start + timedelta(days=rng.randrange(365))).strftime("%Y-%m-%d") for _ in range(date_count)]
+
+
+def bench_inventory_on_date(log_rows=1000000, ingredient_count=2000, calls=5):
+    """/inventory_on_date over a large log, 2N+1 queries vs one ROW_NUMBER() query, with and without the index"""
+    print(f"inventory_on_date: {log_rows} log rows over {ingredient_count} batches")
+    db = vi.SessionLocal()
+    rng = random.Random(5)
+    dates = seed_inventory_log(db, log_rows, ingredient_count, rng, calls)
+    log_table = vi.InventoryLog.__table__
+    log_index = next(index for index in log_table.indexes if index.name == "ix_inventory_log_ingredient_date")
+
+    for indexed in (False, True):
+        if indexed:
+            log_index.create(bind=vi.engine)
+        else:
+            log_index.drop(bind=vi.engine)
+
+        for label, run in (
+            ("legacy", lambda day: legacy_inventory_on_date(db, datetime.strptime(day, "%Y-%m-%d"))),
+            ("row_number", lambda day: vi.inventory_on_date(date=day, db=db)),
+        ):
+            timings = []
+            query_counter.reset()
+            for day in dates:
+                started = time.perf_counter()
+                run(day)
+                timings.append(time.perf_counter() - started)
+            report(f"{label} ({'indexed' if indexed else 'no index'})", timings, query_counter.count)
+
+    db.close()
+
+
+def bench_inventory_snapshots(log_rows=1000000, ingredient_count=2000, calls=20):
+    """Point-in-time stock over a large log, whole-log ROW_NUMBER() vs nearest snapshot plus delta"""
+    print(f"inventory snapshots: {log_rows} log rows over {ingredient_count} batches, "
+          f"every {vi.SNAPSHOT_INTERVAL_DAYS} days")
+    db = vi.SessionLocal()
+    dates = seed_inventory_log(db, log_rows, ingredient_count, random.Random(6), calls)
+
+    def run_all():
+        timings = []
+        query_counter.reset()
+        for day in dates:
+            started = time.perf_counter()
+            client.get("/inventory_on_date", params={"date": day})
+            timings.append(time.perf_counter() - started)
+        return timings, query_counter.count
+
+    report("whole log", *run_all())
+
+    started = time.perf_counter()
+    vi.run_inventory_snapshots()
+    snapshot_count = db.query(func.count(func.distinct(vi.InventorySnapshot.snapshot_date))).scalar()
+    report(f"take {snapshot_count} snapshots", [time.perf_counter() - started])
+
+    report("snapshot + delta", *run_all())
+
+    timings = []
+    for day in dates:
+        started = time.perf_counter()
+        client.get("/stock_valuation", params={"date": day})
+        timings.append(time.perf_counter() - started)
+    report("stock_valuation", timings)
+
+    db.close()
+
+
+SCENARIOS = {
+    "prepare_dish": bench_prepare_dish,
+    "prepare_dish_check": bench_prepare_dish_check,
+    "menu_feasibility": bench_menu_feasibility,
+    "dish_costs": bench_dish_costs,
+    "stock_contention": bench_stock_contention,
+    "concurrent_prepare": bench_concurrent_prepare,
+    "pool_sizing": bench_pool_sizing,
+    "async_reads": bench_async_reads,
+    "dish_cost_propagation": bench_dish_cost_propagation,
+    "upload_inventory": bench_upload_inventory,
+    "ingest_memory": bench_ingest_memory,
+    "background_upload": bench_background_upload,
+    "unit_conversion": bench_unit_conversion,
+    "ingredient_lookup": bench_ingredient_lookup,
+    "inventory_page": bench_inventory_page,
+    "inventory_writes": bench_inventory_writes,
+    "change_feed": bench_change_feed,
+    "conditional_get": bench_conditional_get,
+    "idempotent_replay": bench_idempotent_replay,
+    "inventory_on_date": bench_inventory_on_date,
+    "inventory_snapshots": bench_inventory_snapshots,
+}
+
+
+def main():
+    selected = sys.argv[1:] or list(SCENARIOS)
+    unknown = [name for name in selected if name not in SCENARIOS]
+    if unknown:
+        print(f"Unknown scenario(s): {', '.join(unknown)}. Available: {', '.join(SCENARIOS)}")
+        sys.exit(1)
+
+    print(f"Database: {vi.DATABASE_URL}")
+    for name in selected:
+        SCENARIOS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
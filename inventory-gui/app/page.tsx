@@ -1,6 +1,6 @@
 'use client'
 
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import axios from "axios";
 import { Card, CardContent, CardHeader, CardTitle} from "@/components/ui/card";
 import { Button } from "@/components/ui/button";
@@ -12,9 +12,13 @@ import PrepareDishForm from "@/components/ui/PrepareDishForm"; // Adjust path if
 
 
 const API_URL = "http://localhost:8000";
+const INVENTORY_PAGE_SIZE = 100;
 
 export default function InventoryApp() {
   const [inventory, setInventory] = useState([]);
+  const [inventoryCursor, setInventoryCursor] = useState(null);
+  const [catalogVersion, setCatalogVersion] = useState(0);
+  const feedConnected = useRef(false);
   const [newItem, setNewItem] = useState({
   name: "",
   quantity: "",
@@ -117,10 +121,22 @@ export default function InventoryApp() {
   }
 };
 
- const fetchInventory = async () => {
+ // Pass the cursor from the previous page to append the next one, or nothing to reload from the start
+ const fetchInventory = async (afterId = null) => {
   try {
-    const res = await axios.get(`${API_URL}/inventory`);
-    setInventory(res.data);
+    const res = await axios.get(`${API_URL}/inventory`, {
+      params: {
+        only_in_stock: true,
+        limit: INVENTORY_PAGE_SIZE,
+        after_id: afterId ?? undefined,
+      },
+    });
+    setInventory(afterId ? (prev) => {
+      // Rows pushed by the change feed may already be on screen
+      const shown = new Set(prev.map((item) => item.id));
+      return [...prev, ...res.data.filter((item) => !shown.has(item.id))];
+    } : res.data);
+    setInventoryCursor(res.headers["x-next-after-id"] ?? null);
 
     // Optional: Print inventory in console as a table
     console.table(res.data);
@@ -129,6 +145,31 @@ export default function InventoryApp() {
   }
 };
 
+  // Apply an /events inventory delta to the rows on screen, exhausted batches drop out like in the in-stock listing
+  const applyInventoryDelta = (delta) => {
+    if (delta.reset) {
+      fetchInventory();
+      return;
+    }
+    const gone = new Set(delta.deleted);
+    delta.upserted.forEach((row) => {
+      if (row.quantity <= 0) gone.add(row.id);
+    });
+    setInventory((prev) => {
+      const rows = new Map(prev.map((item) => [item.id, item]));
+      gone.forEach((id) => rows.delete(id));
+      delta.upserted.forEach((row) => {
+        if (!gone.has(row.id)) rows.set(row.id, row);
+      });
+      return [...rows.values()].sort((a, b) => a.id - b.id);
+    });
+  };
+
+  // Our own writes arrive through the change feed too, only reload when it is down
+  const refreshInventory = () => {
+    if (!feedConnected.current) fetchInventory();
+  };
+
   const fetchDishes = async () => {
     const res = await axios.get(`${API_URL}/dishes`);
     setDishes(res.data);
@@ -189,7 +230,7 @@ export default function InventoryApp() {
 
       if (response.ok) {
         alert(data.message);
-        setInventory(data.current_inventory);
+        refreshInventory();
         setShowUpdateForm(false);
         setSelectedItem(null);
       } else {
@@ -258,6 +299,19 @@ export default function InventoryApp() {
   useEffect(() => {
     fetchInventory();
 
+    const events = new EventSource(`${API_URL}/events`);
+    events.addEventListener("ready", () => {
+      // After a reconnect we may have missed changes, start over from the first page
+      if (feedConnected.current === null) fetchInventory();
+      feedConnected.current = true;
+    });
+    events.addEventListener("inventory", (e) => applyInventoryDelta(JSON.parse(e.data)));
+    events.addEventListener("resync", () => fetchInventory());
+    events.addEventListener("catalog", (e) => setCatalogVersion(JSON.parse(e.data).catalog_version));
+    events.onerror = () => {
+      if (feedConnected.current) feedConnected.current = null;
+    };
+    return () => events.close();
   }, []);
 
 
@@ -297,7 +351,7 @@ export default function InventoryApp() {
       type: "",
       date_added: "",
     });
-    fetchInventory();
+    refreshInventory();
   } catch (error) {
     console.error("Error adding item:", error);
     alert("Failed to add item. Check input values.");
@@ -329,7 +383,7 @@ export default function InventoryApp() {
         quantity: parseFloat(dishQty),
       },
     });
-    fetchInventory();
+    refreshInventory();
   };
 
   const handleInventoryOnDate = async () => {
@@ -363,7 +417,7 @@ export default function InventoryApp() {
 
     const data = await response.json();
     alert(data.message);
-    fetchInventory(); // refresh list
+    refreshInventory(); // refresh list
   } catch (error) {
     alert("Failed to delete item");
   }
@@ -776,6 +830,13 @@ export default function InventoryApp() {
             ))}
           </tbody>
         </table>
+        {inventoryCursor && (
+          <div className="mt-2 flex justify-center">
+            <Button variant="outline" size="sm" onClick={() => fetchInventory(inventoryCursor)}>
+              Load more
+            </Button>
+          </div>
+        )}
       </div>
     )}
   </CardContent>
@@ -954,7 +1015,7 @@ export default function InventoryApp() {
     </Card>
 
     {/* 👇 This needs to be inside the fragment */}
-    <DishList dishes={dishes} />
+    <DishList dishes={dishes} catalogVersion={catalogVersion} />
   </>
 )}
 
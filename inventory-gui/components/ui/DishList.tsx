@@ -22,7 +22,11 @@ interface Dish {
   ingredients: Ingredient[];
 }
 
-const DishList: React.FC = () => {
+interface DishListProps {
+  catalogVersion?: number;
+}
+
+const DishList: React.FC<DishListProps> = ({ catalogVersion }) => {
   const [dishes, setDishes] = useState<Dish[]>([]);
   const [loading, setLoading] = useState(true);
   const [expandedDishIds, setExpandedDishIds] = useState<Set<number>>(new Set());
@@ -37,9 +41,10 @@ const DishList: React.FC = () => {
   const [status, setStatus] = useState<string>("");
   const [details, setDetails] = useState<any>(null);
 
+  // Reload whenever the change feed reports a new catalog version
   useEffect(() => {
-    fetchDishes();
-  }, []);
+    fetchDishes(searchTerm);
+  }, [catalogVersion]);
 
   const fetchDishes = (name?: string) => {
     setLoading(true);
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# Point the app at a scratch database (or TEST_DATABASE_URL) before it creates its engine
+os.environ["DATABASE_URL"] = os.getenv(
+    "TEST_DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='vibes-test-')}/test.db"
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
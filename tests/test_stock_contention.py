@@ -0,0 +1,124 @@
+"""Concurrent /prepare_dish and /add_item calls from several worker processes must never lose a deduction,
+and must leave the derived stock, expense and cost tables matching the raw rows they summarise"""
+import multiprocessing
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import func
+
+import vibesInventory as vi
+
+RECIPES = {
+    "Cake": {"flour": 100.0, "sugar": 50.0, "butter": 30.0},
+    "Cookie": {"flour": 50.0, "butter": 20.0},
+}
+WORKERS = 6
+ORDERS_PER_WORKER = 50
+BATCHES = 10
+RESTOCK_SHARE = 0.5  # Of the calls each worker makes
+RESTOCK_DAY = datetime(2024, 6, 1)  # Every restock lands on the same expense rollup key
+
+
+def seed_stock() -> dict:
+    """Fresh tables with enough stock for roughly two thirds of the orders, returns the initial totals"""
+    vi.Base.metadata.drop_all(bind=vi.engine)
+    vi.Base.metadata.create_all(bind=vi.engine)
+    vi.seed_table_versions()
+
+    batch_quantity = ORDERS_PER_WORKER * WORKERS * 55.0 / BATCHES
+    db = vi.SessionLocal()
+    try:
+        for ingredient in ("flour", "sugar", "butter"):
+            db.bulk_insert_mappings(vi.Inventory, [{
+                "name": ingredient, "quantity": batch_quantity, "unit": "gm", "price_per_unit": 0.01,
+                "total_cost": batch_quantity * 0.01, "type": "Test",
+                "date_added": datetime(2024, 1, 1) + timedelta(hours=batch)
+            } for batch in range(BATCHES)])
+        db.commit()
+    finally:
+        db.close()
+
+    client = TestClient(vi.app)
+    for dish_name, recipe in RECIPES.items():
+        response = client.post("/add_dish", json={"name": dish_name, "type": "Test", "ingredients": [
+            {"name": ingredient, "quantity_required": quantity, "unit": "gm"}
+            for ingredient, quantity in recipe.items()
+        ]})
+        assert response.status_code == 200, response.text
+
+    db = vi.SessionLocal()
+    try:
+        vi.rebuild_ingredient_stock(db)
+        vi.rebuild_expense_rollup(db)
+        vi.rebuild_dish_costs(db)
+        db.commit()
+    finally:
+        db.close()
+    return {ingredient: batch_quantity * BATCHES for ingredient in ("flour", "sugar", "butter")}
+
+
+def place_orders(args) -> dict:
+    """One worker process placing single-serving orders, and restocking now and then"""
+    use_writer, seed = args
+    vi.engine.dispose(close=False)  # Don't share the parent's pooled connections across the fork
+    if not use_writer:
+        vi.sqlite_writer = None
+    rng = random.Random(seed)
+    prepared = {dish_name: 0 for dish_name in RECIPES}
+    restocked = {}
+    for _ in range(ORDERS_PER_WORKER):
+        db = vi.SessionLocal()
+        try:
+            if rng.random() < RESTOCK_SHARE:
+                # salt has no stock or rollup row yet, so workers race to insert them. A restock at a new price
+                # changes the cost of every dish using the ingredient, and Cake uses three of them
+                ingredient = rng.choice(["flour", "sugar", "butter", "salt"])
+                quantity = float(rng.randint(50, 500))
+                vi.add_item(name=ingredient, quantity=quantity, unit="gm", price_per_unit=round(rng.uniform(0.01, 0.5), 2),
+                            total_cost=None, type="Test", date_added=RESTOCK_DAY, db=db)
+                restocked[ingredient] = restocked.get(ingredient, 0.0) + quantity
+            else:
+                dish_name = rng.choice(list(RECIPES))
+                vi.prepare_dish(dish_name=dish_name, quantity=1, date=None, db=db)
+                prepared[dish_name] += 1
+        except HTTPException:
+            pass  # Out of stock, or a conflict that used up its retries: nothing was deducted
+        finally:
+            db.close()
+    return {"prepared": prepared, "restocked": restocked}
+
+
+@pytest.mark.parametrize("use_writer", [False, True], ids=["versioned", "sqlite-writer"])
+def test_concurrent_deductions_are_never_lost(use_writer):
+    if use_writer and vi.sqlite_writer is None:
+        pytest.skip("the SQLite writer queue is off for this database")
+    initial = seed_stock()
+
+    with multiprocessing.get_context("fork").Pool(WORKERS) as pool:
+        results = pool.map(place_orders, [(use_writer, seed) for seed in range(WORKERS)])
+    prepared = {dish_name: sum(result["prepared"][dish_name] for result in results) for dish_name in RECIPES}
+    restocked = {ingredient: sum(result["restocked"].get(ingredient, 0.0) for result in results)
+                 for ingredient in ("flour", "sugar", "butter", "salt")}
+
+    db = vi.SessionLocal()
+    try:
+        remaining = dict(db.query(vi.Inventory.name_key, func.sum(vi.Inventory.quantity)).group_by(
+            vi.Inventory.name_key).all())
+        negative = db.query(vi.Inventory.id).filter(vi.Inventory.quantity < -1e-9).count()
+        stock_mismatches = vi.check_ingredient_stock(db)
+        rollup_mismatches = vi.check_expense_rollup(db)
+        cost_mismatches = vi.check_dish_costs(db)
+    finally:
+        db.close()
+
+    assert sum(prepared.values()) > 0
+    for ingredient, quantity in initial.items():
+        used = sum(prepared[dish_name] * recipe.get(ingredient, 0.0) for dish_name, recipe in RECIPES.items())
+        assert quantity + restocked[ingredient] - remaining[ingredient] == pytest.approx(used, abs=1e-6), ingredient
+    assert negative == 0
+    assert stock_mismatches == []
+    assert rollup_mismatches == []
+    assert cost_mismatches == []
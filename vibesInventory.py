@@ -1,20 +1,48 @@
-from fastapi import FastAPI, HTTPException, Depends, Query, UploadFile, File, HTTPException
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, func, desc, and_, text, \
-    inspect
+from fastapi import FastAPI, HTTPException, Depends, Query, UploadFile, File, HTTPException, Request
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Date, ForeignKey, func, desc, and_, \
+    text, inspect, UniqueConstraint, Text, Index, event, LargeBinary, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import sessionmaker, Session, relationship, validates
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import NullPool, QueuePool
 from datetime import datetime, timedelta, date
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.routing import APIRoute
 from typing import Optional, List
-from collections import defaultdict, Counter
-from fastapi.responses import JSONResponse
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from inspect import signature
+from itertools import islice
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.routing import Match
+from fastapi.encoders import jsonable_encoder
 from openpyxl import load_workbook
-from io import BytesIO
 from pydantic import BaseModel
 from dateutil import parser
+import numpy as np
 import openai
+import asyncio
+import hashlib
+import random
 import os
+import json
+import queue
+import math
+import re
+import shutil
+import tempfile
+import time
+import threading
 import logging
+import zlib
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -29,29 +57,530 @@ logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./inventory.db")
 
+# --- Engine Configuration ---
+# Every gunicorn worker has its own pool, so the database sees up to WEB_CONCURRENCY x (DB_POOL_SIZE +
+# DB_MAX_OVERFLOW) connections. Setting DB_MAX_CONNECTIONS to what the server allows this app splits that
+# budget across the workers instead. Unset, the pool settings are SQLAlchemy's defaults.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+DB_POOL_RECYCLE_SECONDS = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "-1"))  # -1: connections are never recycled
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))  # PostgreSQL only, 0: no timeout
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "0"))  # 0: no budget, each worker gets the full pool
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# "queue" keeps connections open between requests, "null" opens one per checkout. SQLite defaults to
+# "null": a queue pool must then be larger than the request threads, or the SQLite writer can be left
+# waiting for a connection held by a request that is waiting on it.
+DB_POOL_CLASS = os.getenv("DB_POOL_CLASS", "")
+
+
+class PoolMetrics:
+    """Checkout, wait and hold counters for the engine's pool in this process"""
+
+    WAIT_BUCKETS_MS = (1, 5, 25, 100, 500, 1000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.overflow_events = 0
+            self.connects = 0
+            self.invalidations = 0
+            self.checked_out = 0
+            self.peak_checked_out = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            self.wait_buckets = [0] * (len(self.WAIT_BUCKETS_MS) + 1)
+            self.hold_seconds = 0.0
+            self.max_hold_seconds = 0.0
+            self.checkins = 0
+            self.since = datetime.utcnow()
+
+    def record_wait(self, waited: float):
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        bucket = 0
+        while bucket < len(self.WAIT_BUCKETS_MS) and waited * 1000 >= self.WAIT_BUCKETS_MS[bucket]:
+            bucket += 1
+        self.wait_buckets[bucket] += 1
+
+    def record_checkout(self, waited: float):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+            self.record_wait(waited)
+
+    def record_timeout(self, waited: float):
+        with self.lock:
+            self.timeouts += 1
+            self.record_wait(waited)
+
+    def record_checkin(self, held: float):
+        with self.lock:
+            self.checkins += 1
+            self.checked_out -= 1
+            self.hold_seconds += held
+            self.max_hold_seconds = max(self.max_hold_seconds, held)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            bucket_names = [f"under_{limit}ms" for limit in self.WAIT_BUCKETS_MS] + \
+                [f"{self.WAIT_BUCKETS_MS[-1]}ms_or_more"]
+            return {
+                "since": self.since.isoformat(),
+                "checkouts": self.checkouts,
+                "checked_out": self.checked_out,
+                "peak_checked_out": self.peak_checked_out,
+                "overflow_events": self.overflow_events,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "wait_ms": {
+                    "mean": round(self.wait_seconds * 1000 / max(self.checkouts + self.timeouts, 1), 3),
+                    "max": round(self.max_wait_seconds * 1000, 3),
+                    "histogram": dict(zip(bucket_names, self.wait_buckets)),
+                },
+                "hold_ms": {
+                    "mean": round(self.hold_seconds * 1000 / max(self.checkins, 1), 3),
+                    "max": round(self.max_hold_seconds * 1000, 3),
+                },
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MeteredPoolMixin:
+    """Times every checkout, including the wait for a free connection and any pre-ping, into pool_metrics"""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            pool_metrics.record_timeout(time.perf_counter() - started)
+            raise
+        connection.info["pool_checked_out_at"] = time.perf_counter()
+        pool_metrics.record_checkout(connection.info["pool_checked_out_at"] - started)
+        return connection
+
+    def _do_return_conn(self, record):
+        checked_out_at = record.info.pop("pool_checked_out_at", None)
+        if checked_out_at is not None:
+            pool_metrics.record_checkin(time.perf_counter() - checked_out_at)
+        super()._do_return_conn(record)
+
+
+class MeteredQueuePool(MeteredPoolMixin, QueuePool):
+    def _inc_overflow(self):
+        opened = super()._inc_overflow()
+        # The overflow count starts at -pool_size, so it is above zero once a connection beyond pool_size opens
+        if opened and self._overflow > 0:
+            with pool_metrics.lock:
+                pool_metrics.overflow_events += 1
+        return opened
+
+
+class MeteredNullPool(MeteredPoolMixin, NullPool):
+    pass
+
+
+def count_new_connection(dbapi_connection, connection_record):
+    with pool_metrics.lock:
+        pool_metrics.connects += 1
+
+
+def count_invalidated_connection(dbapi_connection, connection_record, exception):
+    with pool_metrics.lock:
+        pool_metrics.invalidations += 1
+
+
+for metered_pool in (MeteredQueuePool, MeteredNullPool):
+    event.listen(metered_pool, "connect", count_new_connection)
+    event.listen(metered_pool, "invalidate", count_invalidated_connection)
+
+
+def pool_limits() -> tuple:
+    """(pool_size, max_overflow) for this worker, within its share of DB_MAX_CONNECTIONS when that is set"""
+    pool_size, max_overflow = DB_POOL_SIZE, DB_MAX_OVERFLOW
+    if DB_MAX_CONNECTIONS > 0:
+        share = max(DB_MAX_CONNECTIONS // max(WEB_CONCURRENCY, 1), 1)
+        pool_size = min(pool_size, share)
+        max_overflow = max(min(max_overflow, share - pool_size), 0)
+    return pool_size, max_overflow
+
+
+def engine_options(database_url: str) -> dict:
+    """create_engine() keyword arguments for database_url from the DB_* settings"""
+    is_sqlite = database_url.startswith("sqlite")
+    options = {"connect_args": {"check_same_thread": False}} if is_sqlite else {"connect_args": {}}
+    if is_sqlite and (":memory:" in database_url or database_url.rstrip("/") == "sqlite:"):
+        return options  # An in-memory database lives and dies with its one connection, leave its pool alone
+
+    if (DB_POOL_CLASS or ("null" if is_sqlite else "queue")) == "null":
+        options["poolclass"] = MeteredNullPool
+    else:
+        pool_size, max_overflow = pool_limits()
+        options.update(poolclass=MeteredQueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                       pool_timeout=DB_POOL_TIMEOUT_SECONDS)
+    options["pool_pre_ping"] = DB_POOL_PRE_PING
+    options["pool_recycle"] = DB_POOL_RECYCLE_SECONDS
+    if not is_sqlite and DB_STATEMENT_TIMEOUT_MS > 0:
+        options["connect_args"]["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    return options
+
+
 if DATABASE_URL.startswith("postgresql://") or DATABASE_URL.startswith("postgres://"):
     # Fix postgres:// URL (Heroku/Render often use this)
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
     print("Using PostgreSQL database")
 else:
     # SQLite for local development
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
     print("Using SQLite database")
 
+# How long a SQLite connection waits for another writer's lock before giving up with "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "30000"))
+
+
+@event.listens_for(engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """WAL lets readers run alongside the writer, and NORMAL only syncs at checkpoints, which WAL keeps safe"""
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# --- Async Engine ---
+# With ASYNC_DATABASE=true the hot read endpoints (GET /inventory, /inventory/changes and /dishes) run on
+# the event loop over an async driver (aiosqlite or asyncpg, both in requirements.txt) instead of holding
+# one of Starlette's threadpool threads each. Writes stay on the sync engine. The async engine has a pool of its own, sized by the same DB_* settings.
+ASYNC_DATABASE = os.getenv("ASYNC_DATABASE", "false").lower() in ("1", "true", "yes")
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def async_engine_options(database_url: str) -> dict:
+    """create_async_engine() keyword arguments for database_url from the DB_* settings"""
+    if database_url.startswith("sqlite"):
+        return {}  # aiosqlite opens a connection per checkout for a database file, like the sync engine
+    pool_size, max_overflow = pool_limits()
+    options = {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": DB_POOL_TIMEOUT_SECONDS,
+        "pool_recycle": DB_POOL_RECYCLE_SECONDS,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+    return options
+
+
+def create_async_read_engine():
+    """The async engine when ASYNC_DATABASE is on and its driver is installed, else None"""
+    if not ASYNC_DATABASE:
+        return None
+    scheme, location = DATABASE_URL.split("://", 1)
+    try:
+        async_engine = create_async_engine(f"{ASYNC_DRIVERS[scheme.split('+')[0]]}://{location}",
+                                           **async_engine_options(DATABASE_URL))
+    except (ImportError, KeyError) as e:
+        logger.error(f"ASYNC_DATABASE is set but no async engine could be created ({e!r}), reads stay sync")
+        return None
+    event.listen(async_engine.sync_engine, "connect", configure_sqlite_connection)
+    print(f"Async read path on {async_engine.dialect.name}+{async_engine.dialect.driver}")
+    return async_engine
+
+
+async_engine = create_async_read_engine()
+AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False) \
+    if async_engine is not None else None
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 Base = declarative_base()
 
 app = FastAPI()
 
+
+# --- Idempotency Keys ---
+# A stock-mutating request may carry an Idempotency-Key header. The first request with a key claims it,
+# runs, and stores its response; a retry with the same key and the same request gets that response back
+# from one SELECT, without running the endpoint. A different request under a used key is rejected.
+# Keys are evicted IDEMPOTENCY_TTL_HOURS after they were claimed.
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+IDEMPOTENCY_PENDING_SECONDS = float(os.getenv("IDEMPOTENCY_PENDING_SECONDS", "300"))  # Then a claim is abandoned
+IDEMPOTENCY_SWEEP_SECONDS = float(os.getenv("IDEMPOTENCY_SWEEP_SECONDS", "600"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String)  # sha256 of the method, path, query and body, stored with the response
+    status_code = Column(Integer)  # NULL while the request that claimed the key is still running
+    response_headers = Column(Text)  # JSON [name, value] pairs, all but content-length
+    response_body = Column(LargeBinary)  # zlib-compressed
+    claimed_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+idempotent_endpoints = set()
+idempotency_sweep = {"last": 0.0}
+
+
+def idempotent(endpoint):
+    """Mark a route's endpoint as honouring the Idempotency-Key header"""
+    idempotent_endpoints.add(endpoint)
+    return endpoint
+
+
+def is_idempotent_route(scope) -> bool:
+    for route in app.router.routes:
+        if getattr(route, "endpoint", None) in idempotent_endpoints and route.matches(scope)[0] == Match.FULL:
+            return True
+    return False
+
+
+def sweep_idempotency_keys(db: Session, now: datetime):
+    """Delete expired keys, at most once every IDEMPOTENCY_SWEEP_SECONDS per process"""
+    if time.monotonic() - idempotency_sweep["last"] < IDEMPOTENCY_SWEEP_SECONDS:
+        return
+    idempotency_sweep["last"] = time.monotonic()
+    db.query(IdempotencyKey).filter(IdempotencyKey.expires_at < now).delete(synchronize_session=False)
+
+
+def claim_idempotency_key(key: str):
+    """Return ("stored", row), ("in_progress", None) or ("claimed", claimed_at) for a key"""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        row = db.query(IdempotencyKey).filter(IdempotencyKey.key == key).first()
+        if row is not None and row.expires_at > now:
+            if row.status_code is not None:
+                return "stored", row
+            if (now - row.claimed_at).total_seconds() < IDEMPOTENCY_PENDING_SECONDS:
+                return "in_progress", None
+
+        sweep_idempotency_keys(db, now)
+        claim = {"claimed_at": now, "expires_at": now + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+                 "fingerprint": None, "status_code": None, "response_headers": None, "response_body": None}
+        if row is None:
+            db.add(IdempotencyKey(key=key, **claim))
+        else:
+            # Take over an expired or abandoned key, unless another request just did
+            taken = db.query(IdempotencyKey).filter(
+                IdempotencyKey.key == key, IdempotencyKey.claimed_at == row.claimed_at
+            ).update(claim, synchronize_session=False)
+            if not taken:
+                db.rollback()
+                return "in_progress", None
+        db.commit()
+        return "claimed", now
+
+    except IntegrityError:
+        db.rollback()  # Another request inserted the key first
+        return "in_progress", None
+
+    finally:
+        db.close()
+
+
+def store_idempotent_response(key: str, claimed_at: datetime, fingerprint: str, status_code: int,
+                              headers: list, body: bytes):
+    db = SessionLocal()
+    try:
+        db.query(IdempotencyKey).filter(
+            IdempotencyKey.key == key, IdempotencyKey.claimed_at == claimed_at
+        ).update({
+            "fingerprint": fingerprint,
+            "status_code": status_code,
+            "response_headers": json.dumps(headers),
+            "response_body": zlib.compress(body)
+        }, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def release_idempotency_key(key: str, claimed_at: datetime):
+    """Forget a claim whose request failed, so the client can retry it for real"""
+    db = SessionLocal()
+    try:
+        db.query(IdempotencyKey).filter(
+            IdempotencyKey.key == key, IdempotencyKey.claimed_at == claimed_at
+        ).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def request_fingerprint(scope):
+    """sha256 seeded with the method, path and query string; the body is fed in as it is received"""
+    fingerprint = hashlib.sha256()
+    for part in (scope["method"].encode(), scope["path"].encode(), scope.get("query_string", b"")):
+        fingerprint.update(part + b"\0")
+    return fingerprint
+
+
+def multipart_boundary(scope) -> Optional[bytes]:
+    content_type = dict(scope["headers"]).get(b"content-type", b"")
+    if not content_type.startswith(b"multipart/"):
+        return None
+    for parameter in content_type.split(b";")[1:]:
+        name, _, value = parameter.strip().partition(b"=")
+        if name.lower() == b"boundary" and value:
+            return b"--" + value.strip(b'"')
+    return None
+
+
+class BodyFingerprint:
+    """Feeds a request body into the fingerprint as it is received.
+
+    Multipart bodies carry a random boundary that changes on every retry, so it is cut out of the
+    hashed bytes: a retried upload matches when its fields and files do.
+    """
+
+    def __init__(self, fingerprint, boundary: Optional[bytes]):
+        self.fingerprint = fingerprint
+        self.boundary = boundary
+        self.pending = b""  # Held back in case a boundary straddles two chunks
+
+    def update(self, chunk: bytes, more_body: bool):
+        if self.boundary is None:
+            self.fingerprint.update(chunk)
+            return
+        data = (self.pending + chunk).replace(self.boundary, b"")
+        split = max(len(data) - len(self.boundary) + 1, 0) if more_body else len(data)
+        self.fingerprint.update(data[:split])
+        self.pending = data[split:]
+
+
+# Client errors that say "not now" rather than "not this request", so a retry runs for real
+TRANSIENT_CLIENT_ERRORS = {408, 409, 425, 429}
+
+
+def replayable(status_code: int) -> bool:
+    # Server errors and transient client errors are worth retrying, everything else is the request's outcome
+    return status_code < 500 and status_code not in TRANSIENT_CLIENT_ERRORS
+
+
+class IdempotencyMiddleware:
+    """Plain ASGI middleware, so request bodies and uploads stream through untouched"""
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT", "PATCH", "DELETE"):
+            return await self.app(scope, receive, send)
+
+        key = dict(scope["headers"]).get(b"idempotency-key")
+        if key is None or not is_idempotent_route(scope):
+            return await self.app(scope, receive, send)
+
+        key = key.decode("latin-1").strip()
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            response = JSONResponse(status_code=400, content={
+                "detail": f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters"
+            })
+            return await response(scope, receive, send)
+
+        state, claim = await run_in_threadpool(claim_idempotency_key, key)
+        fingerprint = request_fingerprint(scope)
+        body_fingerprint = BodyFingerprint(fingerprint, multipart_boundary(scope))
+
+        if state == "stored":
+            # Read the retried body only to make sure it is the same request
+            while True:
+                message = await receive()
+                body_fingerprint.update(message.get("body", b""), message.get("more_body", False))
+                if not message.get("more_body"):
+                    break
+            if fingerprint.hexdigest() != claim.fingerprint:
+                response = JSONResponse(status_code=422, content={
+                    "detail": "This Idempotency-Key was already used for a different request"
+                })
+            else:
+                response = Response(
+                    content=zlib.decompress(claim.response_body),
+                    status_code=claim.status_code,
+                    headers=Headers(raw=[
+                        (name.encode("latin-1"), value.encode("latin-1"))
+                        for name, value in json.loads(claim.response_headers)
+                    ] + [(b"idempotent-replayed", b"true")])
+                )
+            return await response(scope, receive, send)
+
+        if state == "in_progress":
+            response = JSONResponse(status_code=409, content={
+                "detail": "A request with this Idempotency-Key is still being processed"
+            })
+            return await response(scope, receive, send)
+
+        claimed_at = claim
+        captured = {"status": 500, "headers": [], "body": []}
+
+        async def hashing_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                body_fingerprint.update(message.get("body", b""), message.get("more_body", False))
+            return message
+
+        async def capturing_send(message):
+            if message["type"] == "http.response.start":
+                captured["status"] = message["status"]
+                # The replay computes its own content-length
+                captured["headers"] = [
+                    (name.decode("latin-1"), value.decode("latin-1"))
+                    for name, value in message.get("headers", []) if name.lower() != b"content-length"
+                ]
+            elif message["type"] == "http.response.body":
+                captured["body"].append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, hashing_receive, capturing_send)
+        except Exception:
+            await run_in_threadpool(release_idempotency_key, key, claimed_at)
+            raise
+
+        if replayable(captured["status"]):
+            await run_in_threadpool(
+                store_idempotent_response, key, claimed_at, fingerprint.hexdigest(),
+                captured["status"], captured["headers"], b"".join(captured["body"])
+            )
+        else:
+            await run_in_threadpool(release_idempotency_key, key, claimed_at)
+
+
+# Added before CORS so it runs inside it, and replayed responses get the CORS headers too
+app.add_middleware(IdempotencyMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-After-Id", "Idempotent-Replayed"],
 )
 
 
@@ -90,6 +619,18 @@ class RenderSafeMigration:
                 logger.warning("Unit column not found in dish_ingredients table.")
                 logger.info("You can add it manually using the migration endpoint.")
                 return True  # Don't fail startup
+            elif self.name_key_status()["pending"]:
+                logger.warning("name_key columns are missing or not backfilled.")
+                logger.info("Run /admin/migrate-add-name-key?confirm=true before preparing dishes.")
+                return True  # Don't fail startup
+            elif not self.has_inventory_version():
+                logger.warning("version column not found in inventory table.")
+                logger.info("Run /admin/migrate-add-inventory-version?confirm=true before using the inventory.")
+                return True  # Don't fail startup
+            elif self.missing_indexes():
+                logger.warning(f"Missing indexes: {', '.join(index.name for index in self.missing_indexes())}")
+                logger.info("You can create them using /admin/migrate-add-indexes?confirm=true.")
+                return True  # Don't fail startup
             else:
                 logger.info("Database schema is up to date.")
                 return True
@@ -140,6 +681,10 @@ class RenderSafeMigration:
 
     def add_costing_column(self):
         """Add cost_per_unit column with intelligent default calculation"""
+        # Ingredient prices are matched on name_key
+        if not self.add_name_key_columns():
+            return False
+
         try:
             with self.engine.connect() as connection:
                 trans = connection.begin()
@@ -178,10 +723,10 @@ class RenderSafeMigration:
                         inventory_result = connection.execute(text("""
                             SELECT price_per_unit, unit as inv_unit
                             FROM inventory 
-                            WHERE LOWER(name) LIKE LOWER(:ingredient_name)
+                            WHERE name_key = :name_key
                             ORDER BY date_added DESC 
                             LIMIT 1
-                        """), {"ingredient_name": f"%{ingredient_name}%"}).fetchone()
+                        """), {"name_key": normalize_name_key(ingredient_name)}).fetchone()
 
                         if inventory_result:
                             price_per_unit, inv_unit = inventory_result
@@ -225,23 +770,292 @@ class RenderSafeMigration:
             logger.error(f"Database connection failed: {e}")
             return False
 
+    def _calculate_cost_with_unit_conversion(self, price_per_unit, inventory_unit, recipe_unit):
+        """Price of one recipe unit, given the price of one inventory unit"""
+        return (price_per_unit or 0.0) * convert_to_base_unit(1, recipe_unit, inventory_unit or recipe_unit)
+
+    NAME_KEY_SOURCES = (("inventory", "name"), ("dish_ingredients", "ingredient_name"))
+
+    def name_key_status(self):
+        """Which tables still lack the name_key column, and how many rows are waiting for a key"""
+        inspector = inspect(self.engine)
+        missing_columns = []
+        rows_without_key = 0
+        with self.engine.connect() as connection:
+            for table, name_column in self.NAME_KEY_SOURCES:
+                if 'name_key' not in [col['name'] for col in inspector.get_columns(table)]:
+                    missing_columns.append(table)
+                    continue
+                rows_without_key += connection.execute(text(
+                    f"SELECT COUNT(*) FROM {table} WHERE name_key IS NULL AND {name_column} IS NOT NULL"
+                )).scalar()
+
+        return {
+            "pending": bool(missing_columns or rows_without_key),
+            "tables_missing_column": missing_columns,
+            "rows_without_key": rows_without_key
+        }
+
+    def add_name_key_columns(self):
+        """Add the indexed name_key columns where missing and backfill rows without a key"""
+        try:
+            with self.engine.connect() as connection:
+                trans = connection.begin()
+
+                try:
+                    inspector = inspect(connection)
+                    for table, name_column in self.NAME_KEY_SOURCES:
+                        columns = [col['name'] for col in inspector.get_columns(table)]
+                        if 'name_key' not in columns:
+                            logger.info(f"Adding name_key column to {table}...")
+                            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN name_key VARCHAR"))
+                        connection.execute(text(
+                            f"CREATE INDEX IF NOT EXISTS ix_{table}_name_key ON {table} (name_key)"
+                        ))
+
+                        # Keys are computed in Python so they match what the app writes
+                        rows = connection.execute(text(
+                            f"SELECT id, {name_column} FROM {table} WHERE name_key IS NULL AND {name_column} IS NOT NULL"
+                        )).fetchall()
+                        for chunk in chunked(rows, 1000):
+                            connection.execute(
+                                text(f"UPDATE {table} SET name_key = :name_key WHERE id = :id"),
+                                [{"id": row_id, "name_key": normalize_name_key(name)} for row_id, name in chunk]
+                            )
+                        logger.info(f"Backfilled name_key for {len(rows)} {table} rows.")
+
+                    trans.commit()
+
+                except Exception as e:
+                    logger.error(f"name_key migration failed: {e}")
+                    trans.rollback()
+                    return False
+
+            # ingredient_stock and dish_cost are keyed or priced on name_key, so redo them with the backfilled keys
+            return self.populate_ingredient_stock(rebuild=True) and self.populate_dish_costs(rebuild=True)
+
+        except Exception as e:
+            logger.error(f"Database connection failed: {e}")
+            return False
+
+    def has_inventory_version(self):
+        return 'version' in [col['name'] for col in inspect(self.engine).get_columns('inventory')]
+
+    def add_inventory_version_column(self):
+        """Add the batch version column the optimistic stock deductions compare against"""
+        try:
+            with self.engine.connect() as connection:
+                trans = connection.begin()
+
+                try:
+                    logger.info("Adding version column to inventory...")
+                    connection.execute(text(
+                        "ALTER TABLE inventory ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+                    ))
+
+                    trans.commit()
+                    logger.info("Inventory version column added.")
+                    return True
+
+                except Exception as e:
+                    logger.error(f"Inventory version migration failed: {e}")
+                    trans.rollback()
+                    return False
+
+        except Exception as e:
+            logger.error(f"Database connection failed: {e}")
+            return False
+
+    def missing_indexes(self):
+        """Indexes declared on the models that an existing table doesn't have yet.
+
+        create_all() only builds indexes together with new tables, so indexes added to an existing
+        table later have to be created here. Indexes on columns that a column migration still has
+        to add are left to that migration.
+        """
+        inspector = inspect(self.engine)
+        existing_tables = set(inspector.get_table_names())
+        missing = []
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            existing_columns = {col['name'] for col in inspector.get_columns(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes and \
+                        all(column.name in existing_columns for column in index.columns):
+                    missing.append(index)
+        return missing
+
+    def add_missing_indexes(self):
+        """Create every model index missing from an existing table"""
+        try:
+            with self.engine.connect() as connection:
+                trans = connection.begin()
+
+                try:
+                    for index in self.missing_indexes():
+                        logger.info(f"Creating index {index.name} on {index.table.name}...")
+                        index.create(bind=connection)
+
+                    trans.commit()
+                    return True
+
+                except Exception as e:
+                    logger.error(f"Index migration failed: {e}")
+                    trans.rollback()
+                    return False
+
+        except Exception as e:
+            logger.error(f"Database connection failed: {e}")
+            return False
+
+    def run_all_migrations(self):
+        """Run every pending migration in order, returns (success, names of the migrations run)"""
+        migrations_run = []
+        columns = [col['name'] for col in inspect(self.engine).get_columns('dish_ingredients')]
+
+        pending = []
+        if 'unit' not in columns:
+            pending.append(("add_unit_column", self.add_unit_column))
+        if self.name_key_status()["pending"]:
+            pending.append(("add_name_key_columns", self.add_name_key_columns))
+        if not self.has_inventory_version():
+            pending.append(("add_inventory_version_column", self.add_inventory_version_column))
+        if 'cost_per_unit' not in columns:
+            pending.append(("add_costing_column", self.add_costing_column))
+        if self.missing_indexes():
+            pending.append(("add_missing_indexes", self.add_missing_indexes))
+
+        for name, migration in pending:
+            if not migration():
+                logger.error(f"Migration {name} failed, stopping.")
+                return False, migrations_run
+            migrations_run.append(name)
+
+        return True, migrations_run
+
+    def populate_ingredient_stock(self, rebuild: bool = False):
+        """Fill ingredient_stock from the inventory table when it is still empty, or always with rebuild"""
+        db = SessionLocal()
+        try:
+            if rebuild or (db.query(IngredientStock.id).first() is None and db.query(Inventory.id).first() is not None):
+                logger.info("Populating ingredient_stock from inventory...")
+                row_count = rebuild_ingredient_stock(db)
+                db.commit()
+                logger.info(f"Ingredient stock populated with {row_count} rows.")
+            return True
+
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ingredient stock population failed: {e}")
+            return False
+
+        finally:
+            db.close()
+
+    def populate_dish_costs(self, rebuild: bool = False):
+        """Fill dish_cost from recipes and inventory when it is still empty, or always with rebuild"""
+        db = SessionLocal()
+        try:
+            if rebuild or (db.query(DishCost.dish_id).first() is None and db.query(Dish.id).first() is not None):
+                logger.info("Populating dish_cost from recipes and inventory...")
+                row_count = rebuild_dish_costs(db)
+                db.commit()
+                logger.info(f"Dish costs populated with {row_count} rows.")
+            return True
+
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Dish cost population failed: {e}")
+            return False
+
+        finally:
+            db.close()
+
+    def populate_expense_rollup(self):
+        """Fill expense_daily_rollup from the inventory table when it is still empty"""
+        db = SessionLocal()
+        try:
+            if db.query(ExpenseDailyRollup.id).first() is None and db.query(Inventory.id).first() is not None:
+                logger.info("Populating expense_daily_rollup from inventory...")
+                row_count = rebuild_expense_rollup(db)
+                db.commit()
+                logger.info(f"Expense rollup populated with {row_count} rows.")
+            return True
+
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Expense rollup population failed: {e}")
+            return False
+
+        finally:
+            db.close()
+
 
 # Initialize migration handler
 migration_handler = RenderSafeMigration()
 
 
+# --- Ingredient Name Keys ---
+# Ingredient names are matched on a persisted, indexed name_key instead of ilike scans, so
+# "Tomatoes ", "tomato" and "TOMATO" all land on the same batches.
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def singularize_word(word: str) -> str:
+    """Cheap English singular for ingredient words, leaves short words and -ss/-us/-is endings alone"""
+    if len(word) <= 3:
+        return word
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("oes"):
+        return word[:-2]
+    if word.endswith(("ches", "shes", "sses", "xes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def normalize_name_key(name: Optional[str]) -> Optional[str]:
+    """Case-folded, whitespace-collapsed, singularized lookup key for an ingredient name"""
+    if name is None:
+        return None
+    words = WHITESPACE_RE.sub(" ", name).strip().casefold().split(" ")
+    return " ".join(singularize_word(word) for word in words if word)
+
+
+def name_key_default(name_column: str):
+    """Column default filling name_key from name_column, covers bulk inserts that skip the ORM"""
+    def default(context):
+        return normalize_name_key(context.get_current_parameters().get(name_column))
+    return default
+
+
 # --- Models ---
 
 class Inventory(Base):
     __tablename__ = "inventory"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
+    name_key = Column(String, index=True, default=name_key_default("name"))
     quantity = Column(Float)
     unit = Column(String)
     price_per_unit = Column(Float)
     total_cost = Column(Float)
     type = Column(String)
     date_added = Column(DateTime, default=datetime.utcnow)
+    # Bumped by every ORM update or delete, which only succeeds while the version is still the one
+    # that was read, so a batch changed by another worker in between raises StaleDataError
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+    @validates("name")
+    def _set_name_key(self, key, value):
+        self.name_key = normalize_name_key(value)
+        return value
 
 
 class Expense(Base):
@@ -274,8 +1088,14 @@ class DishIngredient(Base):
     dish_id = Column(Integer, ForeignKey("dishes.id"))
     quantity_required = Column(Float)
     unit = Column(String, default="gm")  # NEW COLUMN with default
+    name_key = Column(String, index=True, default=name_key_default("ingredient_name"))
     dish = relationship("Dish")
 
+    @validates("ingredient_name")
+    def _set_name_key(self, key, value):
+        self.name_key = normalize_name_key(value)
+        return value
+
 
 class InventoryLog(Base):
     __tablename__ = "inventory_log"
@@ -286,6 +1106,82 @@ class InventoryLog(Base):
     ingredient = relationship("Inventory")
 
 
+class InventorySnapshot(Base):
+    __tablename__ = "inventory_snapshot"
+    __table_args__ = (UniqueConstraint("snapshot_date", "ingredient_id", name="uq_inventory_snapshot_key"),)
+    id = Column(Integer, primary_key=True, index=True)
+    snapshot_date = Column(DateTime, nullable=False)
+    ingredient_id = Column(Integer)  # No FK: like the log it summarises, it outlives deleted batches
+    quantity_left = Column(Float)
+    log_date = Column(DateTime)  # Date of the log the quantity was taken from
+
+
+# Matches the ROW_NUMBER() window in /inventory_on_date (partition by ingredient, newest first)
+# and covers quantity_left, so the window is read straight off the index without a sort
+Index(
+    "ix_inventory_log_ingredient_date",
+    InventoryLog.ingredient_id, InventoryLog.date.desc(), InventoryLog.id.desc(), InventoryLog.quantity_left
+)
+
+
+class ExpenseDailyRollup(Base):
+    __tablename__ = "expense_daily_rollup"
+    __table_args__ = (UniqueConstraint("day", "item_name", "type", name="uq_expense_daily_rollup_key"),)
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, index=True)
+    item_name = Column(String, index=True)
+    type = Column(String, default="")
+    total_cost = Column(Float, default=0.0)
+    item_count = Column(Integer, default=0)
+    max_cost = Column(Float)
+    min_cost = Column(Float)
+
+
+class IngredientStock(Base):
+    __tablename__ = "ingredient_stock"
+    __table_args__ = (UniqueConstraint("name_key", "base_unit", name="uq_ingredient_stock_key"),)
+    id = Column(Integer, primary_key=True, index=True)
+    name_key = Column(String, nullable=False, index=True)
+    base_unit = Column(String, nullable=False)  # One row per dimension the ingredient is stocked in
+    quantity = Column(Float, default=0.0)  # On-hand quantity of every batch, in base_unit
+    value = Column(Float, default=0.0)  # Sum of quantity * price_per_unit over the same batches
+    batch_count = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class DishCost(Base):
+    __tablename__ = "dish_cost"
+    dish_id = Column(Integer, ForeignKey("dishes.id"), primary_key=True)
+    total_cost = Column(Float, default=0.0)  # One serving at the latest batch price of every ingredient
+    missing_ingredients = Column(Integer, default=0)  # Ingredients with no batch to price them from
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class InventoryChange(Base):
+    __tablename__ = "inventory_changes"
+    id = Column(Integer, primary_key=True, index=True)  # The inventory version this change produced
+    inventory_id = Column(Integer, index=True)  # No FK: deletions are recorded too
+    action = Column(String, nullable=False)  # created, updated, deleted, cleared
+    changed_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)
+    filename = Column(String)
+    status = Column(String, default="queued", index=True)  # queued, running, succeeded, failed
+    rows_processed = Column(Integer, default=0)
+    chunks_processed = Column(Integer, default=0)
+    progress = Column(Text)  # JSON of the latest chunk report
+    result = Column(Text)  # JSON of the import response once finished
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+
 class IngredientInput(BaseModel):
     name: str
     quantity_required: float
@@ -332,36 +1228,561 @@ class PrepareDishRequest(BaseModel):
     date: Optional[str] = None  # format: YYYY-MM-DD
 
 
+class PrepareDishesRequest(BaseModel):
+    orders: List[PrepareDishRequest]
+
+
 class OpenAIPromptRequest(BaseModel):
     prompt: str
 
 
-# Database initialization
-def initialize_database():
-    """Initialize database with schema check only"""
+class TableVersion(Base):
+    __tablename__ = "table_versions"
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# --- Table Versions ---
+# Every committed session transaction bumps the version of each table it wrote to, in the same
+# transaction. Versions are cached per process: our own commits update the cache right away,
+# other workers' commits show up once it is re-read, at most TABLE_VERSION_TTL_SECONDS later.
+TABLE_VERSION_TTL_SECONDS = float(os.getenv("TABLE_VERSION_TTL_SECONDS", "2"))
+# Tables the /dishes catalog is built from, a commit to any of them is published on the change feed
+CATALOG_TABLES = ("dishes", "dish_types", "dish_ingredients")
+# Not a table: the row inventory_changes ids are taken from, see take_inventory_versions
+INVENTORY_VERSION_COUNTER = "inventory_version"
+
+table_version_cache = {
+    "versions": {},
+    "loaded_at": None
+}
+table_version_lock = threading.Lock()
+
+
+@event.listens_for(engine, "after_execute")
+def track_written_tables(connection, clauseelement, *args):
+    """Remember which tables the current transaction on this connection has written to"""
+    if getattr(clauseelement, "is_dml", False) and clauseelement.table.name != TableVersion.__tablename__:
+        connection.info.setdefault("written_tables", set()).add(clauseelement.table.name)
+
+
+@event.listens_for(engine, "commit")
+@event.listens_for(engine, "rollback")
+def forget_written_tables(connection):
+    # Writes outside a session (migrations, raw engine transactions) don't bump versions
+    connection.info.pop("written_tables", None)
+
+
+@event.listens_for(SessionLocal, "before_commit")
+def bump_table_versions(session):
+    session.flush()  # commit() only flushes after this hook, and the flush may write too
+    if not session.in_transaction():
+        return
+    connection = session.connection()
+    written = connection.info.pop("written_tables", None)
+    if not written:
+        return
+
+    versions = TableVersion.__table__
+    connection.execute(
+        versions.update().where(versions.c.table_name.in_(written)).values(version=versions.c.version + 1)
+    )
+    bumped = dict(connection.execute(
+        versions.select().with_only_columns(versions.c.table_name, versions.c.version)
+        .where(versions.c.table_name.in_(written))
+    ).fetchall())
+    missing = [{"table_name": name, "version": 1} for name in written if name not in bumped]
+    if missing:
+        connection.execute(versions.insert(), missing)
+        bumped.update((row["table_name"], 1) for row in missing)
+    session.info["bumped_table_versions"] = bumped
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def mark_committed(session):
+    # The first after_commit hook, so it runs even when a later one fails. SqliteWriter reads it to tell a
+    # failed COMMIT from a failure after it
+    session.info["committed"] = True
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def publish_table_versions(session):
+    bumped = session.info.pop("bumped_table_versions", None)
+    if not bumped:
+        return
+    with table_version_lock:
+        cached = table_version_cache["versions"]
+        for name, version in bumped.items():
+            cached[name] = max(cached.get(name, 0), version)
+    if bumped.keys() & set(CATALOG_TABLES):
+        change_feed.publish("catalog", {"catalog_version": dish_catalog_version()})
+
+
+@event.listens_for(SessionLocal, "after_soft_rollback")
+def forget_table_versions(session, previous_transaction):
+    session.info.pop("bumped_table_versions", None)
+
+
+def cached_table_versions(names) -> Optional[tuple]:
+    """Versions of the given tables from the cache, None once it is older than the TTL"""
+    with table_version_lock:
+        loaded_at = table_version_cache["loaded_at"]
+        if loaded_at is not None and time.monotonic() - loaded_at < TABLE_VERSION_TTL_SECONDS:
+            return tuple(table_version_cache["versions"].get(name, 0) for name in names)
+    return None
+
+
+def store_table_versions(stored: dict, names) -> tuple:
+    """Merge versions read from the database into the cache, returns the given tables' versions"""
+    with table_version_lock:
+        cached = table_version_cache["versions"]
+        for name, version in stored.items():
+            cached[name] = max(cached.get(name, 0), version)
+        table_version_cache["loaded_at"] = time.monotonic()
+        return tuple(cached.get(name, 0) for name in names)
+
+
+def table_versions(names) -> tuple:
+    """Versions of the given tables, read from the cache unless it is older than the TTL"""
+    versions = cached_table_versions(names)
+    if versions is not None:
+        return versions
+
+    db = SessionLocal()
     try:
-        # First, create basic tables if they don't exist
-        Base.metadata.create_all(bind=engine)
+        stored = dict(db.query(TableVersion.table_name, TableVersion.version).all())
+    finally:
+        db.close()
+    return store_table_versions(stored, names)
 
-        # Then run schema check (no auto-migration)
-        schema_ok = migration_handler.check_schema_on_startup()
 
-        if not schema_ok:
-            logger.error("Database schema check failed!")
+def seed_table_versions():
+    """Give every table a version row up front, so concurrent first writes only ever UPDATE"""
+    db = SessionLocal()
+    try:
+        existing = {name for name, in db.query(TableVersion.table_name).all()}
+        db.bulk_insert_mappings(TableVersion, [
+            {"table_name": table.name, "version": 0}
+            for table in Base.metadata.sorted_tables if table.name not in existing
+        ])
+        if INVENTORY_VERSION_COUNTER not in existing:
+            # Databases from before the counter carry on from their latest change id
+            db.add(TableVersion(table_name=INVENTORY_VERSION_COUNTER,
+                                version=db.query(func.max(InventoryChange.id)).scalar() or 0))
+        db.commit()
+    except IntegrityError:
+        db.rollback()  # Another worker seeded them first
+    finally:
+        db.close()
 
-        return schema_ok
 
-    except Exception as e:
-        logger.error(f"Database initialization failed: {e}")
-        return False
+def table_etag(*tables: str) -> str:
+    return versions_etag(table_versions(tables))
 
 
-# Call this at startup
-database_ready = initialize_database()
+def versions_etag(versions: tuple) -> str:
+    return '"' + "-".join(str(version) for version in versions) + '"'
 
 
-# --- Migration Endpoints ---
-@app.post("/admin/migrate-add-unit-column")
+def etag_headers(etag: str) -> dict:
+    # no-cache makes browsers revalidate with If-None-Match every time instead of guessing freshness
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    """True when If-None-Match already names `etag`, so the caller can answer 304"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
+# --- Expense Rollup ---
+
+def chunked(items, size: int):
+    """Yield successive lists of at most `size` items, consuming `items` lazily"""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def insert_missing_rows(db: Session, model, rows: list):
+    """INSERT the rows whose unique key is not taken yet. A key another transaction is still inserting
+    waits for that transaction instead of failing, so concurrent first writes of a summary row don't collide"""
+    if not rows:
+        return
+    insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    db.execute(insert(model.__table__).on_conflict_do_nothing(), rows)
+
+
+def parse_sql_date(value) -> date:
+    """func.date() comes back as a date on PostgreSQL and as an ISO string on SQLite"""
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def expense_rollup_key(item: Inventory):
+    """(day, item_name, type) rollup key of an inventory row"""
+    return item.date_added.date(), item.name, item.type or ""
+
+
+def aggregate_inventory_expenses(db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                 names=None) -> dict:
+    """GROUP BY the raw inventory table into {(day, item_name, type): (total, count, max, min)}"""
+    expense_day = func.date(Inventory.date_added)
+    item_type = func.coalesce(Inventory.type, "")
+    query = db.query(
+        expense_day,
+        Inventory.name,
+        item_type,
+        func.coalesce(func.sum(Inventory.total_cost), 0.0),
+        func.count(Inventory.id),
+        func.max(Inventory.total_cost),
+        func.min(Inventory.total_cost)
+    ).filter(Inventory.date_added.isnot(None), Inventory.name.isnot(None))
+
+    if start is not None:
+        query = query.filter(Inventory.date_added >= start)
+    if end is not None:
+        query = query.filter(Inventory.date_added < end)
+    if names is not None:
+        query = query.filter(Inventory.name.in_(names))
+
+    return {
+        (parse_sql_date(day), name, type_): (total, count, max_cost, min_cost)
+        for day, name, type_, total, count, max_cost, min_cost in query.group_by(
+            expense_day, Inventory.name, item_type
+        ).all()
+    }
+
+
+def refresh_expense_rollup(db: Session, keys):
+    """Recompute the rollup rows for the given (day, item_name, type) keys in the caller's transaction.
+
+    The rows are created if missing and locked before the totals are aggregated. max_cost and min_cost
+    can't be kept as deltas, so on PostgreSQL a concurrent writer of the same key has to wait for our
+    commit and aggregate again, rather than overwrite our totals with a snapshot that never saw them.
+    """
+    keys = {key for key in keys if key[0] is not None and key[1] is not None}
+    if not keys:
+        return
+
+    db.flush()  # Make pending inventory changes visible to the aggregate query
+
+    days = [key[0] for key in keys]
+    start = datetime.combine(min(days), datetime.min.time())
+    end = datetime.combine(max(days), datetime.min.time()) + timedelta(days=1)
+
+    for names in chunked(sorted({key[1] for key in keys}), 500):
+        chunk_keys = {key for key in keys if key[1] in names}
+        insert_missing_rows(db, ExpenseDailyRollup, [
+            {"day": day, "item_name": name, "type": type_, "total_cost": 0.0, "item_count": 0}
+            for day, name, type_ in sorted(chunk_keys)
+        ])
+        existing = {
+            (row.day, row.item_name, row.type): row
+            for row in db.query(ExpenseDailyRollup).filter(
+                ExpenseDailyRollup.day >= start.date(),
+                ExpenseDailyRollup.day <= max(days),
+                ExpenseDailyRollup.item_name.in_(names)
+            ).order_by(
+                ExpenseDailyRollup.day, ExpenseDailyRollup.item_name, ExpenseDailyRollup.type
+            ).with_for_update().all()
+        }
+        fresh = aggregate_inventory_expenses(db, start, end, names)
+
+        updates = []
+        deletes = []
+        for key in chunk_keys:
+            row_id = existing[key].id
+            values = fresh.get(key)
+            if values is None:
+                deletes.append(row_id)  # No inventory left for the key, or just the row we inserted above
+            else:
+                totals = dict(zip(("total_cost", "item_count", "max_cost", "min_cost"), values))
+                updates.append({"id": row_id, **totals})
+
+        if deletes:
+            db.query(ExpenseDailyRollup).filter(ExpenseDailyRollup.id.in_(deletes)).delete(synchronize_session=False)
+        db.bulk_update_mappings(ExpenseDailyRollup, updates)
+
+
+def check_expense_rollup(db: Session) -> List[dict]:
+    """Compare every rollup row against the raw inventory table and return the mismatches"""
+    expected = aggregate_inventory_expenses(db)
+    actual = {
+        (row.day, row.item_name, row.type): (row.total_cost, row.item_count, row.max_cost, row.min_cost)
+        for row in db.query(ExpenseDailyRollup).all()
+    }
+
+    mismatches = []
+    for key in set(expected) | set(actual):
+        raw = expected.get(key)
+        rolled = actual.get(key)
+        if raw is not None and rolled is not None and raw[1] == rolled[1] and \
+                all(abs((a or 0.0) - (b or 0.0)) < 0.01 for a, b in zip(raw, rolled)):
+            continue
+        mismatches.append({
+            "day": key[0].isoformat(),
+            "item_name": key[1],
+            "type": key[2],
+            "raw": {"total_cost": raw[0], "item_count": raw[1]} if raw else None,
+            "rollup": {"total_cost": rolled[0], "item_count": rolled[1]} if rolled else None
+        })
+
+    return mismatches
+
+
+def rebuild_expense_rollup(db: Session) -> int:
+    """Recompute the whole rollup from the raw inventory table, the caller commits"""
+    db.query(ExpenseDailyRollup).delete(synchronize_session=False)
+    rows = [
+        {
+            "day": day,
+            "item_name": name,
+            "type": type_,
+            "total_cost": total,
+            "item_count": count,
+            "max_cost": max_cost,
+            "min_cost": min_cost
+        }
+        for (day, name, type_), (total, count, max_cost, min_cost) in aggregate_inventory_expenses(db).items()
+    ]
+    db.bulk_insert_mappings(ExpenseDailyRollup, rows)
+    return len(rows)
+
+
+# --- Ingredient Stock ---
+# ingredient_stock keeps the on-hand total of every ingredient per unit dimension, in that dimension's
+# base unit, so availability checks read a row per ingredient instead of summing its batches.
+# Every write to inventory quantities refreshes the touched keys in the caller's transaction. The
+# refresh locks the stock rows before aggregating, so on PostgreSQL a concurrent writer of the same
+# ingredient waits for our commit and then aggregates with our batches in, rather than overwriting
+# our totals with a snapshot that never saw them.
+
+def aggregate_ingredient_stock(db: Session, name_keys=None) -> dict:
+    """GROUP BY the positive-quantity batches into {(name_key, base_unit): [quantity, value, batch_count]}"""
+    query = db.query(
+        Inventory.name_key,
+        Inventory.unit,
+        func.sum(Inventory.quantity),
+        func.coalesce(func.sum(Inventory.quantity * func.coalesce(Inventory.price_per_unit, 0.0)), 0.0),
+        func.count(Inventory.id)
+    ).filter(Inventory.name_key.isnot(None), Inventory.quantity > 0)
+
+    if name_keys is not None:
+        query = query.filter(Inventory.name_key.in_(name_keys))
+
+    stock = {}
+    for name_key, unit, quantity, value, count in query.group_by(Inventory.name_key, Inventory.unit).all():
+        base_unit, factor = stock_base_unit(unit)
+        totals = stock.setdefault((name_key, base_unit), [0.0, 0.0, 0])
+        totals[0] += quantity * factor
+        totals[1] += value
+        totals[2] += count
+    return stock
+
+
+def refresh_ingredient_stock(db: Session, name_keys):
+    """Recompute the stock rows of the given name keys in the caller's transaction"""
+    name_keys = {key for key in name_keys if key}
+    if not name_keys:
+        return
+
+    db.flush()  # Make pending inventory changes visible to the aggregate query
+
+    now = datetime.utcnow()
+    for keys in chunked(sorted(name_keys), 500):
+        # Every (name_key, base_unit) our batches are stocked in gets a row, then all of the keys' rows are
+        # locked in key order. Only then are the totals aggregated, from what has been committed since.
+        insert_missing_rows(db, IngredientStock, [
+            {"name_key": name_key, "base_unit": base_unit, "quantity": 0.0, "value": 0.0, "batch_count": 0,
+             "updated_at": now}
+            for name_key, base_unit in sorted(aggregate_ingredient_stock(db, keys))
+        ])
+        locked = {
+            (name_key, base_unit): row_id
+            for row_id, name_key, base_unit in db.query(
+                IngredientStock.id, IngredientStock.name_key, IngredientStock.base_unit
+            ).filter(IngredientStock.name_key.in_(keys)).order_by(
+                IngredientStock.name_key, IngredientStock.base_unit
+            ).with_for_update().all()
+        }
+        fresh = aggregate_ingredient_stock(db, keys)
+
+        # A key in `fresh` that isn't locked only holds another transaction's batches, which wrote its row
+        updates = [
+            {"id": row_id, "quantity": fresh[key][0], "value": fresh[key][1], "batch_count": fresh[key][2],
+             "updated_at": now}
+            for key, row_id in locked.items() if key in fresh
+        ]
+        deletes = [row_id for key, row_id in locked.items() if key not in fresh]
+
+        if deletes:
+            db.query(IngredientStock).filter(IngredientStock.id.in_(deletes)).delete(synchronize_session=False)
+        db.bulk_update_mappings(IngredientStock, updates)
+
+
+def check_ingredient_stock(db: Session) -> List[dict]:
+    """Compare every stock row against the raw inventory table and return the mismatches"""
+    expected = aggregate_ingredient_stock(db)
+    actual = {
+        (row.name_key, row.base_unit): (row.quantity, row.value, row.batch_count)
+        for row in db.query(IngredientStock).all()
+    }
+
+    mismatches = []
+    for key in set(expected) | set(actual):
+        raw = expected.get(key)
+        stocked = actual.get(key)
+        if raw is not None and stocked is not None and raw[2] == stocked[2] and \
+                all(abs((a or 0.0) - (b or 0.0)) < 0.01 for a, b in zip(raw[:2], stocked[:2])):
+            continue
+        mismatches.append({
+            "name_key": key[0],
+            "base_unit": key[1],
+            "raw": {"quantity": raw[0], "value": raw[1], "batch_count": raw[2]} if raw else None,
+            "stock": {"quantity": stocked[0], "value": stocked[1], "batch_count": stocked[2]} if stocked else None
+        })
+
+    return mismatches
+
+
+def rebuild_ingredient_stock(db: Session) -> int:
+    """Recompute the whole stock table from the raw inventory table, the caller commits"""
+    db.query(IngredientStock).delete(synchronize_session=False)
+    now = datetime.utcnow()
+    rows = [
+        {
+            "name_key": name_key,
+            "base_unit": base_unit,
+            "quantity": quantity,
+            "value": value,
+            "batch_count": count,
+            "updated_at": now
+        }
+        for (name_key, base_unit), (quantity, value, count) in aggregate_ingredient_stock(db).items()
+    ]
+    db.bulk_insert_mappings(IngredientStock, rows)
+    return len(rows)
+
+
+def load_ingredient_stock(db: Session, ingredient_names) -> dict:
+    """Stock rows of the given ingredients in one indexed query, as {name_key: [(base_unit, quantity, value)]}"""
+    keys = {normalize_name_key(name) for name in ingredient_names if name}
+    stock = defaultdict(list)
+    if keys:
+        for name_key, base_unit, quantity, value in db.query(
+                IngredientStock.name_key, IngredientStock.base_unit, IngredientStock.quantity, IngredientStock.value
+        ).filter(IngredientStock.name_key.in_(keys)).all():
+            stock[name_key].append((base_unit, quantity, value))
+    return stock
+
+
+def stock_availability(stock: dict, ingredient_name: str, unit: str):
+    """Return (available in `unit`, total value) of an ingredient from load_ingredient_stock() rows"""
+    total_available = 0.0
+    total_value = 0.0
+    for base_unit, quantity, value in stock.get(normalize_name_key(ingredient_name), []):
+        total_available += convert_to_base_unit(quantity, base_unit, unit, ingredient_name)
+        total_value += value
+    return total_available, total_value
+
+
+# --- Inventory Change Log ---
+# Every write to the inventory table appends to inventory_changes in the same transaction. The id of
+# the latest change is the inventory version, so clients can sync with /inventory/changes?since=.
+# Ids come from the INVENTORY_VERSION_COUNTER row in table_versions rather than the table's own
+# sequence: bumping it locks the row until the transaction ends, so ids are handed out in commit
+# order and a change that commits late never lands below a version a client has already read.
+INVENTORY_CHANGES_PAGE_SIZE = int(os.getenv("INVENTORY_CHANGES_PAGE_SIZE", "1000"))
+
+
+def current_inventory_version(db: Session) -> int:
+    return db.query(func.max(InventoryChange.id)).scalar() or 0
+
+
+def take_inventory_versions(db: Session, count: int) -> int:
+    """Reserve the next `count` inventory versions for the caller's transaction, returns the last one"""
+    versions = TableVersion.__table__
+    counter = versions.c.table_name == INVENTORY_VERSION_COUNTER
+    if db.execute(versions.update().where(counter).values(version=versions.c.version + count)).rowcount == 0:
+        db.execute(versions.insert().values(table_name=INVENTORY_VERSION_COUNTER,
+                                            version=current_inventory_version(db) + count))
+    return db.execute(versions.select().with_only_columns(versions.c.version).where(counter)).scalar()
+
+
+def record_inventory_changes(db: Session, inventory_ids, action: str) -> int:
+    """Append one change per inventory id in the caller's transaction, returns the new inventory version"""
+    inventory_ids = sorted(set(inventory_ids))
+    last_version = take_inventory_versions(db, len(inventory_ids))
+    first_version = last_version - len(inventory_ids) + 1
+    now = datetime.utcnow()
+    db.bulk_insert_mappings(InventoryChange, [
+        {"id": first_version + offset, "inventory_id": inventory_id, "action": action, "changed_at": now}
+        for offset, inventory_id in enumerate(inventory_ids)
+    ])
+    db.flush()
+    db.info["inventory_changed"] = True  # Wakes the change feed once committed
+    return last_version
+
+
+def serialize_inventory_item(item: Inventory) -> dict:
+    """One inventory row in the shape GET /inventory returns"""
+    return {
+        "id": item.id,
+        "name": item.name,
+        "price_per_unit": item.price_per_unit,
+        "unit": item.unit,
+        "quantity": item.quantity,
+        "total_cost": item.total_cost,
+        "type": item.type,
+        "date_added": item.date_added.strftime("%Y-%m-%d %H:%M:%S") if item.date_added else None
+    }
+
+
+# Database initialization
+def initialize_database():
+    """Initialize database with schema check only"""
+    try:
+        # First, create basic tables if they don't exist
+        Base.metadata.create_all(bind=engine)
+        seed_table_versions()
+
+        # Then run schema check (no auto-migration)
+        schema_ok = migration_handler.check_schema_on_startup()
+
+        # Derived tables added after the fact start out empty
+        migration_handler.populate_expense_rollup()
+
+        if not schema_ok:
+            logger.error("Database schema check failed!")
+
+        return schema_ok
+
+    except Exception as e:
+        logger.error(f"Database initialization failed: {e}")
+        return False
+
+
+# Call this at startup
+database_ready = initialize_database()
+
+
+@app.on_event("startup")
+def populate_ingredient_stock():
+    """ingredient_stock totals batches through the unit registry, so it is filled once the module has loaded"""
+    migration_handler.populate_ingredient_stock()
+    migration_handler.populate_dish_costs()
+
+
+# --- Migration Endpoints ---
+@app.post("/admin/migrate-add-unit-column")
 def manual_add_unit_column(
         confirm: bool = Query(False, description="Set to true to confirm migration"),
         db: Session = Depends(get_db)
@@ -393,6 +1814,102 @@ def manual_add_unit_column(
         }
 
 
+@app.post("/admin/migrate-add-inventory-version")
+def manual_add_inventory_version(
+        confirm: bool = Query(False, description="Set to true to confirm migration"),
+        db: Session = Depends(get_db)
+):
+    """Manual endpoint to add the inventory version column used for optimistic stock deductions"""
+    if not confirm:
+        return {
+            "message": "Migration not confirmed. Set confirm=true to proceed.",
+            "warning": "This will add a version column to the inventory table.",
+            "current_status": get_migration_status(db)
+        }
+
+    try:
+        success = migration_handler.add_inventory_version_column()
+        if success:
+            return {
+                "message": "Inventory version column added successfully!",
+                "status": get_migration_status(db)
+            }
+        else:
+            return {
+                "message": "Migration failed. Check logs for details.",
+                "status": "failed"
+            }
+    except Exception as e:
+        return {
+            "message": f"Migration error: {str(e)}",
+            "status": "error"
+        }
+
+
+@app.post("/admin/migrate-add-name-key")
+def manual_add_name_key(
+        confirm: bool = Query(False, description="Set to true to confirm migration"),
+        db: Session = Depends(get_db)
+):
+    """Manual endpoint to add and backfill the normalized ingredient name_key columns"""
+    if not confirm:
+        return {
+            "message": "Migration not confirmed. Set confirm=true to proceed.",
+            "warning": "This will add an indexed name_key column to inventory and dish_ingredients.",
+            "current_status": get_migration_status(db)
+        }
+
+    try:
+        success = migration_handler.add_name_key_columns()
+        if success:
+            return {
+                "message": "name_key columns added and backfilled successfully!",
+                "status": get_migration_status(db)
+            }
+        else:
+            return {
+                "message": "Migration failed. Check logs for details.",
+                "status": "failed"
+            }
+    except Exception as e:
+        return {
+            "message": f"Migration error: {str(e)}",
+            "status": "error"
+        }
+
+
+@app.post("/admin/migrate-add-indexes")
+def manual_add_indexes(
+        confirm: bool = Query(False, description="Set to true to confirm migration"),
+        db: Session = Depends(get_db)
+):
+    """Manual endpoint to create model indexes missing from existing tables"""
+    if not confirm:
+        return {
+            "message": "Migration not confirmed. Set confirm=true to proceed.",
+            "warning": "Building indexes on large tables can block writes while it runs.",
+            "current_status": get_migration_status(db)
+        }
+
+    try:
+        success = migration_handler.add_missing_indexes()
+        if success:
+            return {
+                "message": "Missing indexes created successfully!",
+                "status": get_migration_status(db)
+            }
+        else:
+            return {
+                "message": "Migration failed. Check logs for details.",
+                "status": "failed"
+            }
+    except Exception as e:
+        return {
+            "message": f"Migration error: {str(e)}",
+            "status": "error"
+        }
+
+
 @app.get("/system/migration-status")
 def get_migration_status(db: Session = Depends(get_db)):
     """Check migration status"""
@@ -402,16 +1919,25 @@ def get_migration_status(db: Session = Depends(get_db)):
         has_unit_column = 'unit' in columns
 
         # Count records with/without units
-        total_ingredients = db.query(DishIngredient).count()
-        ingredients_with_units = db.query(DishIngredient).filter(
+        total_ingredients = db.query(DishIngredient.id).count()
+        ingredients_with_units = db.query(DishIngredient.id).filter(
             DishIngredient.unit.isnot(None),
             DishIngredient.unit != ""
         ).count()
 
+        name_key_status = migration_handler.name_key_status()
+        has_inventory_version = migration_handler.has_inventory_version()
+        missing_indexes = [index.name for index in migration_handler.missing_indexes()]
+
         return {
-            "migration_complete": has_unit_column and (ingredients_with_units == total_ingredients),
+            "migration_complete": has_unit_column and (ingredients_with_units == total_ingredients)
+                                  and not name_key_status["pending"] and has_inventory_version
+                                  and not missing_indexes,
             "schema_updated": has_unit_column,
             "data_migrated": ingredients_with_units == total_ingredients,
+            "name_key": name_key_status,
+            "inventory_version": has_inventory_version,
+            "missing_indexes": missing_indexes,
             "stats": {
                 "total_ingredients": total_ingredients,
                 "ingredients_with_units": ingredients_with_units,
@@ -515,9 +2041,203 @@ def health_check(db: Session = Depends(get_db)):
             "timestamp": datetime.utcnow().isoformat()
         }
 
+@app.get("/admin/db-pool")
+def get_db_pool_metrics():
+    """Pool settings and metrics for the worker process that answers; each gunicorn worker has its own pool"""
+    pool = engine.pool
+    gauges = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        gauges.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                      overflow=max(pool.overflow(), 0), max_overflow=pool._max_overflow, timeout=pool.timeout())
+    return {
+        "pid": os.getpid(),
+        "settings": {
+            "web_concurrency": WEB_CONCURRENCY,
+            "max_connections": DB_MAX_CONNECTIONS or None,
+            "pool_recycle_seconds": DB_POOL_RECYCLE_SECONDS,
+            "pool_pre_ping": DB_POOL_PRE_PING,
+            "statement_timeout_ms": DB_STATEMENT_TIMEOUT_MS or None,
+        },
+        "pool": gauges,
+        "metrics": pool_metrics.snapshot(),
+    }
+
+
+@app.post("/admin/db-pool/reset-metrics")
+def reset_db_pool_metrics():
+    """Start this worker's pool metrics over, e.g. at the start of a load test"""
+    pool_metrics.reset()
+    return {"message": "Pool metrics reset", "pid": os.getpid()}
+
+
+# --- SQLite Writer ---
+# SQLite has one writer per database file. Rather than letting request threads queue on its lock (and
+# fail with "database is locked" once the busy timeout runs out), short writes are handed to one writer
+# thread per process as jobs: functions of a session that write without committing. The writer runs
+# every job waiting in the queue back to back in one transaction, each under its own SAVEPOINT so a
+# failing job only undoes itself, and commits the group once. Other processes are held off by the
+# group's BEGIN IMMEDIATE and wait for it through the busy timeout.
+SQLITE_WRITE_QUEUE = os.getenv("SQLITE_WRITE_QUEUE", "true").lower() in ("1", "true", "yes")
+SQLITE_WRITE_BATCH_MAX = int(os.getenv("SQLITE_WRITE_BATCH_MAX", "32"))
+
+
+class SqliteWriter:
+    """One thread that group-commits queued write jobs"""
+
+    def __init__(self, batch_max: int):
+        self.batch_max = batch_max
+        self.lock = threading.Lock()
+        self.jobs = None
+        self.thread = None
+        self.pid = None
+        self.stats = {"groups": 0, "jobs": 0}
+
+    def submit(self, job, retry_conflicts: bool = False):
+        """Queue job(session) and block until its group has committed, returns its result or raises its error.
+
+        With retry_conflicts, a job that loses an optimistic version check is run again on its own.
+        """
+        future = Future()
+        self.ensure_started().put((job, retry_conflicts, future))
+        return future.result()
+
+    def ensure_started(self) -> queue.Queue:
+        with self.lock:
+            if self.pid != os.getpid():  # First use, or a forked worker that didn't inherit the thread
+                self.jobs = queue.Queue()
+                self.thread = threading.Thread(target=self.run, args=(self.jobs,), daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+            return self.jobs
+
+    def run(self, jobs: queue.Queue):
+        while True:
+            group = [jobs.get()]
+            while len(group) < self.batch_max:
+                try:
+                    group.append(jobs.get_nowait())
+                except queue.Empty:
+                    break
+            self.run_group(group)
+
+    def run_group(self, group):
+        try:
+            outcomes = self.commit_group([job for job, _, _ in group])
+        except Exception as e:
+            if len(group) > 1:
+                # A failed flush or commit takes the whole transaction down, so find the culprit alone.
+                # commit_group() only raises when nothing was committed, so no job is applied twice
+                for entry in group:
+                    self.run_group([entry])
+                return
+            outcomes = [(False, e)]
+
+        self.stats["groups"] += 1
+        self.stats["jobs"] += len(group)
+        for (job, retry_conflicts, future), (succeeded, value) in zip(group, outcomes):
+            if not succeeded and retry_conflicts and isinstance(value, StaleDataError):
+                succeeded, value = self.retry_conflict(job)
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def retry_conflict(self, job) -> tuple:
+        """Run a job that lost a version check again on its own, the way retry_stock_conflicts() does.
+
+        No backoff: the group holds the write lock, so the rows it reads now are current.
+        """
+        for attempt_number in range(2, STOCK_CONFLICT_RETRIES + 1):
+            stock_conflict_stats["retried"] += 1
+            logger.debug(f"Stock conflict, retrying deduction (attempt {attempt_number})")
+            try:
+                (succeeded, value), = self.commit_group([job])
+            except Exception as e:
+                succeeded, value = False, e
+            if succeeded or not isinstance(value, StaleDataError):
+                return succeeded, value
+        stock_conflict_stats["gave_up"] += 1
+        return False, StockConflictError(STOCK_CONFLICT_RETRIES)
+
+    def commit_group(self, jobs) -> list:
+        db = SessionLocal()
+        try:
+            lock_inventory_for_update(db)  # BEGIN IMMEDIATE, so no other process commits during the group
+            connection = db.connection()
+            outcomes = []
+            for job in jobs:
+                # A connection-level savepoint, so the session's commit hooks only fire for the group
+                savepoint = connection.begin_nested()
+                loaded = set(db.identity_map.keys())
+                try:
+                    value = job(db)
+                    db.flush()
+                    savepoint.commit()
+                    outcomes.append((True, value))
+                except Exception as e:
+                    if not db.is_active:
+                        raise
+                    savepoint.rollback()
+                    forget_job_objects(db, loaded)
+                    outcomes.append((False, e))
+            try:
+                db.commit()
+            except Exception as e:
+                if not db.info.get("committed"):
+                    raise
+                # COMMIT went through and a hook after it failed: the jobs are applied, so they must not be
+                # run again and their outcomes stand
+                logger.error(f"After-commit hook failed for a group of {len(jobs)} write(s): {e}")
+            return outcomes
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+def forget_job_objects(db: Session, loaded: set):
+    """After a job's savepoint rolled back, drop the objects it brought into the session and expire
+    the ones it found there, so earlier jobs' objects stay attached but are reloaded on next access"""
+    for obj in list(db.new):
+        db.expunge(obj)
+    for key, obj in list(db.identity_map.items()):
+        if key in loaded:
+            db.expire(obj)
+        else:
+            db.expunge(obj)
+
+
+sqlite_writer = SqliteWriter(SQLITE_WRITE_BATCH_MAX) if engine.dialect.name == "sqlite" and SQLITE_WRITE_QUEUE \
+    else None
+
+
+def commit_write(db: Session, job):
+    try:
+        result = job(db)
+        db.commit()
+        return result
+    except Exception:
+        db.rollback()
+        raise
+
+
+def run_write(db: Session, job, retry_conflicts: bool = False):
+    """Run job(session) as one committed write: on the SQLite writer when it is enabled, else on db.
+
+    With retry_conflicts, a job whose batch writes lose an optimistic version check is run again.
+    """
+    if sqlite_writer is not None:
+        return sqlite_writer.submit(job, retry_conflicts)
+    if retry_conflicts:
+        return retry_stock_conflicts(db, lambda: commit_write(db, job))
+    return commit_write(db, job)
+
+
 # --- Routes ---
 
 @app.post("/add_item")
+@idempotent
 def add_item(
     name: str,
     quantity: float,
@@ -537,32 +2257,41 @@ def add_item(
         raise HTTPException(status_code=400, detail="Either price_per_unit or total_cost must be provided")
 
 
-    item = Inventory(
-        name=name,
-        quantity=quantity,
-        unit=unit,
-        price_per_unit=price_per_unit if price_per_unit is not None else 0.0,
-        total_cost=total_cost,
-        type=type if type is not None else "",
-        date_added=date_added
-    )
+    def write_item(db: Session) -> dict:
+        item = Inventory(
+            name=name,
+            quantity=quantity,
+            unit=unit,
+            price_per_unit=price_per_unit if price_per_unit is not None else 0.0,
+            total_cost=total_cost,
+            type=type if type is not None else "",
+            date_added=date_added
+        )
 
-    db.add(item)
-    db.add(Expense(item_name=name, quantity=quantity, total_cost=total_cost, date=date_added))
-    db.commit()
-    db.refresh(item)
+        db.add(item)
+        db.add(Expense(item_name=name, quantity=quantity, total_cost=total_cost, date=date_added))
+        refresh_expense_rollup(db, {expense_rollup_key(item)})
+        refresh_ingredient_stock(db, {item.name_key})
+        propagate_price_changes(db, {item.name_key})
+        db.flush()
+        version = record_inventory_changes(db, [item.id], "created")
+        return {"message": "Item added successfully!", "item": serialize_inventory_item(item), "inventory_version": version}
 
-    inventory = db.query(Inventory).all()
-    return {"message": "Item added successfully!", "inventory": inventory}
+    return run_write(db, write_item)
 
 @app.get("/search_inventory")
 def search_inventory(
+    request: Request,
     name: Optional[str] = Query(None, description="Partial or full item name"),
     type: Optional[str] = Query(None, description="Inventory type (e.g. 'Vegetables', 'Dairy')"),
     start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD format"),
     end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD format"),
     db: Session = Depends(get_db)
 ):
+    etag = table_etag("inventory")
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
     try:
         query = db.query(Inventory)
 
@@ -587,7 +2316,7 @@ def search_inventory(
 
         results = query.all()
 
-        return [
+        return JSONResponse(content=[
             {
                 "id": item.id,
                 "name": item.name,
@@ -599,26 +2328,37 @@ def search_inventory(
                 "date_added": item.date_added.strftime("%Y-%m-%d %H:%M:%S")
             }
             for item in results
-        ]
+        ], headers=etag_headers(etag))
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 @app.delete("/delete_item/{item_id}")
+@idempotent
 def delete_item(item_id: int, db: Session = Depends(get_db)):
-    item = db.query(Inventory).filter(Inventory.id == item_id).first()
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
+    def write_item(db: Session) -> dict:
+        item = db.query(Inventory).filter(Inventory.id == item_id).first()
+        if not item:
+            raise HTTPException(status_code=404, detail="Item not found")
+
+        rollup_key = expense_rollup_key(item)
+        stock_key = item.name_key
+        db.delete(item)
+        refresh_expense_rollup(db, {rollup_key})
+        refresh_ingredient_stock(db, {stock_key})
+        propagate_price_changes(db, {stock_key})
+        version = record_inventory_changes(db, [item_id], "deleted")
+        return {
+            "message": "Item deleted successfully!",
+            "deleted_id": item_id,
+            "inventory_version": version
+        }
 
-    db.delete(item)
-    db.commit()
-    return {
-        "message": "Item deleted successfully!",
-        "current_inventory": db.query(Inventory).all()
-    }
+    return run_write(db, write_item)
 
 
 @app.put("/update_item/{item_id}")
+@idempotent
 def update_item(
     item_id: int,
     name: str = Query(...),
@@ -630,10 +2370,6 @@ def update_item(
     type: Optional[str] = Query(None),
     db: Session = Depends(get_db)
 ):
-    item = db.query(Inventory).filter(Inventory.id == item_id).first()
-    if not item:
-        raise HTTPException(status_code=404, detail="Item not found")
-
     # Recalculate total_cost
     if price_per_unit is not None:
         total_cost = quantity * price_per_unit
@@ -642,128 +2378,455 @@ def update_item(
     else:
         raise HTTPException(status_code=400, detail="Either price_per_unit or total_cost must be provided")
 
-    # Update fields
-    item.name = name
-    item.quantity = quantity
-    item.unit = unit
-    item.price_per_unit = price_per_unit if price_per_unit is not None else 0.0
-    item.total_cost = total_cost
-    item.date_added = date_added
-    item.type = type if type is not None else ""
+    def write_item(db: Session) -> dict:
+        item = db.query(Inventory).filter(Inventory.id == item_id).first()
+        if not item:
+            raise HTTPException(status_code=404, detail="Item not found")
 
-    db.commit()
-    db.refresh(item)
+        previous_rollup_key = expense_rollup_key(item)
+        previous_stock_key = item.name_key
 
-    return {
-        "message": "Item updated successfully!",
-        "updated_item": {
-            "id": item.id,
-            "name": item.name,
-            "quantity": item.quantity,
-            "unit": item.unit,
-            "price_per_unit": item.price_per_unit,
-            "total_cost": item.total_cost,
-            "type": item.type,
-            "date_added": item.date_added.strftime("%Y-%m-%d")
-        },
-        "current_inventory": [
-            {
-                "id": i.id,
-                "name": i.name,
-                "quantity": i.quantity,
-                "unit": i.unit,
-                "price_per_unit": i.price_per_unit,
-                "total_cost": i.total_cost,
-                "type": i.type,
-                "date_added": i.date_added.strftime("%Y-%m-%d")
-            } for i in db.query(Inventory).all()
-        ]
-    }
+        # Update fields
+        item.name = name
+        item.quantity = quantity
+        item.unit = unit
+        item.price_per_unit = price_per_unit if price_per_unit is not None else 0.0
+        item.total_cost = total_cost
+        item.date_added = date_added
+        item.type = type if type is not None else ""
 
-@app.get("/inventory")
-def get_inventory(db: Session = Depends(get_db)):
-    inventory_items = db.query(Inventory).all()
-    return [
-        {
-            "id": item.id,
-            "name": item.name,
-            "price_per_unit": item.price_per_unit,
-            "unit": item.unit,
-            "quantity": item.quantity,
-            "total_cost": item.total_cost,
-            "type": item.type,
-            "date_added": item.date_added.strftime("%Y-%m-%d %H:%M:%S")
+        refresh_expense_rollup(db, {previous_rollup_key, expense_rollup_key(item)})
+        refresh_ingredient_stock(db, {previous_stock_key, item.name_key})
+        propagate_price_changes(db, {previous_stock_key, item.name_key})
+        version = record_inventory_changes(db, [item.id], "updated")
+
+        return {
+            "message": "Item updated successfully!",
+            "updated_item": {
+                "id": item.id,
+                "name": item.name,
+                "quantity": item.quantity,
+                "unit": item.unit,
+                "price_per_unit": item.price_per_unit,
+                "total_cost": item.total_cost,
+                "type": item.type,
+                "date_added": item.date_added.strftime("%Y-%m-%d")
+            },
+            "inventory_version": version
         }
-        for item in inventory_items
-    ]
 
-@app.get("/inventory_by_name/{item_name}")
-def get_inventory_by_name(item_name: str, db: Session = Depends(get_db)):
-    items = db.query(Inventory).filter(Inventory.name.ilike(f"%{item_name}%")).all()
-    if not items:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return items
+    return run_write(db, write_item)
 
-@app.delete("/delete_all_inventory")
-def delete_all_inventory(confirm: bool = False, db: Session = Depends(get_db)):
-    if not confirm:
-        raise HTTPException(status_code=400, detail="Please confirm deletion by setting confirm=true")
+INVENTORY_PAGE_MAX = int(os.getenv("INVENTORY_PAGE_MAX", "1000"))
 
-    deleted = db.query(Inventory).delete()
-    db.commit()
+
+def sql_datetime_text(db: Session, column):
+    """Format a DateTime column as 'YYYY-MM-DD HH:MM:SS' in the query instead of per row in Python"""
+    if db.bind.dialect.name == "postgresql":
+        return func.to_char(column, "YYYY-MM-DD HH24:MI:SS")
+    return func.strftime("%Y-%m-%d %H:%M:%S", column)
+
+
+def inventory_fields(db: Session) -> dict:
+    """Columns /inventory can project, in response order"""
     return {
-        "message": f"Deleted {deleted} item(s) from inventory.",
-        "current_inventory": db.query(Inventory).all()
+        "id": Inventory.id,
+        "name": Inventory.name,
+        "price_per_unit": Inventory.price_per_unit,
+        "unit": Inventory.unit,
+        "quantity": Inventory.quantity,
+        "total_cost": Inventory.total_cost,
+        "type": Inventory.type,
+        "date_added": sql_datetime_text(db, Inventory.date_added)
     }
 
 
-@app.get("/expense_report")
-def expense_report(
-    start_date: Optional[str] = Query(default=None),
-    end_date: Optional[str] = Query(default=None),
-    inventory_name: Optional[str] = Query(default=None),
-    type: Optional[str] = Query(default=None),
+@app.get("/inventory")
+def get_inventory(
+    request: Request,
+    after_id: Optional[int] = Query(None, description="Return rows with an id above this cursor"),
+    limit: Optional[int] = Query(None, description=f"Page size, at most {INVENTORY_PAGE_MAX}; all rows when omitted"),
+    only_in_stock: bool = Query(False, description="Skip exhausted batches"),
+    type: Optional[str] = Query(None, description="Inventory type (e.g. 'Vegetables', 'Dairy')"),
+    start_date: Optional[str] = Query(None, description="Added on or after this day, YYYY-MM-DD"),
+    end_date: Optional[str] = Query(None, description="Added on or before this day, YYYY-MM-DD"),
+    fields: Optional[str] = Query(None, description="Comma-separated columns to return, id is always included"),
     db: Session = Depends(get_db)
 ):
-    # Determine date range if not provided
-    if not start_date or not end_date:
-        date_range = db.query(
-            func.min(Inventory.date_added),
-            func.max(Inventory.date_added)
-        ).first()
-        if not date_range or not date_range[0] or not date_range[1]:
-            return {
-                "message": "No inventory records in the database.",
-                "total_expense": 0,
-                "average_expense": 0,
-                "highest_expense_day": None,
-                "lowest_expense_day": None,
-                "highest_expense_item": None,
-                "lowest_expense_item": None,
-                "most_frequent_inventory": None
-            }
-        start = date_range[0]
-        end = date_range[1]
-    else:
-        start = datetime.strptime(start_date, "%Y-%m-%d")
-        end = datetime.strptime(end_date, "%Y-%m-%d")
+    """Inventory rows in id order. When a page is full, X-Next-After-Id carries the cursor for the next one"""
+    etag = table_etag("inventory")
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    statement = inventory_page_statement(db, after_id, limit, only_in_stock, type, start_date, end_date, fields)
+    rows = [dict(row._mapping) for row in db.execute(statement)]
+    return inventory_page_response(rows, limit, etag)
+
+
+def inventory_page_statement(db, after_id: Optional[int], limit: Optional[int], only_in_stock: bool,
+                             type: Optional[str], start_date: Optional[str], end_date: Optional[str],
+                             fields: Optional[str]):
+    """The SELECT behind one /inventory page, raises a 400 for bad parameters. db may be an AsyncSession"""
+    columns = inventory_fields(db)
+    if fields:
+        selected = ["id"] + [field.strip() for field in fields.split(",") if field.strip() and field.strip() != "id"]
+        unknown = [field for field in selected if field not in columns]
+        if unknown:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unknown field(s): {', '.join(unknown)}. Available: {', '.join(columns)}"
+            )
+        columns = {field: columns[field] for field in dict.fromkeys(selected)}
 
-    # Base query
-    query = db.query(Inventory).filter(
-        Inventory.date_added >= start,
-        Inventory.date_added <= end
-    )
+    if limit is not None and not 1 <= limit <= INVENTORY_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {INVENTORY_PAGE_MAX}")
+
+    statement = select(*[column.label(field) for field, column in columns.items()])
+
+    if after_id is not None:
+        statement = statement.where(Inventory.id > after_id)
+    if only_in_stock:
+        statement = statement.where(Inventory.quantity > 0)
+    if type:
+        statement = statement.where(Inventory.type.ilike(f"%{type}%"))
+    if start_date:
+        try:
+            statement = statement.where(Inventory.date_added >= datetime.strptime(start_date, "%Y-%m-%d"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid start_date format. Use YYYY-MM-DD.")
+    if end_date:
+        try:
+            statement = statement.where(
+                Inventory.date_added < datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
+            )
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid end_date format. Use YYYY-MM-DD.")
+
+    statement = statement.order_by(Inventory.id.asc())
+    if limit is not None:
+        statement = statement.limit(limit + 1)  # One extra row tells us whether there is a next page
+    return statement
+
+
+def inventory_page_response(rows: list, limit: Optional[int], etag: str) -> JSONResponse:
+    headers = etag_headers(etag)
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-After-Id"] = str(rows[-1]["id"])
+
+    return JSONResponse(content=rows, headers=headers)
+
+
+def inventory_changes_since(db: Session, since: int, limit: int) -> dict:
+    """Rows created, updated or deleted after inventory version `since`, in their current state"""
+    changes = db.execute(inventory_changes_statement(since, limit)).all()
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    version = changes[-1].id if changes else current_inventory_version(db)
+
+    reset, latest = latest_inventory_actions(changes)
+    upserted = []
+    for ids in chunked(upserted_inventory_ids(latest), 500):
+        upserted.extend(dict(row._mapping) for row in db.execute(inventory_rows_statement(db, ids)))
+
+    return inventory_delta(version, has_more, reset, latest, upserted)
+
+
+def inventory_changes_statement(since: int, limit: int):
+    # One extra row tells us whether there is more
+    return select(InventoryChange.id, InventoryChange.inventory_id, InventoryChange.action).where(
+        InventoryChange.id > since
+    ).order_by(InventoryChange.id.asc()).limit(limit + 1)
+
+
+def latest_inventory_actions(changes) -> tuple:
+    """(reset, latest action per inventory id), starting over after a clear"""
+    reset = False
+    latest = {}
+    for change in changes:
+        if change.action == "cleared":
+            reset = True
+            latest = {}
+        else:
+            latest[change.inventory_id] = change.action
+    return reset, latest
+
+
+def upserted_inventory_ids(latest: dict) -> list:
+    return sorted(inventory_id for inventory_id, action in latest.items() if action != "deleted")
+
+
+def inventory_rows_statement(db, ids):
+    """The /inventory columns of the rows with the given ids. db may be an AsyncSession"""
+    columns = inventory_fields(db)
+    return select(*[column.label(field) for field, column in columns.items()]).where(
+        Inventory.id.in_(ids)
+    ).order_by(Inventory.id.asc())
+
+
+def inventory_delta(version: int, has_more: bool, reset: bool, latest: dict, upserted: list) -> dict:
+    # Rows deleted by a change past this page are gone already, report them as deleted too
+    present = {row["id"] for row in upserted}
+    deleted = sorted(inventory_id for inventory_id in latest if inventory_id not in present)
+
+    return {
+        "version": version,
+        "has_more": has_more,
+        "reset": reset,
+        "upserted": upserted,
+        "deleted": deleted
+    }
+
+
+@app.get("/inventory/changes")
+def get_inventory_changes(
+    since: int = Query(0, description="Inventory version the client already has"),
+    limit: int = Query(INVENTORY_CHANGES_PAGE_SIZE, description="Maximum number of changes to read"),
+    db: Session = Depends(get_db)
+):
+    """Rows changed after inventory version `since`.
+
+    `reset` means the inventory was cleared in between and should be reloaded from /inventory.
+    While `has_more` is true, call again with since=version.
+    """
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+
+    return inventory_changes_since(db, since, limit)
+
+
+# --- Change Feed ---
+# /events pushes inventory deltas and catalog versions to connected clients as server-sent events.
+# A tail thread follows inventory_changes, so commits from other workers are picked up too; commits
+# in this process wake it right away. Each client gets a bounded queue, and a client that falls
+# that far behind is told to resync instead of holding up everyone else.
+CHANGE_FEED_QUEUE_SIZE = int(os.getenv("CHANGE_FEED_QUEUE_SIZE", "100"))
+CHANGE_FEED_POLL_SECONDS = float(os.getenv("CHANGE_FEED_POLL_SECONDS", "1"))
+CHANGE_FEED_HEARTBEAT_SECONDS = float(os.getenv("CHANGE_FEED_HEARTBEAT_SECONDS", "15"))
+
+
+class FeedSubscriber:
+    """One connected client: an asyncio queue fed from any thread through the client's event loop"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=CHANGE_FEED_QUEUE_SIZE)
+
+    def offer(self, feed_event: dict):
+        """Runs on the client's loop. A full queue is dropped in favour of a single resync event"""
+        try:
+            self.queue.put_nowait(feed_event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"event": "resync", "data": {}})
+
+
+class ChangeFeed:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.wakeup = threading.Event()
+        self.tail_thread = None
+        self.version = None  # Last inventory version published, None while nobody listens
+
+    def subscribe(self) -> FeedSubscriber:
+        subscriber = FeedSubscriber(asyncio.get_running_loop())
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.tail_thread is None:
+                self.tail_thread = threading.Thread(target=self.tail_inventory_changes, daemon=True)
+                self.tail_thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: FeedSubscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event_name: str, data: dict, event_id: Optional[int] = None):
+        """Fan an event out to every subscriber, safe to call from any thread"""
+        feed_event = {"event": event_name, "data": data, "id": event_id}
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, feed_event)
+            except RuntimeError:
+                self.unsubscribe(subscriber)  # Its event loop has closed
+
+    def start_from(self, version: int):
+        """Called with the version a new client was handed, so the tail never starts past it"""
+        with self.lock:
+            if self.version is None:
+                self.version = version
+
+    def tail_inventory_changes(self):
+        """Publish every inventory_changes page past the last version seen, for as long as the process runs"""
+        while True:
+            self.wakeup.wait(CHANGE_FEED_POLL_SECONDS)
+            self.wakeup.clear()
+            with self.lock:
+                if not self.subscribers:
+                    self.version = None
+                version = self.version
+            if version is None:
+                continue
+
+            db = SessionLocal()
+            try:
+                while True:
+                    delta = inventory_changes_since(db, version, INVENTORY_CHANGES_PAGE_SIZE)
+                    if delta["version"] <= version:
+                        break
+                    version = delta["version"]
+                    self.publish("inventory", delta, version)
+                    if not delta["has_more"]:
+                        break
+                with self.lock:
+                    if self.version is not None:
+                        self.version = version
+            except Exception as e:
+                logger.error(f"Change feed tail failed: {e}")
+            finally:
+                db.close()
+
+
+change_feed = ChangeFeed()
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def wake_change_feed(session):
+    if session.info.pop("inventory_changed", False):
+        change_feed.wakeup.set()
+
+
+@event.listens_for(SessionLocal, "after_soft_rollback")
+def forget_inventory_changes(session, previous_transaction):
+    session.info.pop("inventory_changed", None)
+
+
+def format_sse(feed_event: dict) -> str:
+    lines = [f"event: {feed_event['event']}"]
+    if feed_event.get("id") is not None:
+        lines.append(f"id: {feed_event['id']}")
+    lines.append(f"data: {json.dumps(jsonable_encoder(feed_event['data']))}")
+    return "\n".join(lines) + "\n\n"
+
+
+def current_feed_versions() -> dict:
+    db = SessionLocal()
+    try:
+        inventory_version = current_inventory_version(db)
+    finally:
+        db.close()
+    change_feed.start_from(inventory_version)
+    return {"inventory_version": inventory_version, "catalog_version": dish_catalog_version()}
+
+
+@app.get("/events")
+async def change_events(request: Request):
+    """Server-sent events: `ready` with the current versions, then `inventory` deltas (the same shape as
+    /inventory/changes), `catalog` versions and `resync` when the client fell too far behind"""
+    subscriber = change_feed.subscribe()
+    versions = await run_in_threadpool(current_feed_versions)
+
+    async def stream():
+        try:
+            yield format_sse({"event": "ready", "data": versions})
+            while True:
+                try:
+                    feed_event = await asyncio.wait_for(subscriber.queue.get(), CHANGE_FEED_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(feed_event)
+        finally:
+            change_feed.unsubscribe(subscriber)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/inventory_by_name/{item_name}")
+def get_inventory_by_name(item_name: str, db: Session = Depends(get_db)):
+    items = db.query(Inventory).filter(Inventory.name.ilike(f"%{item_name}%")).all()
+    if not items:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return items
+
+@app.delete("/delete_all_inventory")
+@idempotent
+def delete_all_inventory(confirm: bool = False, db: Session = Depends(get_db)):
+    if not confirm:
+        raise HTTPException(status_code=400, detail="Please confirm deletion by setting confirm=true")
+
+    def write_clear(db: Session) -> dict:
+        deleted = db.query(Inventory).delete()
+        db.query(ExpenseDailyRollup).delete()
+        db.query(IngredientStock).delete()
+        rebuild_dish_costs(db)  # Every ingredient lost its price
+        version = record_inventory_changes(db, [None], "cleared")
+        return {
+            "message": f"Deleted {deleted} item(s) from inventory.",
+            "inventory_version": version
+        }
+
+    return run_write(db, write_clear)
+
+
+@app.get("/expense_report")
+def expense_report(
+    start_date: Optional[str] = Query(default=None),
+    end_date: Optional[str] = Query(default=None),
+    inventory_name: Optional[str] = Query(default=None),
+    type: Optional[str] = Query(default=None),
+    db: Session = Depends(get_db)
+):
+    # Determine date range if not provided
+    if not start_date or not end_date:
+        date_range = db.query(
+            func.min(ExpenseDailyRollup.day),
+            func.max(ExpenseDailyRollup.day)
+        ).first()
+        if not date_range or not date_range[0] or not date_range[1]:
+            return {
+                "message": "No inventory records in the database.",
+                "total_expense": 0,
+                "average_expense": 0,
+                "highest_expense_day": None,
+                "lowest_expense_day": None,
+                "highest_expense_item": None,
+                "lowest_expense_item": None,
+                "most_frequent_inventory": None
+            }
+        start = datetime.combine(date_range[0], datetime.min.time())
+        end = datetime.combine(date_range[1], datetime.min.time())
+    else:
+        start = datetime.strptime(start_date, "%Y-%m-%d")
+        end = datetime.strptime(end_date, "%Y-%m-%d")
+
+    # The rollup is per day, so the end date covers the whole day
+    filters = [
+        ExpenseDailyRollup.day >= start.date(),
+        ExpenseDailyRollup.day <= end.date()
+    ]
 
     # Apply inventory_name filter if present
     if inventory_name:
-        query = query.filter(Inventory.name.ilike(f"%{inventory_name}%"))
+        filters.append(ExpenseDailyRollup.item_name.ilike(f"%{inventory_name}%"))
     # Else apply type filter if present
     elif type:
-        query = query.filter(Inventory.type.ilike(f"%{type}%"))
+        filters.append(ExpenseDailyRollup.type.ilike(f"%{type}%"))
 
-    inventory_items = query.all()
+    item_count, total_expense = db.query(
+        func.coalesce(func.sum(ExpenseDailyRollup.item_count), 0),
+        func.coalesce(func.sum(ExpenseDailyRollup.total_cost), 0.0)
+    ).filter(*filters).one()
 
-    if not inventory_items:
+    if not item_count:
         return {
             "message": "No inventory found for the given filters.",
             "total_expense": 0,
@@ -775,17 +2838,16 @@ def expense_report(
             "most_frequent_inventory": None
         }
 
-    # Use total_cost directly
-    total_expense = sum(item.total_cost for item in inventory_items)
-    average_expense = total_expense / len(inventory_items)
+    average_expense = total_expense / item_count
 
-    # Daily totals
-    daily_expenses = defaultdict(float)
-    for item in inventory_items:
-        daily_expenses[item.date_added.date()] += item.total_cost
+    # Daily totals, one row per distinct day
+    daily_expenses = db.query(
+        ExpenseDailyRollup.day,
+        func.sum(ExpenseDailyRollup.total_cost)
+    ).filter(*filters).group_by(ExpenseDailyRollup.day).all()
 
-    highest_day = max(daily_expenses.items(), key=lambda x: x[1])
-    lowest_day = min(daily_expenses.items(), key=lambda x: x[1])
+    highest_day = max(daily_expenses, key=lambda x: x[1])
+    lowest_day = min(daily_expenses, key=lambda x: x[1])
 
     highest_expense_item = None
     lowest_expense_item = None
@@ -793,13 +2855,20 @@ def expense_report(
 
     # Apply extended analysis only if inventory_name is NOT provided
     if not inventory_name:
-        highest_item = max(inventory_items, key=lambda x: x.total_cost, default=None)
-        lowest_item = min(inventory_items, key=lambda x: x.total_cost, default=None)
-        highest_expense_item = highest_item.name if highest_item else None
-        lowest_expense_item = lowest_item.name if lowest_item else None
-
-        item_counts = Counter(item.name for item in inventory_items)
-        most_frequent_inventory = item_counts.most_common(1)[0][0] if item_counts else None
+        highest_item = db.query(ExpenseDailyRollup.item_name).filter(
+            *filters, ExpenseDailyRollup.max_cost.isnot(None)
+        ).order_by(ExpenseDailyRollup.max_cost.desc()).first()
+        lowest_item = db.query(ExpenseDailyRollup.item_name).filter(
+            *filters, ExpenseDailyRollup.min_cost.isnot(None)
+        ).order_by(ExpenseDailyRollup.min_cost.asc()).first()
+        highest_expense_item = highest_item[0] if highest_item else None
+        lowest_expense_item = lowest_item[0] if lowest_item else None
+
+        item_count_col = func.sum(ExpenseDailyRollup.item_count).label("item_count")
+        most_frequent = db.query(ExpenseDailyRollup.item_name, item_count_col).filter(*filters).group_by(
+            ExpenseDailyRollup.item_name
+        ).order_by(item_count_col.desc()).first()
+        most_frequent_inventory = most_frequent[0] if most_frequent else None
 
     return {
         "inventory_name": inventory_name,
@@ -822,193 +2891,568 @@ def expense_report(
     }
 
 
-@app.post("/upload_inventory_excel")
-async def upload_inventory_excel(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    if not file.filename.endswith((".xlsx", ".xls")):
-        raise HTTPException(status_code=400, detail="Please upload a valid Excel file (.xlsx or .xls)")
+@app.get("/expense_summary")
+def expense_summary(
+    period: str = Query("month", description="Bucket size: day, week or month"),
+    start_date: Optional[str] = Query(default=None),
+    end_date: Optional[str] = Query(default=None),
+    type: Optional[str] = Query(default=None),
+    db: Session = Depends(get_db)
+):
+    """Expense totals per day, ISO week or month, read from the daily rollup"""
+    if period not in ("day", "week", "month"):
+        raise HTTPException(status_code=400, detail="period must be one of: day, week, month")
+
+    query = db.query(
+        ExpenseDailyRollup.day,
+        func.sum(ExpenseDailyRollup.total_cost),
+        func.sum(ExpenseDailyRollup.item_count)
+    )
+
+    try:
+        if start_date:
+            query = query.filter(ExpenseDailyRollup.day >= datetime.strptime(start_date, "%Y-%m-%d").date())
+        if end_date:
+            query = query.filter(ExpenseDailyRollup.day <= datetime.strptime(end_date, "%Y-%m-%d").date())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
+
+    if type:
+        query = query.filter(ExpenseDailyRollup.type.ilike(f"%{type}%"))
+
+    buckets = defaultdict(lambda: {"total_expense": 0.0, "item_count": 0})
+    for day, total, count in query.group_by(ExpenseDailyRollup.day).all():
+        if period == "week":
+            bucket_start = day - timedelta(days=day.weekday())
+        elif period == "month":
+            bucket_start = day.replace(day=1)
+        else:
+            bucket_start = day
+        buckets[bucket_start]["total_expense"] += total or 0.0
+        buckets[bucket_start]["item_count"] += count or 0
+
+    return [
+        {"period_start": bucket_start.isoformat(), **totals}
+        for bucket_start, totals in sorted(buckets.items())
+    ]
+
+
+@app.post("/admin/rebuild-expense-rollup")
+def rebuild_expense_rollup_endpoint(
+        confirm: bool = Query(False, description="Set to true to rebuild, otherwise only check"),
+        db: Session = Depends(get_db)
+):
+    """Check expense_daily_rollup against the raw inventory table and optionally rebuild it"""
+    mismatches = check_expense_rollup(db)
+    if not confirm:
+        return {
+            "message": "Rebuild not confirmed. Set confirm=true to proceed.",
+            "mismatch_count": len(mismatches),
+            "mismatches": mismatches[:100]
+        }
+
+    try:
+        row_count = rebuild_expense_rollup(db)
+        remaining = check_expense_rollup(db)
+        if remaining:
+            db.rollback()
+            return {
+                "message": "Rebuilt rollup does not match the inventory table. Rolled back.",
+                "status": "failed",
+                "mismatches": remaining[:100]
+            }
+        db.commit()
+        return {
+            "message": f"Expense rollup rebuilt with {row_count} rows.",
+            "status": "ok",
+            "mismatches_fixed": len(mismatches)
+        }
+    except Exception as e:
+        db.rollback()
+        return {
+            "message": f"Rebuild error: {str(e)}",
+            "status": "error"
+        }
+
+
+@app.post("/admin/rebuild-ingredient-stock")
+def rebuild_ingredient_stock_endpoint(
+        confirm: bool = Query(False, description="Set to true to rebuild, otherwise only check"),
+        db: Session = Depends(get_db)
+):
+    """Check ingredient_stock against the raw inventory table and optionally rebuild it"""
+    mismatches = check_ingredient_stock(db)
+    if not confirm:
+        return {
+            "message": "Rebuild not confirmed. Set confirm=true to proceed.",
+            "mismatch_count": len(mismatches),
+            "mismatches": mismatches[:100]
+        }
+
+    try:
+        row_count = rebuild_ingredient_stock(db)
+        db.commit()
+        return {
+            "message": f"Ingredient stock rebuilt with {row_count} rows.",
+            "status": "ok",
+            "mismatches_fixed": len(mismatches)
+        }
+    except Exception as e:
+        db.rollback()
+        return {
+            "message": f"Rebuild error: {str(e)}",
+            "status": "error"
+        }
+
+
+@app.post("/admin/rebuild-dish-costs")
+def rebuild_dish_costs_endpoint(
+        confirm: bool = Query(False, description="Set to true to rebuild, otherwise only check"),
+        db: Session = Depends(get_db)
+):
+    """Check dish_cost against a fresh costing of every recipe and optionally rebuild it"""
+    mismatches = check_dish_costs(db)
+    if not confirm:
+        return {
+            "message": "Rebuild not confirmed. Set confirm=true to proceed.",
+            "mismatch_count": len(mismatches),
+            "mismatches": mismatches[:100]
+        }
+
+    try:
+        row_count = rebuild_dish_costs(db)
+        db.commit()
+        return {
+            "message": f"Dish costs rebuilt with {row_count} rows.",
+            "status": "ok",
+            "mismatches_fixed": len(mismatches)
+        }
+    except Exception as e:
+        db.rollback()
+        return {
+            "message": f"Rebuild error: {str(e)}",
+            "status": "error"
+        }
+
+
+# --- Excel Ingestion ---
+# Uploads are spooled to disk and read with openpyxl's read-only mode, so only one chunk of
+# rows is held in memory at a time instead of the raw bytes plus a fully built cell tree.
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "500"))
+SPOOL_BLOCK_SIZE = 1024 * 1024
+
+
+class ExcelFormatError(ValueError):
+    """The workbook is readable but its header row is not what the importer expects"""
+
+
+def spool_upload(file: UploadFile) -> str:
+    """Copy an upload to a temp file in fixed-size blocks and return its path, the caller removes it"""
+    suffix = os.path.splitext(file.filename or "")[1]
+    file.file.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as spooled:
+        shutil.copyfileobj(file.file, spooled, SPOOL_BLOCK_SIZE)
+        return spooled.name
+
+
+@contextmanager
+def open_excel_rows(path: str, lowercase_headers: bool = False):
+    """Open a workbook read-only and yield (headers, generator of (row_number, values))"""
+    workbook = load_workbook(filename=path, read_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        headers = [str(value).strip() if value else "" for value in next(rows, ())]
+        if lowercase_headers:
+            headers = [header.lower() for header in headers]
+
+        def numbered_rows():
+            width = len(headers)
+            for idx, row in enumerate(rows, start=2):
+                # Read-only sheets don't pad short rows out to the header width
+                if len(row) < width:
+                    row = tuple(row) + (None,) * (width - len(row))
+                yield idx, row
+
+        yield headers, numbered_rows()
+    finally:
+        workbook.close()
+
+
+def report_chunk_progress(chunks: list, chunk_report: dict, progress=None):
+    """Record a finished chunk, log it and hand it to the optional progress callback"""
+    chunks.append(chunk_report)
+    logger.info(f"Ingestion progress: {chunk_report}")
+    if progress:
+        progress(chunk_report)
+
+
+# --- Background Jobs ---
+# Large imports can run on a small local thread pool instead of holding a request open. Job state
+# lives in the jobs table, so any worker process can answer /jobs/{id} while the import runs.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="import-job")
+
+
+def serialize_job(job: Job) -> dict:
+    return {
+        "job_id": job.id,
+        "kind": job.kind,
+        "filename": job.filename,
+        "status": job.status,
+        "rows_processed": job.rows_processed or 0,
+        "chunks_processed": job.chunks_processed or 0,
+        "progress": json.loads(job.progress) if job.progress else None,
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None
+    }
+
+
+def update_job(job_id: int, **values):
+    """Write job state from its own short session so it never joins the import's transaction"""
+    db = SessionLocal()
+    try:
+        values["updated_at"] = datetime.utcnow()
+        db.query(Job).filter(Job.id == job_id).update(values, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def run_import_job(job_id: int, import_workbook, path: str):
+    """Executor entry point: run an import against a spooled workbook and record the outcome"""
+    def on_progress(chunk_report: dict):
+        update_job(
+            job_id,
+            rows_processed=chunk_report["rows_read"],
+            chunks_processed=chunk_report["chunk"],
+            progress=json.dumps(chunk_report)
+        )
+
+    db = SessionLocal()
+    try:
+        update_job(job_id, status="running", started_at=datetime.utcnow())
+        result = import_workbook(db, path, progress=on_progress)
+        update_job(
+            job_id,
+            status="succeeded",
+            result=json.dumps(jsonable_encoder(result)),
+            finished_at=datetime.utcnow()
+        )
+    except (ExcelFormatError, HTTPException) as e:
+        db.rollback()
+        error = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.warning(f"Import job {job_id} failed: {error}")
+        update_job(job_id, status="failed", error=str(error), finished_at=datetime.utcnow())
+    except Exception as e:
+        import traceback
+        logger.error(f"Import job {job_id} failed: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        db.rollback()
+        update_job(job_id, status="failed", error=str(e), finished_at=datetime.utcnow())
+    finally:
+        db.close()
+        os.remove(path)
+
+
+def submit_import_job(db: Session, kind: str, file: UploadFile, import_workbook) -> JSONResponse:
+    """Spool the upload, record a queued job and hand it to the executor, answers 202 straight away"""
+    path = spool_upload(file)
+    try:
+        job = Job(kind=kind, filename=file.filename, status="queued")
+        db.add(job)
+        db.commit()
+        job_id = job.id
+    except Exception:
+        db.rollback()
+        os.remove(path)
+        raise
+
+    job_executor.submit(run_import_job, job_id, import_workbook, path)
+    logger.info(f"Queued {kind} import job {job_id} for {file.filename}")
+
+    return JSONResponse(status_code=202, content={
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}"
+    })
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: int, db: Session = Depends(get_db)):
+    job = db.query(Job).filter(Job.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return serialize_job(job)
+
+
+def parse_inventory_row(row, col_index: dict) -> dict:
+    """Turn one spreadsheet row into inventory values, raises ValueError with the skip reason"""
+    # Basic field extraction with null checks
+    name = str(row[col_index["name"]]).strip() if row[col_index["name"]] is not None else ""
+    if not name:
+        raise ValueError("Empty name field.")
+
+    try:
+        quantity = float(row[col_index["quantity"]])
+    except (ValueError, TypeError):
+        raise ValueError("Invalid quantity value.")
+
+    unit = str(row[col_index["unit"]]).strip() if row[col_index["unit"]] is not None else ""
+    if not unit:
+        raise ValueError("Empty unit field.")
+
+    # Handle price and cost calculations with better error handling
+    price_per_unit = None
+    total_cost = None
+
+    if "price_per_unit" in col_index and row[col_index["price_per_unit"]] is not None:
+        try:
+            price_per_unit = float(row[col_index["price_per_unit"]])
+        except (ValueError, TypeError):
+            pass
+
+    if "total_cost" in col_index and row[col_index["total_cost"]] is not None:
+        try:
+            total_cost = float(row[col_index["total_cost"]])
+        except (ValueError, TypeError):
+            pass
+
+    # Calculate missing values
+    if price_per_unit is not None and total_cost is None:
+        total_cost = quantity * price_per_unit
+    elif total_cost is not None and price_per_unit is None:
+        price_per_unit = total_cost / quantity if quantity != 0 else 0
+    elif price_per_unit is None and total_cost is None:
+        raise ValueError("Missing both price_per_unit and total_cost.")
+
+    # Handle type field
+    type_ = ""
+    if "type" in col_index and row[col_index["type"]] is not None:
+        type_ = str(row[col_index["type"]]).strip()
+
+    # Enhanced date parsing
+    date_raw = row[col_index["date_added"]]
+
+    if date_raw is None:
+        date_added = datetime.utcnow()
+    elif isinstance(date_raw, datetime):
+        date_added = date_raw
+    elif isinstance(date_raw, str):
+        try:
+            # Try multiple date formats
+            date_str = date_raw.strip()
+            if 'T' in date_str:
+                # ISO format
+                date_added = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+            elif len(date_str) == 10:
+                # YYYY-MM-DD format
+                date_added = datetime.strptime(date_str, "%Y-%m-%d")
+            elif len(date_str) == 19:
+                # YYYY-MM-DD HH:MM:SS format
+                date_added = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
+            else:
+                raise ValueError("Unrecognized date format")
+        except ValueError:
+            raise ValueError(f"Invalid date format '{date_raw}'. Use YYYY-MM-DD.")
+    else:
+        try:
+            # Handle Excel date numbers
+            if isinstance(date_raw, (int, float)):
+                # Excel date serial number
+                excel_epoch = datetime(1900, 1, 1)
+                date_added = excel_epoch + timedelta(days=date_raw - 2)  # Excel counts from 1900-01-01
+            else:
+                date_added = datetime.utcnow()
+        except:
+            date_added = datetime.utcnow()
+
+    return {
+        "name": name,
+        "quantity": quantity,
+        "unit": unit,
+        "price_per_unit": float(price_per_unit) if price_per_unit is not None else 0.0,
+        "total_cost": float(total_cost) if total_cost is not None else 0.0,
+        "type": type_,
+        "date_added": date_added
+    }
+
+
+class InventoryDuplicateIndex:
+    """In-memory set of (name, unit, quantity, total_cost) keys for duplicate detection.
+
+    Values are bucketed by the match tolerances, so a lookup only has to compare against
+    the neighbouring buckets instead of querying the database per row.
+    """
+
+    QUANTITY_TOLERANCE = 0.001
+    COST_TOLERANCE = 0.01
+
+    def __init__(self):
+        self.buckets = defaultdict(list)
+        self.loaded_names = set()
+
+    def _bucket(self, quantity: float, total_cost: float):
+        return math.floor(quantity / self.QUANTITY_TOLERANCE), math.floor(total_cost / self.COST_TOLERANCE)
+
+    def add(self, name: str, unit: str, quantity: float, total_cost: float):
+        if quantity is None or total_cost is None:
+            return
+        quantity_bucket, cost_bucket = self._bucket(quantity, total_cost)
+        self.buckets[(name, unit, quantity_bucket, cost_bucket)].append((quantity, total_cost))
+
+    def contains(self, name: str, unit: str, quantity: float, total_cost: float) -> bool:
+        quantity_bucket, cost_bucket = self._bucket(quantity, total_cost)
+        for quantity_offset in (-1, 0, 1):
+            for cost_offset in (-1, 0, 1):
+                key = (name, unit, quantity_bucket + quantity_offset, cost_bucket + cost_offset)
+                for existing_quantity, existing_cost in self.buckets.get(key, ()):
+                    if abs(existing_quantity - quantity) < self.QUANTITY_TOLERANCE and \
+                            abs(existing_cost - total_cost) < self.COST_TOLERANCE:
+                        return True
+        return False
+
+    def load(self, db: Session, names):
+        """Load the existing keys for names not seen yet, in a handful of IN queries"""
+        new_names = set(names) - self.loaded_names
+        for chunk in chunked(new_names, 500):
+            for name, unit, quantity, total_cost in db.query(
+                    Inventory.name, Inventory.unit, Inventory.quantity, Inventory.total_cost
+            ).filter(Inventory.name.in_(chunk)).all():
+                self.add(name, unit, quantity, total_cost)
+        self.loaded_names |= new_names
 
-    try:
-        contents = await file.read()
-        workbook = load_workbook(filename=BytesIO(contents))
-        sheet = workbook.active
 
-        headers = [str(cell.value).strip() if cell.value else "" for cell in sheet[1]]
+def import_inventory_workbook(db: Session, path: str, progress=None) -> dict:
+    """Stream an inventory workbook into the database, committing every INGEST_CHUNK_SIZE rows"""
+    with open_excel_rows(path) as (headers, rows):
         required_columns = {"name", "quantity", "unit", "date_added"}
         optional_columns = {"price_per_unit", "total_cost", "type"}
 
         missing_required = required_columns - set(headers)
         if missing_required:
-            return JSONResponse(status_code=400, content={
-                "error": f"Missing required columns: {', '.join(missing_required)}. Found: {headers}"
-            })
+            raise ExcelFormatError(f"Missing required columns: {', '.join(missing_required)}. Found: {headers}")
 
         col_index = {key: headers.index(key) for key in required_columns.union(optional_columns) if key in headers}
 
         added_items = []
         skipped_rows = []
+        chunks = []
+        rows_read = 0
 
-        for idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
-            try:
-                if not row or all(cell is None for cell in row):
-                    continue  # Skip empty rows
-
-                # Basic field extraction with null checks
-                name = str(row[col_index["name"]]).strip() if row[col_index["name"]] is not None else ""
-                if not name:
-                    skipped_rows.append(f"Row {idx}: Empty name field.")
-                    continue
-
-                try:
-                    quantity = float(row[col_index["quantity"]])
-                except (ValueError, TypeError):
-                    skipped_rows.append(f"Row {idx}: Invalid quantity value.")
-                    continue
-
-                unit = str(row[col_index["unit"]]).strip() if row[col_index["unit"]] is not None else ""
-                if not unit:
-                    skipped_rows.append(f"Row {idx}: Empty unit field.")
-                    continue
+        # Grows chunk by chunk with the existing keys for new names and the rows accepted so far
+        duplicate_index = InventoryDuplicateIndex()
 
-                # Handle price and cost calculations with better error handling
-                price_per_unit = None
-                total_cost = None
+        for chunk_number, chunk in enumerate(chunked(rows, INGEST_CHUNK_SIZE), start=1):
+            rows_read += len(chunk)
+            parsed_rows = []
+            chunk_skipped = []
 
-                if "price_per_unit" in col_index and row[col_index["price_per_unit"]] is not None:
-                    try:
-                        price_per_unit = float(row[col_index["price_per_unit"]])
-                    except (ValueError, TypeError):
-                        pass
+            for idx, row in chunk:
+                if all(cell is None for cell in row):
+                    continue  # Skip empty rows
 
-                if "total_cost" in col_index and row[col_index["total_cost"]] is not None:
-                    try:
-                        total_cost = float(row[col_index["total_cost"]])
-                    except (ValueError, TypeError):
-                        pass
-
-                # Calculate missing values
-                if price_per_unit is not None and total_cost is None:
-                    total_cost = quantity * price_per_unit
-                elif total_cost is not None and price_per_unit is None:
-                    price_per_unit = total_cost / quantity if quantity != 0 else 0
-                elif price_per_unit is None and total_cost is None:
-                    skipped_rows.append(f"Row {idx}: Missing both price_per_unit and total_cost.")
+                try:
+                    parsed_rows.append((idx, parse_inventory_row(row, col_index)))
+                except ValueError as row_error:
+                    chunk_skipped.append((idx, f"Row {idx}: {str(row_error)}"))
+                except Exception as row_error:
+                    # Enhanced error logging for debugging
+                    import traceback
+                    error_detail = f"Row {idx}: {str(row_error)}"
+                    logger.error(f"Row processing error: {error_detail}")
+                    logger.error(f"Traceback: {traceback.format_exc()}")
+                    chunk_skipped.append((idx, error_detail))
+
+            # Check duplicates in memory instead of one query per row
+            duplicate_index.load(db, {values["name"] for _, values in parsed_rows})
+            inventory_rows = []
+            expense_rows = []
+            rollup_keys = set()
+
+            for idx, values in parsed_rows:
+                if duplicate_index.contains(values["name"], values["unit"], values["quantity"], values["total_cost"]):
+                    chunk_skipped.append((idx, f"Row {idx}: Similar item already exists. Skipped."))
                     continue
 
-                # Handle type field
-                type_ = ""
-                if "type" in col_index and row[col_index["type"]] is not None:
-                    type_ = str(row[col_index["type"]]).strip()
+                duplicate_index.add(values["name"], values["unit"], values["quantity"], values["total_cost"])
+                inventory_rows.append(values)
+                expense_rows.append({
+                    "item_name": values["name"],
+                    "quantity": values["quantity"],
+                    "total_cost": values["total_cost"],
+                    "date": values["date_added"]
+                })
+                rollup_keys.add((values["date_added"].date(), values["name"], values["type"]))
 
-                # Enhanced date parsing
-                date_added = None
-                date_raw = row[col_index["date_added"]]
+            # Insert and commit the chunk
+            try:
+                db.bulk_insert_mappings(Inventory, inventory_rows, return_defaults=True)  # Fills in each "id"
+                db.bulk_insert_mappings(Expense, expense_rows)
+                refresh_expense_rollup(db, rollup_keys)
+                chunk_keys = {normalize_name_key(values["name"]) for values in inventory_rows}
+                refresh_ingredient_stock(db, chunk_keys)
+                propagate_price_changes(db, chunk_keys)
+                if inventory_rows:
+                    record_inventory_changes(db, [values["id"] for values in inventory_rows], "created")
+                db.commit()
+            except Exception as commit_error:
+                db.rollback()
+                logger.error(f"Database commit failed: {str(commit_error)}")
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Database commit failed on chunk {chunk_number}: {str(commit_error)}. "
+                           f"{len(added_items)} item(s) from earlier chunks were saved."
+                )
 
-                if date_raw is None:
-                    date_added = datetime.utcnow()
-                elif isinstance(date_raw, datetime):
-                    date_added = date_raw
-                elif isinstance(date_raw, str):
-                    try:
-                        # Try multiple date formats
-                        date_str = date_raw.strip()
-                        if 'T' in date_str:
-                            # ISO format
-                            date_added = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-                        elif len(date_str) == 10:
-                            # YYYY-MM-DD format
-                            date_added = datetime.strptime(date_str, "%Y-%m-%d")
-                        elif len(date_str) == 19:
-                            # YYYY-MM-DD HH:MM:SS format
-                            date_added = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
-                        else:
-                            raise ValueError("Unrecognized date format")
-                    except ValueError as e:
-                        skipped_rows.append(f"Row {idx}: Invalid date format '{date_raw}'. Use YYYY-MM-DD.")
-                        continue
-                else:
-                    try:
-                        # Handle Excel date numbers
-                        from datetime import date as date_type
-                        if isinstance(date_raw, (int, float)):
-                            # Excel date serial number
-                            excel_epoch = datetime(1900, 1, 1)
-                            date_added = excel_epoch + timedelta(days=date_raw - 2)  # Excel counts from 1900-01-01
-                        else:
-                            date_added = datetime.utcnow()
-                    except:
-                        date_added = datetime.utcnow()
-
-                # Check for existing items with more flexible matching
-                existing = db.query(Inventory).filter(
-                    Inventory.name == name,
-                    Inventory.unit == unit,
-                    func.abs(Inventory.quantity - quantity) < 0.001,  # Float comparison
-                    func.abs(Inventory.total_cost - total_cost) < 0.01  # Float comparison
-                ).first()
-
-                if existing:
-                    skipped_rows.append(f"Row {idx}: Similar item already exists. Skipped.")
-                    continue
+            added_items.extend(values["name"] for values in inventory_rows)
+            skipped_rows.extend(message for _, message in sorted(chunk_skipped, key=lambda entry: entry[0]))
 
-                # Create inventory item with explicit field assignment
-                item = Inventory(
-                    name=name,
-                    quantity=float(quantity),
-                    unit=unit,
-                    price_per_unit=float(price_per_unit) if price_per_unit is not None else 0.0,
-                    total_cost=float(total_cost) if total_cost is not None else 0.0,
-                    type=type_,
-                    date_added=date_added
-                )
+            report_chunk_progress(chunks, {
+                "chunk": chunk_number,
+                "rows_read": rows_read,
+                "added": len(inventory_rows),
+                "skipped": len(chunk_skipped)
+            }, progress)
 
-                # Create expense record
-                expense = Expense(
-                    item_name=name,
-                    quantity=float(quantity),
-                    total_cost=float(total_cost) if total_cost is not None else 0.0,
-                    date=date_added
-                )
+    return {
+        "message": "Excel processed successfully",
+        "added_items": added_items,
+        "skipped_rows": skipped_rows,
+        "summary": {
+            "total_processed": len(added_items) + len(skipped_rows),
+            "successful": len(added_items),
+            "skipped": len(skipped_rows)
+        },
+        "chunks": chunks
+    }
 
-                # Add to session but don't commit yet
-                db.add(item)
-                db.add(expense)
 
-                # Flush to catch any immediate database errors
-                db.flush()
+@app.post("/upload_inventory_excel")
+@idempotent
+def upload_inventory_excel(
+        file: UploadFile = File(...),
+        background: bool = Query(False, description="Queue the import and poll /jobs/{id} instead of waiting"),
+        db: Session = Depends(get_db)
+):
+    if not file.filename.endswith((".xlsx", ".xls")):
+        raise HTTPException(status_code=400, detail="Please upload a valid Excel file (.xlsx or .xls)")
 
-                added_items.append(name)
+    if background:
+        return submit_import_job(db, "inventory", file, import_inventory_workbook)
 
-            except Exception as row_error:
-                # Enhanced error logging for debugging
-                import traceback
-                error_detail = f"Row {idx}: {str(row_error)}"
-                logger.error(f"Row processing error: {error_detail}")
-                logger.error(f"Traceback: {traceback.format_exc()}")
-                skipped_rows.append(error_detail)
-                # Continue processing other rows
-                continue
+    path = spool_upload(file)
+    try:
+        return import_inventory_workbook(db, path)
 
-        # Commit all changes at once
-        try:
-            db.commit()
-        except Exception as commit_error:
-            db.rollback()
-            logger.error(f"Database commit failed: {str(commit_error)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Database commit failed: {str(commit_error)}"
-            )
+    except ExcelFormatError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
 
-        return {
-            "message": "Excel processed successfully",
-            "added_items": added_items,
-            "skipped_rows": skipped_rows,
-            "summary": {
-                "total_processed": len(added_items) + len(skipped_rows),
-                "successful": len(added_items),
-                "skipped": len(skipped_rows)
-            }
-        }
+    except HTTPException:
+        raise
 
     except Exception as e:
         # Enhanced error handling
@@ -1025,186 +3469,277 @@ async def upload_inventory_excel(file: UploadFile = File(...), db: Session = Dep
 
         raise HTTPException(status_code=500, detail=error_msg)
 
+    finally:
+        os.remove(path)
 
-@app.post("/upload_dish_excel")
-async def upload_dish_excel(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    if not file.filename.endswith((".xlsx", ".xls")):
-        raise HTTPException(status_code=400, detail="Please upload a valid Excel file (.xlsx or .xls)")
-
-    try:
-        contents = await file.read()
-        workbook = load_workbook(filename=BytesIO(contents))
-        sheet = workbook.active
 
-        headers = [str(cell.value).strip() if cell.value else "" for cell in sheet[1]]
+def import_dish_workbook(db: Session, path: str, progress=None) -> dict:
+    """Stream a recipe workbook into the database, committing every INGEST_CHUNK_SIZE rows"""
+    with open_excel_rows(path) as (headers, rows):
         required_columns = {"name", "type", "ingredient_name", "quantity_required"}
 
         missing_required = required_columns - set(headers)
         if missing_required:
-            return JSONResponse(status_code=400, content={
-                "error": f"Missing required columns: {', '.join(missing_required)}. Found: {headers}"
-            })
+            raise ExcelFormatError(f"Missing required columns: {', '.join(missing_required)}. Found: {headers}")
 
         col_index = {key: headers.index(key) for key in required_columns}
 
-        dishes_map = {}  # Temporary cache to hold dishes before commit
+        dish_type_ids = {}  # Cache of dish type name -> id across chunks
+        dishes_map = {}  # Cache of (dish name, type id) -> dish id across chunks
         added_dishes = []
         skipped_rows = []
+        chunks = []
+        rows_read = 0
+
+        for chunk_number, chunk in enumerate(chunked(rows, INGEST_CHUNK_SIZE), start=1):
+            rows_read += len(chunk)
+
+            def write_chunk(db: Session) -> dict:
+                # Works on copies of the caches, so a chunk that is rolled back leaves no ids behind
+                written = {
+                    "dish_type_ids": dict(dish_type_ids),
+                    "dishes_map": dict(dishes_map),
+                    "added_dishes": [],
+                    "skipped_rows": [],
+                    "ingredients": 0
+                }
+                chunk_dish_ids = set()
+
+                for idx, row in chunk:
+                    try:
+                        if all(cell is None for cell in row):
+                            continue  # Skip empty rows
+
+                        dish_name = str(row[col_index["name"]]).strip()
+                        dish_type = str(row[col_index["type"]]).strip()
+                        ingredient_name = str(row[col_index["ingredient_name"]]).strip()
+                        quantity_required = float(row[col_index["quantity_required"]])
+
+                        # Fetch or create DishType
+                        type_ids = written["dish_type_ids"]
+                        if dish_type not in type_ids:
+                            dish_type_obj = db.query(DishType).filter_by(name=dish_type).first()
+                            if not dish_type_obj:
+                                dish_type_obj = DishType(name=dish_type)
+                                db.add(dish_type_obj)
+                                db.flush()  # To assign an ID
+                            type_ids[dish_type] = dish_type_obj.id
+                        dish_type_id = type_ids[dish_type]
+
+                        # Unique key for dish mapping
+                        dish_key = (dish_name, dish_type_id)
+                        dish_ids = written["dishes_map"]
+                        if dish_key not in dish_ids:
+                            dish = db.query(Dish).filter_by(name=dish_name, type_id=dish_type_id).first()
+                            if not dish:
+                                dish = Dish(name=dish_name, type_id=dish_type_id)
+                                db.add(dish)
+                                db.flush()  # Assign ID
+                                written["added_dishes"].append(dish_name)
+                            dish_ids[dish_key] = dish.id
+
+                        # Add ingredient
+                        db.add(DishIngredient(
+                            dish_id=dish_ids[dish_key],
+                            ingredient_name=ingredient_name,
+                            quantity_required=quantity_required
+                        ))
+                        chunk_dish_ids.add(dish_ids[dish_key])
+                        written["ingredients"] += 1
+
+                    except Exception as row_error:
+                        written["skipped_rows"].append(f"Row {idx}: {str(row_error)}")
+
+                refresh_dish_costs(db, chunk_dish_ids)
+                return written
+
+            written = run_write(db, write_chunk)
+            dish_type_ids = written["dish_type_ids"]
+            dishes_map = written["dishes_map"]
+            added_dishes.extend(written["added_dishes"])
+            skipped_rows.extend(written["skipped_rows"])
+            chunk_ingredients = written["ingredients"]
+            chunk_skipped = len(written["skipped_rows"])
+
+            report_chunk_progress(chunks, {
+                "chunk": chunk_number,
+                "rows_read": rows_read,
+                "ingredients_added": chunk_ingredients,
+                "skipped": chunk_skipped
+            }, progress)
 
-        for idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
-            try:
-                if not row or all(cell is None for cell in row):
-                    continue  # Skip empty rows
+    return {
+        "message": "Dishes uploaded successfully",
+        "added_dishes": list(set(added_dishes)),
+        "skipped_rows": skipped_rows,
+        "chunks": chunks
+    }
 
-                dish_name = str(row[col_index["name"]]).strip()
-                dish_type = str(row[col_index["type"]]).strip()
-                ingredient_name = str(row[col_index["ingredient_name"]]).strip()
-                quantity_required = float(row[col_index["quantity_required"]])
-
-                # Fetch or create DishType
-                dish_type_obj = db.query(DishType).filter_by(name=dish_type).first()
-                if not dish_type_obj:
-                    dish_type_obj = DishType(name=dish_type)
-                    db.add(dish_type_obj)
-                    db.flush()  # To assign an ID
-
-                # Unique key for dish mapping
-                dish_key = (dish_name, dish_type_obj.id)
-                if dish_key not in dishes_map:
-                    dish = db.query(Dish).filter_by(name=dish_name, type_id=dish_type_obj.id).first()
-                    if not dish:
-                        dish = Dish(name=dish_name, type_id=dish_type_obj.id)
-                        db.add(dish)
-                        db.flush()  # Assign ID
-                        added_dishes.append(dish_name)
-                    dishes_map[dish_key] = dish
-                else:
-                    dish = dishes_map[dish_key]
-
-                # Add ingredient
-                dish_ingredient = DishIngredient(
-                    dish_id=dish.id,
-                    ingredient_name=ingredient_name,
-                    quantity_required=quantity_required
-                )
-                db.add(dish_ingredient)
 
-            except Exception as row_error:
-                skipped_rows.append(f"Row {idx}: {str(row_error)}")
+@app.post("/upload_dish_excel")
+def upload_dish_excel(
+        file: UploadFile = File(...),
+        background: bool = Query(False, description="Queue the import and poll /jobs/{id} instead of waiting"),
+        db: Session = Depends(get_db)
+):
+    if not file.filename.endswith((".xlsx", ".xls")):
+        raise HTTPException(status_code=400, detail="Please upload a valid Excel file (.xlsx or .xls)")
+
+    if background:
+        return submit_import_job(db, "dishes", file, import_dish_workbook)
 
-        db.commit()
+    path = spool_upload(file)
+    try:
+        return import_dish_workbook(db, path)
 
-        return {
-            "message": "Dishes uploaded successfully",
-            "added_dishes": list(set(added_dishes)),
-            "skipped_rows": skipped_rows
-        }
+    except ExcelFormatError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
 
     except Exception as e:
         import traceback
         traceback.print_exc()
+        db.rollback()
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+    finally:
+        os.remove(path)
+
 
 @app.post("/add_dish")
 def add_dish(request: AddDishRequest, db: Session = Depends(get_db)):
-    # Check if dish with same name exists
-    existing_dish = db.query(Dish).filter(Dish.name == request.name).first()
-    if existing_dish:
-        raise HTTPException(status_code=400, detail="Dish with this name already exists.")
-
-    # Get or create DishType
-    dish_type = db.query(DishType).filter(DishType.name == request.type).first()
-    if not dish_type:
-        dish_type = DishType(name=request.type)
-        db.add(dish_type)
-        db.commit()
-        db.refresh(dish_type)
-
-    # Create new dish
-    new_dish = Dish(name=request.name, type_id=dish_type.id)
-    db.add(new_dish)
-    db.commit()
-    db.refresh(new_dish)
-
-    # Process ingredients
-    for ing in request.ingredients:
-        #inventory_item = db.query(Inventory).filter(Inventory.name == ing.name).first()
-        #if not inventory_item:
-            #raise HTTPException(status_code=404, detail=f"Ingredient '{ing.name}' not found in inventory.")
-
-        dish_ingredient = DishIngredient(
-            dish_id=new_dish.id,
-            #ingredient_name=inventory_item.name,
-            ingredient_name=ing.name,
-            quantity_required=ing.quantity_required
-        )
-        db.add(dish_ingredient)
+    def write_dish(db: Session) -> dict:
+        # Check if dish with same name exists
+        existing_dish = db.query(Dish).filter(Dish.name == request.name).first()
+        if existing_dish:
+            raise HTTPException(status_code=400, detail="Dish with this name already exists.")
+
+        # Get or create DishType
+        dish_type = db.query(DishType).filter(DishType.name == request.type).first()
+        if not dish_type:
+            dish_type = DishType(name=request.type)
+            db.add(dish_type)
+            db.flush()  # Assign ID
+
+        # Create new dish
+        new_dish = Dish(name=request.name, type_id=dish_type.id)
+        db.add(new_dish)
+        db.flush()  # Assign ID
+
+        # Process ingredients
+        for ing in request.ingredients:
+            #inventory_item = db.query(Inventory).filter(Inventory.name == ing.name).first()
+            #if not inventory_item:
+                #raise HTTPException(status_code=404, detail=f"Ingredient '{ing.name}' not found in inventory.")
+
+            dish_ingredient = DishIngredient(
+                dish_id=new_dish.id,
+                #ingredient_name=inventory_item.name,
+                ingredient_name=ing.name,
+                quantity_required=ing.quantity_required
+            )
+            db.add(dish_ingredient)
+
+        refresh_dish_costs(db, {new_dish.id})
+        return {"message": f"Dish '{request.name}' added successfully with ingredients."}
+
+    return run_write(db, write_dish)
+
+# --- Dish Catalog Cache ---
+# Serialized /dishes payload, reloaded when a catalog table's version moves on (see CATALOG_TABLES)
+dish_catalog_cache = {
+    "loaded_version": None,
+    "dishes": [],
+    "payload": b"[]"
+}
+dish_catalog_lock = threading.Lock()
+
+
+def dish_catalog_version() -> int:
+    """Sum of the catalog tables' versions, so it moves on with every committed catalog change"""
+    return sum(table_versions(CATALOG_TABLES))
+
+
+def load_dish_catalog(db: Session) -> dict:
+    """Return the cached catalog, reloading it with two set-based queries when stale"""
+    # Read the version before the rows, so the cached rows are never older than their version
+    version = dish_catalog_version()
+    catalog = cached_dish_catalog(version)
+    if catalog is not None:
+        return catalog
+
+    dishes_statement, ingredients_statement = dish_catalog_statements()
+    return cache_dish_catalog(version, db.execute(dishes_statement).all(), db.execute(ingredients_statement).all())
+
+
+def cached_dish_catalog(version: int) -> Optional[dict]:
+    with dish_catalog_lock:
+        if dish_catalog_cache["loaded_version"] == version:
+            return {"dishes": dish_catalog_cache["dishes"], "payload": dish_catalog_cache["payload"]}
+    return None
+
+
+def dish_catalog_statements() -> tuple:
+    """SELECTs for the catalog's dishes (id, name, type name) and ingredients (dish id, name, quantity)"""
+    dishes = select(Dish.id, Dish.name, DishType.name).outerjoin(
+        DishType, DishType.id == Dish.type_id
+    ).order_by(Dish.id)
+    ingredients = select(
+        DishIngredient.dish_id, DishIngredient.ingredient_name, DishIngredient.quantity_required
+    ).order_by(DishIngredient.id)
+    return dishes, ingredients
+
+
+def cache_dish_catalog(version: int, dish_rows: list, ingredient_rows: list) -> dict:
+    """Build the catalog and its JSON payload from the rows of dish_catalog_statements() and cache it"""
+    ingredients_by_dish = defaultdict(list)
+    for dish_id, ingredient_name, quantity_required in ingredient_rows:
+        # Unnamed ingredients were always left out of /dishes. /dishes/by_name used to pass them to
+        # DishIngredientOut, whose ingredient_name is required, and failed the whole response with a 500
+        if ingredient_name is None:
+            continue
+        ingredients_by_dish[dish_id].append({
+            "ingredient_name": ingredient_name,
+            "quantity_required": quantity_required,
+            "unit": "gm"
+        })
+
+    dishes = [
+        {
+            "id": dish_id,
+            "name": dish_name,
+            "type": type_name if type_name else "Unknown",
+            "ingredients": ingredients_by_dish[dish_id]
+        }
+        for dish_id, dish_name, type_name in dish_rows
+    ]
 
-    db.commit()
-    return {"message": f"Dish '{request.name}' added successfully with ingredients."}
+    catalog = {"dishes": dishes, "payload": json.dumps(dishes).encode("utf-8")}
 
-@app.get("/dishes", response_model=List[DishOut])
-def list_dishes(db: Session = Depends(get_db)):
-    dishes = db.query(Dish).all()
-    result = []
-
-    for dish in dishes:
-        # Get the dish type name
-        dish_type = db.query(DishType).filter(DishType.id == dish.type_id).first()
-
-        # Get all ingredients for this dish
-        ingredients = db.query(DishIngredient).filter(DishIngredient.dish_id == dish.id).all()
-
-        # Convert DishIngredient DB entries to response models
-        ingredient_list = [
-            DishIngredientOut(
-                ingredient_name=di.ingredient_name,
-                quantity_required=di.quantity_required
-            ) for di in ingredients if di.ingredient_name is not None
-        ]
+    with dish_catalog_lock:
+        dish_catalog_cache.update(catalog, loaded_version=version)
 
-        # Append formatted dish to result
-        result.append(DishOut(
-            id=dish.id,
-            name=dish.name,
-            type=dish_type.name if dish_type else "Unknown",
-            ingredients=ingredient_list
-        ))
+    return catalog
+
+
+@app.get("/dishes", response_model=List[DishOut])
+def list_dishes(request: Request, db: Session = Depends(get_db)):
+    etag = table_etag(*CATALOG_TABLES)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
 
-    return result
+    catalog = load_dish_catalog(db)
+    return Response(content=catalog["payload"], media_type="application/json", headers=etag_headers(etag))
 
 
 @app.get("/dishes/by_name", response_model=List[DishOut])
 def search_dishes_by_name(partial_name: str, db: Session = Depends(get_db)):
-    matched_dishes = db.query(Dish).filter(
-        Dish.name.ilike(f"%{partial_name}%")
-    ).all()
+    search = partial_name.lower()
+    matched_dishes = [dish for dish in load_dish_catalog(db)["dishes"] if search in dish["name"].lower()]
 
     if not matched_dishes:
         raise HTTPException(status_code=404, detail="No matching dishes found")
 
-    result = []
-    for dish in matched_dishes:
-        dish_type = db.query(DishType).filter(DishType.id == dish.type_id).first()
-        ingredients = db.query(DishIngredient).filter(DishIngredient.dish_id == dish.id).all()
-
-        ingredient_list = [
-            DishIngredientOut(
-                ingredient_name=di.ingredient_name,
-                quantity_required=di.quantity_required
-            )
-            for di in ingredients
-        ]
-
-        result.append(DishOut(
-            id=dish.id,
-            name=dish.name,
-            type=dish_type.name if dish_type else "Unknown",
-            ingredients=ingredient_list
-        ))
-
-    return result
+    return matched_dishes
 
 @app.delete("/dishes/{dish_name}")
 def delete_dish_by_name(
@@ -1212,115 +3747,560 @@ def delete_dish_by_name(
     confirm: bool = Query(False, description="Set to true to confirm deletion"),
     db: Session = Depends(get_db)
 ):
-    dish = db.query(Dish).filter(Dish.name.ilike(dish_name)).first()
-    if not dish:
-        raise HTTPException(status_code=404, detail="Dish not found")
+    def write_delete(db: Session) -> dict:
+        dish = db.query(Dish).filter(Dish.name.ilike(dish_name)).first()
+        if not dish:
+            raise HTTPException(status_code=404, detail="Dish not found")
 
-    if not confirm:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Deletion not confirmed. To delete dish '{dish.name}', set confirm=true."
-        )
+        if not confirm:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Deletion not confirmed. To delete dish '{dish.name}', set confirm=true."
+            )
+
+        db.query(DishIngredient).filter(DishIngredient.dish_id == dish.id).delete()
+        db.query(DishCost).filter(DishCost.dish_id == dish.id).delete()
+        db.delete(dish)
+        return {"message": f"Dish '{dish.name}' deleted successfully"}
 
-    db.query(DishIngredient).filter(DishIngredient.dish_id == dish.id).delete()
-    db.delete(dish)
-    db.commit()
-    return {"message": f"Dish '{dish.name}' deleted successfully"}
+    return run_write(db, write_delete)
 
 @app.get("/dish_types")
-def get_dish_types(db: Session = Depends(get_db)):
-    dish_types = db.query(DishType).all()
-    return [dt.name for dt in dish_types]
+def get_dish_types(request: Request, db: Session = Depends(get_db)):
+    etag = table_etag("dish_types")
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    dish_types = db.query(DishType.name).all()
+    return JSONResponse(content=[name for name, in dish_types], headers=etag_headers(etag))
+
+
+# --- Dish Costing ---
+# Latest price of every ingredient, loaded with one windowed query and cached until the next
+# committed inventory write moves the inventory table's version on.
+ingredient_price_cache = {
+    "loaded_version": None,
+    "prices": {}
+}
+ingredient_price_lock = threading.Lock()
+
+
+def query_latest_prices(db: Session, name_keys=None) -> dict:
+    """One ROW_NUMBER() query for the newest batch of every ingredient, or of the given name keys"""
+    newest_first = func.row_number().over(
+        partition_by=Inventory.name_key,
+        order_by=(Inventory.date_added.desc(), Inventory.id.desc())
+    ).label("newest_first")
+    batches = db.query(Inventory.name_key, Inventory.price_per_unit, Inventory.unit, newest_first)
+    if name_keys is not None:
+        batches = batches.filter(Inventory.name_key.in_(name_keys))
+    batches = batches.subquery()
 
+    return {
+        name_key: (price_per_unit or 0.0, unit)
+        for name_key, price_per_unit, unit in db.query(
+            batches.c.name_key, batches.c.price_per_unit, batches.c.unit
+        ).filter(batches.c.newest_first == 1).all()
+    }
 
-@app.get("/dishes/{dish_id}/cost")
-def get_dish_cost(dish_id: int, db: Session = Depends(get_db)):
-    dish = db.query(Dish).filter(Dish.id == dish_id).first()
-    if not dish:
-        raise HTTPException(status_code=404, detail="Dish not found")
 
-    ingredients = db.query(DishIngredient).filter(DishIngredient.dish_id == dish.id).all()
-    total_cost = 0.0
-    ingredient_costs = []
+def latest_ingredient_prices(db: Session) -> dict:
+    """{name_key: (price_per_unit, unit)} of the most recently added batch of every ingredient"""
+    version = table_versions(("inventory",))
+    with ingredient_price_lock:
+        if ingredient_price_cache["loaded_version"] == version:
+            return ingredient_price_cache["prices"]
 
-    for di in ingredients:
-        # Get the most recent inventory item for this ingredient
-        inventory_item = db.query(Inventory).filter(
-            Inventory.name.ilike(di.ingredient_name)
-        ).order_by(Inventory.date_added.desc()).first()
+    prices = query_latest_prices(db)
 
-        if not inventory_item:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Ingredient '{di.ingredient_name}' not found in inventory"
-            )
+    with ingredient_price_lock:
+        ingredient_price_cache.update(prices=prices, loaded_version=version)
 
-        item_cost = di.quantity_required * inventory_item.price_per_unit
+    return prices
+
+
+def cost_dish_ingredients(ingredients, prices: dict) -> dict:
+    """Cost one dish's (ingredient_name, quantity_required, unit) rows against the latest prices"""
+    total_cost = 0.0
+    ingredient_costs = []
+    missing = []
+
+    for ingredient_name, quantity_required, unit in ingredients:
+        latest = prices.get(normalize_name_key(ingredient_name))
+        if latest is None:
+            missing.append(ingredient_name)
+            continue
+
+        price_per_unit, inventory_unit = latest
+        recipe_unit = (unit or 'gm').strip().lower()
+        # Prices are per inventory unit, so the recipe quantity is converted into it first
+        quantity = convert_to_base_unit(quantity_required or 0.0, recipe_unit, inventory_unit or recipe_unit,
+                                        ingredient_name)
+        item_cost = quantity * price_per_unit
         total_cost += item_cost
 
         ingredient_costs.append({
-            "ingredient": di.ingredient_name,
-            "quantity_required": di.quantity_required,
-            "unit_price": inventory_item.price_per_unit,
+            "ingredient": ingredient_name,
+            "quantity_required": quantity_required,
+            "unit": recipe_unit,
+            "unit_price": price_per_unit,
+            "price_unit": inventory_unit,
             "total_cost": item_cost
         })
 
     return {
-        "dish_id": dish.id,
-        "dish_name": dish.name,
         "ingredient_breakdown": ingredient_costs,
+        "missing_ingredients": missing,
         "total_cost": round(total_cost, 2)
     }
 
 
-@app.put("/dishes/{dish_id}")
-def update_dish(dish_id: int, payload: DishUpdate, db: Session = Depends(get_db)):
+# --- Dish Cost Table ---
+# dish_cost keeps the cost of one serving of every dish at the latest prices. dish_ingredients.name_key
+# is the inverted index from an ingredient to the dishes using it, so a price change recomputes only
+# those dishes, in the caller's transaction; recipe changes recompute their own dish. Each dish's row
+# is locked before it is costed, so concurrent price or recipe changes for it are costed one at a time.
+
+def aggregate_dish_costs(db: Session, dish_ids=None) -> dict:
+    """Cost the given dishes (or all of them) as {dish_id: (total_cost, missing_ingredients)}"""
+    query = db.query(Dish.id)
+    if dish_ids is not None:
+        query = query.filter(Dish.id.in_(dish_ids))
+    ingredients_by_dish = {dish_id: [] for dish_id, in query.all()}
+
+    ingredient_query = db.query(
+        DishIngredient.dish_id, DishIngredient.ingredient_name, DishIngredient.quantity_required, DishIngredient.unit
+    ).filter(DishIngredient.ingredient_name.isnot(None))
+    if dish_ids is not None:
+        ingredient_query = ingredient_query.filter(DishIngredient.dish_id.in_(dish_ids))
+    for dish_id, ingredient_name, quantity_required, unit in ingredient_query.order_by(DishIngredient.id).all():
+        if dish_id in ingredients_by_dish:
+            ingredients_by_dish[dish_id].append((ingredient_name, quantity_required, unit))
+
+    if dish_ids is None:
+        prices = query_latest_prices(db)
+    else:
+        prices = {}
+        name_keys = {
+            normalize_name_key(name) for ingredients in ingredients_by_dish.values() for name, _, _ in ingredients
+        }
+        for keys in chunked(name_keys, 500):
+            prices.update(query_latest_prices(db, keys))
+
+    costs = {}
+    for dish_id, ingredients in ingredients_by_dish.items():
+        costing = cost_dish_ingredients(ingredients, prices)
+        costs[dish_id] = (costing["total_cost"], len(costing["missing_ingredients"]))
+    return costs
+
+
+def refresh_dish_costs(db: Session, dish_ids):
+    """Recompute the cost rows of the given dishes in the caller's transaction"""
+    dish_ids = {dish_id for dish_id in dish_ids if dish_id is not None}
+    if not dish_ids:
+        return
+
+    db.flush()  # Make pending inventory and recipe changes visible to the queries
+
+    now = datetime.utcnow()
+    for ids in chunked(sorted(dish_ids), 500):
+        insert_missing_rows(db, DishCost, [
+            {"dish_id": dish_id, "total_cost": None, "missing_ingredients": None, "updated_at": now}
+            for dish_id, in db.query(Dish.id).filter(Dish.id.in_(ids)).order_by(Dish.id)
+        ])
+        existing = {
+            dish_id: (total_cost, missing)
+            for dish_id, total_cost, missing in db.query(
+                DishCost.dish_id, DishCost.total_cost, DishCost.missing_ingredients
+            ).filter(DishCost.dish_id.in_(ids)).order_by(DishCost.dish_id).with_for_update().all()
+        }
+        fresh = aggregate_dish_costs(db, ids)
+
+        # A dish only in `fresh` was added by a transaction that committed after the lock and costed it itself
+        updates = [
+            {"dish_id": dish_id, "total_cost": fresh[dish_id][0], "missing_ingredients": fresh[dish_id][1],
+             "updated_at": now}
+            for dish_id, stored in existing.items()
+            if dish_id in fresh and stored != fresh[dish_id]  # Unchanged costs are left alone
+        ]
+        deletes = [dish_id for dish_id in existing if dish_id not in fresh]
+
+        if deletes:
+            db.query(DishCost).filter(DishCost.dish_id.in_(deletes)).delete(synchronize_session=False)
+        db.bulk_update_mappings(DishCost, updates)
+
+
+def dishes_using_ingredients(db: Session, name_keys) -> set:
+    """Ids of the dishes whose recipes use any of the given name keys"""
+    name_keys = {key for key in name_keys if key}
+    dish_ids = set()
+    for keys in chunked(name_keys, 500):
+        dish_ids.update(dish_id for dish_id, in db.query(DishIngredient.dish_id).filter(
+            DishIngredient.name_key.in_(keys)
+        ).distinct())
+    return dish_ids
+
+
+def propagate_price_changes(db: Session, name_keys):
+    """Recompute the cost of every dish using an ingredient whose batches were added, edited or removed"""
+    db.flush()  # Recipes added earlier in the transaction have to be found too
+    refresh_dish_costs(db, dishes_using_ingredients(db, name_keys))
+
+
+def check_dish_costs(db: Session) -> List[dict]:
+    """Compare every cost row against a fresh costing of the recipes and return the mismatches"""
+    expected = aggregate_dish_costs(db)
+    actual = {
+        dish_id: (total_cost, missing)
+        for dish_id, total_cost, missing in db.query(
+            DishCost.dish_id, DishCost.total_cost, DishCost.missing_ingredients
+        ).all()
+    }
+
+    mismatches = []
+    for dish_id in set(expected) | set(actual):
+        fresh = expected.get(dish_id)
+        stored = actual.get(dish_id)
+        if fresh is not None and stored is not None and fresh[1] == stored[1] and \
+                abs((fresh[0] or 0.0) - (stored[0] or 0.0)) < 0.01:
+            continue
+        mismatches.append({
+            "dish_id": dish_id,
+            "fresh": {"total_cost": fresh[0], "missing_ingredients": fresh[1]} if fresh else None,
+            "stored": {"total_cost": stored[0], "missing_ingredients": stored[1]} if stored else None
+        })
+
+    return mismatches
+
+
+def rebuild_dish_costs(db: Session) -> int:
+    """Recompute the whole dish_cost table from recipes and inventory, the caller commits"""
+    db.query(DishCost).delete(synchronize_session=False)
+    now = datetime.utcnow()
+    rows = [
+        {"dish_id": dish_id, "total_cost": total_cost, "missing_ingredients": missing, "updated_at": now}
+        for dish_id, (total_cost, missing) in aggregate_dish_costs(db).items()
+    ]
+    db.bulk_insert_mappings(DishCost, rows)
+    return len(rows)
+
+
+@app.get("/menu/costs")
+def menu_costs(request: Request, db: Session = Depends(get_db)):
+    """Precomputed cost of one serving of every dish, read straight from dish_cost"""
+    etag = table_etag("dish_cost", "dishes", "dish_types")
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    dishes = [
+        {
+            "dish_id": dish_id,
+            "dish_name": dish_name,
+            "type": type_name if type_name else "Unknown",
+            "total_cost": total_cost,
+            "missing_ingredients": missing,
+            "updated_at": updated_at.strftime("%Y-%m-%d %H:%M:%S") if updated_at else None
+        }
+        for dish_id, dish_name, type_name, total_cost, missing, updated_at in db.query(
+            Dish.id, Dish.name, DishType.name, DishCost.total_cost, DishCost.missing_ingredients, DishCost.updated_at
+        ).join(DishCost, DishCost.dish_id == Dish.id).outerjoin(
+            DishType, DishType.id == Dish.type_id
+        ).order_by(Dish.id).all()
+    ]
+
+    return JSONResponse(
+        content={"total_dishes": len(dishes), "dishes": dishes},
+        headers=etag_headers(etag)
+    )
+
+
+@app.get("/dishes/costs")
+def get_dish_costs(
+        dish_ids: Optional[List[int]] = Query(None, description="Only cost these dishes"),
+        name: Optional[str] = Query(None, description="Only cost dishes whose name contains this"),
+        type: Optional[str] = Query(None, description="Only cost dishes of this type"),
+        db: Session = Depends(get_db)
+):
+    """Cost every dish (or the filtered ones) in one pass against the latest ingredient prices"""
+    prices = latest_ingredient_prices(db)
+
+    dish_query = db.query(Dish.id, Dish.name, DishType.name).outerjoin(DishType, DishType.id == Dish.type_id)
+    if dish_ids:
+        dish_query = dish_query.filter(Dish.id.in_(dish_ids))
+    if name:
+        dish_query = dish_query.filter(Dish.name.ilike(f"%{name.strip()}%"))
+    if type:
+        dish_query = dish_query.filter(DishType.name.ilike(type.strip()))
+    dish_rows = dish_query.order_by(Dish.id).all()
+
+    ingredients_by_dish = defaultdict(list)
+    for ids in chunked([dish_id for dish_id, _, _ in dish_rows], 500):
+        for dish_id, ingredient_name, quantity_required, unit in db.query(
+                DishIngredient.dish_id, DishIngredient.ingredient_name, DishIngredient.quantity_required,
+                DishIngredient.unit
+        ).filter(DishIngredient.dish_id.in_(ids)).order_by(DishIngredient.id).all():
+            if ingredient_name is not None:
+                ingredients_by_dish[dish_id].append((ingredient_name, quantity_required, unit))
+
+    dishes = [
+        {
+            "dish_id": dish_id,
+            "dish_name": dish_name,
+            "type": type_name if type_name else "Unknown",
+            **cost_dish_ingredients(ingredients_by_dish[dish_id], prices)
+        }
+        for dish_id, dish_name, type_name in dish_rows
+    ]
+
+    return {
+        "total_dishes": len(dishes),
+        "fully_costed": sum(1 for dish in dishes if not dish["missing_ingredients"]),
+        "dishes": dishes
+    }
+
+
+@app.get("/dishes/{dish_id}/cost")
+def get_dish_cost(dish_id: int, db: Session = Depends(get_db)):
     dish = db.query(Dish).filter(Dish.id == dish_id).first()
     if not dish:
         raise HTTPException(status_code=404, detail="Dish not found")
 
-    # Update dish name and type
-    dish.name = payload.name
+    ingredients = db.query(
+        DishIngredient.ingredient_name, DishIngredient.quantity_required, DishIngredient.unit
+    ).filter(DishIngredient.dish_id == dish.id).order_by(DishIngredient.id).all()
+    costing = cost_dish_ingredients(ingredients, latest_ingredient_prices(db))
 
-    # Lookup dish type
-    dish_type = db.query(DishType).filter(DishType.name.ilike(payload.type)).first()
-    if not dish_type:
-        dish_type = DishType(name=payload.type)
-        db.add(dish_type)
-        db.commit()
-        db.refresh(dish_type)
+    if costing["missing_ingredients"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Ingredient '{costing['missing_ingredients'][0]}' not found in inventory"
+        )
+
+    return {
+        "dish_id": dish.id,
+        "dish_name": dish.name,
+        "ingredient_breakdown": costing["ingredient_breakdown"],
+        "total_cost": costing["total_cost"]
+    }
 
-    dish.type_id = dish_type.id
-    db.commit()
 
-    dish_ingredients = db.query(DishIngredient).filter(DishIngredient.dish_id == dish.id).all()
+@app.put("/dishes/{dish_id}")
+def update_dish(dish_id: int, payload: DishUpdate, db: Session = Depends(get_db)):
+    def write_dish(db: Session) -> dict:
+        dish = db.query(Dish).filter(Dish.id == dish_id).first()
+        if not dish:
+            raise HTTPException(status_code=404, detail="Dish not found")
 
-    # Update ingredients: map by name for easy comparison
-    existing_ingredients = {di.ingredient_name.lower(): di for di in dish_ingredients}
-    updated_names = {ing.ingredient_name.lower() for ing in payload.ingredients}
+        # Update dish name and type
+        dish.name = payload.name
 
-    for ing in payload.ingredients:
-        key = ing.ingredient_name.lower()
-        if key in existing_ingredients:
-            existing_ingredients[key].quantity_required = ing.quantity_required
-        else:
-            db.add(DishIngredient(
-                dish_id=dish.id,
-                ingredient_name=ing.ingredient_name,
-                quantity_required=ing.quantity_required
-            ))
+        # Lookup dish type
+        dish_type = db.query(DishType).filter(DishType.name.ilike(payload.type)).first()
+        if not dish_type:
+            dish_type = DishType(name=payload.type)
+            db.add(dish_type)
+            db.flush()  # Assign ID
+
+        dish.type_id = dish_type.id
+
+        dish_ingredients = db.query(DishIngredient).filter(DishIngredient.dish_id == dish.id).all()
+
+        # Update ingredients: map by name for easy comparison
+        existing_ingredients = {di.ingredient_name.lower(): di for di in dish_ingredients}
+        updated_names = {ing.ingredient_name.lower() for ing in payload.ingredients}
+
+        for ing in payload.ingredients:
+            key = ing.ingredient_name.lower()
+            if key in existing_ingredients:
+                existing_ingredients[key].quantity_required = ing.quantity_required
+            else:
+                db.add(DishIngredient(
+                    dish_id=dish.id,
+                    ingredient_name=ing.ingredient_name,
+                    quantity_required=ing.quantity_required
+                ))
+
+        # Delete ingredients no longer in request
+
+        for key, di in existing_ingredients.items():
+            if key not in updated_names:
+                db.delete(di)
+
+        refresh_dish_costs(db, {dish.id})
+        return {"message": "Dish updated successfully"}
+
+    return run_write(db, write_dish)
+
+
+# --- FIFO Allocation Engine ---
+
+# Stock deductions are optimistic: batches are read without locks, planned in memory and written
+# with a version check (see Inventory.version). When another worker changed a batch in between,
+# the whole deduction is rolled back and planned again from fresh rows, a bounded number of times.
+STOCK_CONFLICT_RETRIES = int(os.getenv("STOCK_CONFLICT_RETRIES", "5"))
+STOCK_CONFLICT_BACKOFF_SECONDS = float(os.getenv("STOCK_CONFLICT_BACKOFF_SECONDS", "0.02"))
+
+stock_conflict_stats = {"retried": 0, "gave_up": 0}
+
+
+class StockConflictError(HTTPException):
+    def __init__(self, attempts: int):
+        super().__init__(
+            status_code=409,
+            detail=f"Inventory kept changing while this was being prepared ({attempts} attempts). Please retry."
+        )
+
+
+def retry_stock_conflicts(db: Session, attempt):
+    """Run attempt() (which commits) until its batch writes no longer race another transaction"""
+    for attempt_number in range(1, STOCK_CONFLICT_RETRIES + 1):
+        try:
+            return attempt()
+        except StaleDataError:
+            db.rollback()  # Expires every loaded batch, so the next attempt plans against fresh rows
+            if attempt_number == STOCK_CONFLICT_RETRIES:
+                stock_conflict_stats["gave_up"] += 1
+                raise StockConflictError(attempt_number)
+            stock_conflict_stats["retried"] += 1
+            logger.debug(f"Stock conflict, retrying deduction (attempt {attempt_number + 1})")
+            # Jittered backoff, so the transactions that collided don't collide again in lockstep
+            time.sleep(random.uniform(0, STOCK_CONFLICT_BACKOFF_SECONDS * attempt_number))
+
+
+@app.exception_handler(StaleDataError)
+def stale_data_handler(request: Request, exc: StaleDataError):
+    """A batch changed by another request between reading and writing it"""
+    return JSONResponse(
+        status_code=409,
+        content={"detail": "This item was changed by another request. Reload it and try again."}
+    )
+
+
+def lock_inventory_for_update(db: Session):
+    """Take the SQLite write lock up front, so no other writer commits between our reads and writes"""
+    if db.bind.dialect.name != "sqlite":
+        return  # PostgreSQL callers order themselves with the rows they lock
+
+    dbapi_connection = db.connection().connection
+    if not dbapi_connection.in_transaction:
+        db.execute(text("BEGIN IMMEDIATE"))
+
+
+def get_recipe_unit(ingredient: DishIngredient) -> str:
+    return (getattr(ingredient, 'unit', None) or 'gm').strip().lower()
+
+
+class FifoAllocator:
+    """Plans FIFO deductions against every candidate batch of a set of ingredients.
+
+    All batches are loaded in a single unlocked query, deductions are planned in memory and
+    written back with one flush by apply(). The flush checks every batch's version, so it raises
+    StaleDataError if another transaction changed one of them after it was loaded.
+    """
+
+    def __init__(self, db: Session, ingredient_names):
+        self.db = db
+        self.batches = defaultdict(list)
+        self.remaining = {}
+        self.allocations = []
+
+        keys = {self.key(name) for name in ingredient_names if name}
+        if not keys:
+            return
+
+        query = db.query(Inventory).filter(
+            Inventory.name_key.in_(keys),
+            Inventory.quantity > 0
+        ).order_by(Inventory.date_added.asc(), Inventory.id.asc())
+
+        for batch in query.all():
+            self.batches[batch.name_key].append(batch)
+            self.remaining[batch.id] = batch.quantity
+
+    @staticmethod
+    def key(ingredient_name: str) -> str:
+        return normalize_name_key(ingredient_name)
+
+    def has_batches(self, ingredient_name: str) -> bool:
+        return bool(self.batches.get(self.key(ingredient_name)))
 
-    # Delete ingredients no longer in request
+    def availability(self, ingredient_name: str, unit: str):
+        """Return (available in `unit`, total value, total quantity in batch units) of what is left"""
+        total_available = 0.0
+        total_value = 0.0
+        total_quantity = 0.0
+
+        for batch in self.batches.get(self.key(ingredient_name), []):
+            quantity = self.remaining[batch.id]
+            if quantity <= 0:
+                continue
+            total_available += convert_to_base_unit(quantity, batch.unit, unit, ingredient_name)
+            total_value += quantity * batch.price_per_unit
+            total_quantity += quantity
+
+        return total_available, total_value, total_quantity
+
+    def allocate(self, ingredient_name: str, required_qty: float, unit: str, prepare_date: Optional[datetime] = None):
+        """Plan FIFO deductions of required_qty (in `unit`), returns (allocations, shortfall)"""
+        remaining_required = required_qty
+        planned = []
+
+        for batch in self.batches.get(self.key(ingredient_name), []):
+            if remaining_required <= 0:
+                break
+
+            available = self.remaining[batch.id]
+            if available <= 0:
+                continue
+
+            batch_unit = batch.unit.strip().lower()
+            available_in_recipe_unit = convert_to_base_unit(available, batch_unit, unit, ingredient_name)
+            deduct_in_recipe_unit = min(available_in_recipe_unit, remaining_required)
+            deduct_in_batch_unit = convert_from_base_unit(deduct_in_recipe_unit, batch_unit, unit, ingredient_name)
+
+            self.remaining[batch.id] = max(0, available - deduct_in_batch_unit)
+
+            planned.append({
+                "ingredient_name": ingredient_name,
+                "batch": batch,
+                "batch_unit": batch_unit,
+                "recipe_unit": unit,
+                "deduct_in_batch_unit": deduct_in_batch_unit,
+                "deduct_in_recipe_unit": deduct_in_recipe_unit,
+                "remaining_in_batch": self.remaining[batch.id],
+                "prepare_date": prepare_date
+            })
+            remaining_required -= deduct_in_recipe_unit
+
+        self.allocations.extend(planned)
+        return planned, remaining_required
+
+    def apply(self, prepare_date: Optional[datetime] = None):
+        """Write the planned quantities back to the batches and bulk insert their logs"""
+        logs = []
+        for allocation in self.allocations:
+            batch = allocation["batch"]
+            batch.quantity = allocation["remaining_in_batch"]
+            logs.append({
+                "ingredient_id": batch.id,
+                "quantity_left": allocation["remaining_in_batch"],
+                "date": allocation["prepare_date"] or prepare_date
+            })
 
-    for key, di in existing_ingredients.items():
-        if key not in updated_names:
-            db.delete(di)
+        self.db.flush()
+        if logs:
+            self.db.bulk_insert_mappings(InventoryLog, logs)
+            refresh_ingredient_stock(self.db, {allocation["batch"].name_key for allocation in self.allocations})
+            record_inventory_changes(self.db, [allocation["batch"].id for allocation in self.allocations], "updated")
+            invalidate_inventory_snapshots(self.db, min(log["date"] for log in logs))
 
-    db.commit()
-    return {"message": "Dish updated successfully"}
+        applied = self.allocations
+        self.allocations = []
+        return applied
 
 
 @app.post("/prepare_dish")
+@idempotent
 def prepare_dish(
         dish_name: str = Query(..., description="Name of the dish to prepare"),
         quantity: float = Query(..., description="Number of servings"),
@@ -1350,209 +4330,391 @@ def prepare_dish(
     if not dish_ingredients:
         raise HTTPException(status_code=400, detail=f"No ingredients found for dish '{dish_name}'")
 
-    # Pre-flight check: verify all ingredients are available
+    # Plain values only: the write job may run on the SQLite writer thread, in a session of its own
+    stored_dish_name = dish.name
+    recipe = [
+        (ingredient.ingredient_name, ingredient.quantity_required, get_recipe_unit(ingredient))
+        for ingredient in dish_ingredients
+    ]
+
+    return run_write(
+        db, lambda session: prepare_dish_once(session, stored_dish_name, recipe, quantity, prepare_date),
+        retry_conflicts=True
+    )
+
+
+def prepare_dish_once(db: Session, dish_name: str, recipe, quantity: float, prepare_date: datetime) -> dict:
+    """One attempt at /prepare_dish: check, plan FIFO and write, run_write() commits.
+
+    `recipe` lists the dish's (ingredient name, quantity per serving, recipe unit).
+    """
+    ingredient_names = [ingredient_name for ingredient_name, _, _ in recipe]
+
+    # Pre-flight check against ingredient_stock, no batch is loaded unless every ingredient passes
+    stock = load_ingredient_stock(db, ingredient_names)
+
     availability_check = []
     total_cost = 0.0
 
-    for ingredient in dish_ingredients:
-        required_qty = ingredient.quantity_required * quantity
-        recipe_unit = getattr(ingredient, 'unit', 'gm').strip().lower()
-
-        # Get available inventory for this ingredient
-        inventory_batches = db.query(Inventory).filter(
-            Inventory.name.ilike(ingredient.ingredient_name),
-            Inventory.quantity > 0
-        ).order_by(Inventory.date_added.asc()).all()
+    for ingredient_name, quantity_required, recipe_unit in recipe:
+        required_qty = quantity_required * quantity
 
-        if not inventory_batches:
+        if not stock.get(normalize_name_key(ingredient_name)):
             raise HTTPException(
                 status_code=400,
-                detail=f"No inventory available for {ingredient.ingredient_name}"
+                detail=f"No inventory available for {ingredient_name}"
             )
 
-        # Calculate total available quantity with unit conversion
-        total_available = 0.0
-        cost_per_unit_avg = 0.0
-        total_value = 0.0
-
-        for batch in inventory_batches:
-            batch_unit = batch.unit.strip().lower()
-            converted_qty = convert_to_base_unit(batch.quantity, batch_unit, recipe_unit)
-            total_available += converted_qty
-            total_value += batch.quantity * batch.price_per_unit
+        total_available, total_value = stock_availability(stock, ingredient_name, recipe_unit)
 
         if total_available < required_qty:
             shortage = required_qty - total_available
             raise HTTPException(
                 status_code=400,
-                detail=f"Insufficient {ingredient.ingredient_name}: need {required_qty:.2f} {recipe_unit}, "
+                detail=f"Insufficient {ingredient_name}: need {required_qty:.2f} {recipe_unit}, "
                        f"available {total_available:.2f} {recipe_unit}, short by {shortage:.2f} {recipe_unit}"
             )
 
-        # Calculate average cost per unit
-        if total_available > 0:
-            cost_per_unit_avg = total_value / sum(b.quantity for b in inventory_batches)
-            total_cost += required_qty * cost_per_unit_avg
+        # Calculate average cost per recipe unit
+        cost_per_unit_avg = total_value / total_available if total_available > 0 else 0.0
+        total_cost += required_qty * cost_per_unit_avg
 
         availability_check.append({
-            "ingredient": ingredient.ingredient_name,
+            "ingredient": ingredient_name,
             "required": required_qty,
             "available": total_available,
             "unit": recipe_unit,
             "estimated_cost": required_qty * cost_per_unit_avg
         })
 
-    # All ingredients available, proceed with preparation
-    usage_summary = []
+    # Load every candidate batch for the whole recipe in one query, then plan FIFO in memory.
+    # The batches stay authoritative: a recipe listing an ingredient twice can still come up short.
+    allocator = FifoAllocator(db, ingredient_names)
+    planned_usage = []
+
+    for ingredient_name, quantity_required, recipe_unit in recipe:
+        required_qty = quantity_required * quantity
+
+        allocations, shortage = allocator.allocate(ingredient_name, required_qty, recipe_unit)
+        if shortage > 1e-6:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient {ingredient_name}: need {required_qty:.2f} {recipe_unit}, "
+                       f"available {required_qty - shortage:.2f} {recipe_unit}, short by {shortage:.2f} {recipe_unit}"
+            )
+        planned_usage.extend(allocations)
 
+    # All ingredients available, apply the plan
     try:
-        for ingredient in dish_ingredients:
-            required_qty = ingredient.quantity_required * quantity
-            recipe_unit = getattr(ingredient, 'unit', 'gm').strip().lower()
+        allocator.apply(prepare_date)
 
-            inventory_batches = db.query(Inventory).filter(
-                Inventory.name.ilike(ingredient.ingredient_name),
-                Inventory.quantity > 0
-            ).order_by(Inventory.date_added.asc()).all()
+        # Build the response before the commit expires the batches
+        usage_summary = [
+            {
+                "ingredient_name": allocation["ingredient_name"],
+                "inventory_batch_id": allocation["batch"].id,
+                "batch_unit": allocation["batch_unit"],
+                "recipe_unit": allocation["recipe_unit"],
+                "used_from_batch": {
+                    "quantity": allocation["deduct_in_batch_unit"],
+                    "unit": allocation["batch_unit"]
+                },
+                "recipe_equivalent": {
+                    "quantity": allocation["deduct_in_recipe_unit"],
+                    "unit": allocation["recipe_unit"]
+                },
+                "remaining_in_batch": allocation["remaining_in_batch"],
+                "cost": allocation["deduct_in_batch_unit"] * allocation["batch"].price_per_unit,
+                "logged_at": prepare_date.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            for allocation in planned_usage
+        ]
 
-            remaining_required = required_qty
+    except StaleDataError:
+        raise  # Another worker changed a batch, retry_stock_conflicts plans again
 
-            for batch in inventory_batches:
-                if remaining_required <= 0:
-                    break
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to prepare dish: {str(e)}"
+        )
 
-                batch_unit = batch.unit.strip().lower()
+    return {
+        "success": True,
+        "message": f"Dish '{dish_name}' prepared successfully for {quantity} servings on {prepare_date.date()}.",
+        "preparation_details": {
+            "dish_name": dish_name,
+            "servings": quantity,
+            "preparation_date": prepare_date.strftime("%Y-%m-%d %H:%M:%S"),
+            "total_estimated_cost": round(total_cost, 2)
+        },
+        "usage_summary": usage_summary,
+        "ingredients_check": availability_check
+    }
 
-                # Convert batch quantity to recipe unit for comparison
-                batch_qty_in_recipe_unit = convert_to_base_unit(batch.quantity, batch_unit, recipe_unit)
 
-                # Determine how much to deduct from this batch
-                deduct_qty_in_recipe_unit = min(batch_qty_in_recipe_unit, remaining_required)
+def prepare_dish_orders(db: Session, orders: List[dict]) -> dict:
+    """Prepare a list of dish orders (dish_name, quantity, preparation_date) in one transaction.
+
+    Recipes are resolved with two set-based queries, ingredient demand is summed across all
+    orders and checked against a single load of the batches, then every order is
+    allocated FIFO in memory and all InventoryLog rows are bulk inserted. Nothing is written
+    unless every order can be prepared. The caller commits.
+    """
+    dish_keys = {order["dish_name"].strip().lower() for order in orders}
+    dishes = {}
+    for dish in db.query(Dish).filter(func.lower(Dish.name).in_(dish_keys)).order_by(Dish.id).all():
+        dishes.setdefault(dish.name.lower(), dish)
+
+    recipes = defaultdict(list)
+    if dishes:
+        for ingredient in db.query(DishIngredient).filter(
+                DishIngredient.dish_id.in_([dish.id for dish in dishes.values()])
+        ).all():
+            recipes[ingredient.dish_id].append(ingredient)
+
+    # Sum ingredient demand across all orders, in the unit of the first recipe that uses it
+    unavailable_dishes = {}
+    demand = {}
+    servings_by_dish = defaultdict(float)
+
+    for order in orders:
+        dish = dishes.get(order["dish_name"].strip().lower())
+        if not dish:
+            unavailable_dishes[order["dish_name"]] = {
+                "dish": order["dish_name"],
+                "error": f"Dish '{order['dish_name']}' not found"
+            }
+            continue
+        if not recipes[dish.id]:
+            unavailable_dishes[dish.name] = {
+                "dish": dish.name,
+                "error": f"No ingredients found for dish '{dish.name}'"
+            }
+            continue
+
+        servings_by_dish[dish.name] += order["quantity"]
+        for ingredient in recipes[dish.id]:
+            recipe_unit = get_recipe_unit(ingredient)
+            entry = demand.setdefault(FifoAllocator.key(ingredient.ingredient_name), {
+                "ingredient": ingredient.ingredient_name,
+                "unit": recipe_unit,
+                "required": 0.0,
+                "dishes": set()
+            })
+            entry["required"] += convert_to_base_unit(
+                ingredient.quantity_required * order["quantity"], recipe_unit, entry["unit"], ingredient.ingredient_name
+            )
+            entry["dishes"].add(dish.name)
+
+    if unavailable_dishes:
+        return {"success": False, "unavailable_dishes": list(unavailable_dishes.values())}
+
+    # One load of every batch, then check the summed demand
+    allocator = FifoAllocator(db, [entry["ingredient"] for entry in demand.values()])
+
+    for entry in demand.values():
+        available, _, _ = allocator.availability(entry["ingredient"], entry["unit"])
+        if available >= entry["required"]:
+            continue
+
+        issue = {
+            "ingredient": entry["ingredient"],
+            "required": entry["required"],
+            "available": available,
+            "unit": entry["unit"],
+            "sufficient": False,
+            "shortage": entry["required"] - available
+        }
+        for dish_name in entry["dishes"]:
+            unavailable_dishes.setdefault(dish_name, {
+                "dish": dish_name,
+                "total_servings_requested": servings_by_dish[dish_name],
+                "issues": []
+            })["issues"].append(issue)
+
+    if unavailable_dishes:
+        return {"success": False, "unavailable_dishes": list(unavailable_dishes.values())}
+
+    # Plan every order against the shared in-memory ledger
+    prepared = []
+    for order in orders:
+        dish = dishes[order["dish_name"].strip().lower()]
+        order_cost = 0.0
+        for ingredient in recipes[dish.id]:
+            allocations, _ = allocator.allocate(
+                ingredient.ingredient_name,
+                ingredient.quantity_required * order["quantity"],
+                get_recipe_unit(ingredient),
+                order["preparation_date"]
+            )
+            order_cost += sum(a["deduct_in_batch_unit"] * a["batch"].price_per_unit for a in allocations)
 
-                # Convert back to batch unit for inventory update
-                deduct_qty_in_batch_unit = convert_from_base_unit(deduct_qty_in_recipe_unit, batch_unit, recipe_unit)
+        prepared.append({
+            "dish_name": dish.name,
+            "servings": order["quantity"],
+            "preparation_date": order["preparation_date"].strftime("%Y-%m-%d %H:%M:%S"),
+            "total_cost": round(order_cost, 2)
+        })
 
-                # Update batch quantity
-                new_batch_quantity = batch.quantity - deduct_qty_in_batch_unit
-                batch.quantity = max(0, new_batch_quantity)  # Ensure no negative quantities
+    log_entries = len(allocator.apply())
+    return {"success": True, "prepared": prepared, "log_entries": log_entries}
 
-                # Create inventory log
-                inventory_log = InventoryLog(
-                    ingredient_id=batch.id,
-                    quantity_left=batch.quantity,
-                    date=prepare_date
-                )
-                db.add(inventory_log)
-
-                # Add to usage summary
-                usage_summary.append({
-                    "ingredient_name": ingredient.ingredient_name,
-                    "inventory_batch_id": batch.id,
-                    "batch_unit": batch_unit,
-                    "recipe_unit": recipe_unit,
-                    "used_from_batch": {
-                        "quantity": deduct_qty_in_batch_unit,
-                        "unit": batch_unit
-                    },
-                    "recipe_equivalent": {
-                        "quantity": deduct_qty_in_recipe_unit,
-                        "unit": recipe_unit
-                    },
-                    "remaining_in_batch": batch.quantity,
-                    "cost": deduct_qty_in_batch_unit * batch.price_per_unit,
-                    "logged_at": prepare_date.strftime("%Y-%m-%d %H:%M:%S")
-                })
 
-                remaining_required -= deduct_qty_in_recipe_unit
+@app.post("/prepare_dishes")
+@idempotent
+def prepare_dishes(request: PrepareDishesRequest, db: Session = Depends(get_db)):
+    """Prepare several orders at once, all or nothing, in a single transaction"""
+    if not request.orders:
+        raise HTTPException(status_code=400, detail="No orders provided")
 
-            # Final check - should not happen due to pre-flight check
-            if remaining_required > 0.001:  # Small tolerance for floating point errors
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Internal error: Still need {remaining_required:.3f} {recipe_unit} of {ingredient.ingredient_name}"
-                )
+    orders = []
+    for idx, order in enumerate(request.orders, start=1):
+        if order.quantity <= 0:
+            raise HTTPException(status_code=400, detail=f"Order {idx}: Quantity must be positive")
 
-        # Commit all changes
-        db.commit()
+        if order.date:
+            try:
+                preparation_date = datetime.strptime(order.date, "%Y-%m-%d")
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Order {idx}: Invalid date format. Use YYYY-MM-DD.")
+        else:
+            preparation_date = datetime.utcnow()
 
-        return {
-            "success": True,
-            "message": f"Dish '{dish.name}' prepared successfully for {quantity} servings on {prepare_date.date()}.",
-            "preparation_details": {
-                "dish_name": dish.name,
-                "servings": quantity,
-                "preparation_date": prepare_date.strftime("%Y-%m-%d %H:%M:%S"),
-                "total_estimated_cost": round(total_cost, 2)
-            },
-            "usage_summary": usage_summary,
-            "ingredients_check": availability_check
-        }
+        orders.append({
+            "dish_name": order.dish_name,
+            "quantity": order.quantity,
+            "preparation_date": preparation_date
+        })
 
+    try:
+        result = run_write(db, lambda session: prepare_dish_orders(session, orders), retry_conflicts=True)
+    except HTTPException:
+        raise
     except Exception as e:
         db.rollback()
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to prepare dish: {str(e)}"
-        )
+        raise HTTPException(status_code=500, detail=f"Failed to prepare dishes: {str(e)}")
 
+    if not result["success"]:
+        raise HTTPException(status_code=400, detail={
+            "message": "Cannot prepare some dishes due to insufficient inventory",
+            "unavailable_dishes": result["unavailable_dishes"]
+        })
 
-def convert_to_base_unit(quantity: float, from_unit: str, to_unit: str) -> float:
-    """Convert quantity from one unit to another within the same category"""
-    from_unit = from_unit.lower()
-    to_unit = to_unit.lower()
-
-    # If units are the same, no conversion needed
-    if from_unit == to_unit:
-        return quantity
-
-    # Weight conversions (base unit: grams)
-    weight_units = {
-        'gm': 1, 'g': 1, 'grams': 1,
-        'kg': 1000, 'kilogram': 1000, 'kilograms': 1000,
-        'oz': 28.3495, 'ounce': 28.3495, 'ounces': 28.3495,
-        'lb': 453.592, 'pound': 453.592, 'pounds': 453.592
+    total_cost = sum(p["total_cost"] for p in result["prepared"])
+    return {
+        "success": True,
+        "message": f"Prepared {len(result['prepared'])} order(s) successfully.",
+        "total_cost": round(total_cost, 2),
+        "inventory_log_entries": result["log_entries"],
+        "preparations": result["prepared"]
     }
 
-    # Volume conversions (base unit: ml)
-    volume_units = {
-        'ml': 1, 'milliliter': 1, 'milliliters': 1,
-        'l': 1000, 'liter': 1000, 'liters': 1000, 'litre': 1000, 'litres': 1000,
-        'cup': 240, 'cups': 240,
-        'tablespoon': 15, 'tablespoons': 15, 'tbsp': 15,
-        'teaspoon': 5, 'teaspoons': 5, 'tsp': 5
-    }
 
-    # Count units (no conversion, must match exactly)
-    count_units = {
-        'piece': 1, 'pieces': 1, 'pc': 1, 'pcs': 1,
-        'item': 1, 'items': 1, 'unit': 1, 'units': 1,
-        'pack': 1, 'packs': 1, 'packet': 1, 'packets': 1
-    }
+# --- Unit Conversion ---
+# Every unit alias maps to a (dimension, factor) pair, where the factor converts one of that unit
+# into the dimension's base unit (grams, millilitres or pieces). Conversion factors per unit pair
+# are cached, so the hot FIFO loops only pay for a dict lookup.
+WEIGHT, VOLUME, COUNT = "weight", "volume", "count"
+
 
-    # Check if both units are in the same category
-    if from_unit in weight_units and to_unit in weight_units:
-        # Convert to grams, then to target unit
-        grams = quantity * weight_units[from_unit]
-        return grams / weight_units[to_unit]
+class UnitRegistry:
+    """Unit aliases and per-ingredient densities, both registrable at runtime"""
 
-    elif from_unit in volume_units and to_unit in volume_units:
-        # Convert to ml, then to target unit
-        ml = quantity * volume_units[from_unit]
-        return ml / volume_units[to_unit]
+    def __init__(self):
+        self.units = {}
+        self.densities = {}  # lower-cased ingredient name -> grams per millilitre
 
-    elif from_unit in count_units and to_unit in count_units:
-        # Count units should be the same
-        return quantity
+    def register_unit(self, dimension: str, factor: float, *aliases: str):
+        for alias in aliases:
+            self.units[alias.strip().lower()] = (dimension, float(factor))
+        unit_conversion_factor.cache_clear()
+
+    def register_density(self, ingredient_name: str, grams_per_ml: float):
+        if grams_per_ml <= 0:
+            raise ValueError(f"Density for {ingredient_name} must be positive, got {grams_per_ml}")
+        self.densities[ingredient_name.strip().lower()] = float(grams_per_ml)
+
+    def density(self, ingredient_name: Optional[str]) -> Optional[float]:
+        if not ingredient_name:
+            return None
+        return self.densities.get(ingredient_name.strip().lower())
 
-    else:
-        # Incompatible units - return as-is but log warning
-        logger.warning(f"Cannot convert from {from_unit} to {to_unit} - incompatible unit types")
-        return quantity
 
+@lru_cache(maxsize=1024)
+def unit_conversion_factor(from_unit: str, to_unit: str, density: Optional[float] = None) -> Optional[float]:
+    """Multiplier taking a quantity in from_unit to to_unit, or None if the units are incompatible"""
+    from_unit = from_unit.strip().lower()
+    to_unit = to_unit.strip().lower()
 
-def convert_from_base_unit(quantity: float, target_unit: str, base_unit: str) -> float:
+    # If units are the same, no conversion needed
+    if from_unit == to_unit:
+        return 1.0
+
+    from_entry = unit_registry.units.get(from_unit)
+    to_entry = unit_registry.units.get(to_unit)
+    if from_entry and to_entry:
+        (from_dimension, from_factor), (to_dimension, to_factor) = from_entry, to_entry
+
+        if from_dimension == to_dimension:
+            # Count units carry no scale, a piece is a piece
+            return 1.0 if from_dimension == COUNT else from_factor / to_factor
+
+        # Weight <-> volume needs the ingredient's density
+        if density and {from_dimension, to_dimension} == {WEIGHT, VOLUME}:
+            if from_dimension == VOLUME:
+                return from_factor * density / to_factor
+            return from_factor / density / to_factor
+
+    # Incompatible units - logged once per pair thanks to the cache
+    logger.warning(f"Cannot convert from {from_unit} to {to_unit} - incompatible unit types")
+    return None
+
+
+unit_registry = UnitRegistry()
+unit_registry.register_unit(WEIGHT, 1, 'gm', 'g', 'grams')
+unit_registry.register_unit(WEIGHT, 1000, 'kg', 'kilogram', 'kilograms')
+unit_registry.register_unit(WEIGHT, 28.3495, 'oz', 'ounce', 'ounces')
+unit_registry.register_unit(WEIGHT, 453.592, 'lb', 'pound', 'pounds')
+unit_registry.register_unit(VOLUME, 1, 'ml', 'milliliter', 'milliliters')
+unit_registry.register_unit(VOLUME, 1000, 'l', 'liter', 'liters', 'litre', 'litres')
+unit_registry.register_unit(VOLUME, 240, 'cup', 'cups')
+unit_registry.register_unit(VOLUME, 15, 'tablespoon', 'tablespoons', 'tbsp')
+unit_registry.register_unit(VOLUME, 5, 'teaspoon', 'teaspoons', 'tsp')
+unit_registry.register_unit(COUNT, 1, 'piece', 'pieces', 'pc', 'pcs', 'item', 'items', 'unit', 'units',
+                            'pack', 'packs', 'packet', 'packets')
+
+# ingredient_stock totals each dimension in these units
+BASE_UNITS = {WEIGHT: "gm", VOLUME: "ml", COUNT: "pcs"}
+
+
+def stock_base_unit(unit: Optional[str]):
+    """(base unit, factor into it) a batch unit is totalled in, unknown units are totalled as they are"""
+    unit = (unit or "").strip().lower()
+    entry = unit_registry.units.get(unit)
+    if entry is None:
+        return unit, 1.0
+    dimension, factor = entry
+    return BASE_UNITS[dimension], 1.0 if dimension == COUNT else factor
+
+
+# Optional densities for ingredients stocked by weight but used by volume (or the reverse),
+# e.g. INGREDIENT_DENSITIES='{"milk": 1.03, "oil": 0.92}' in grams per millilitre
+for density_name, grams_per_ml in json.loads(os.getenv("INGREDIENT_DENSITIES", "{}")).items():
+    unit_registry.register_density(density_name, grams_per_ml)
+
+
+def convert_to_base_unit(quantity: float, from_unit: str, to_unit: str, ingredient_name: Optional[str] = None) -> float:
+    """Convert quantity from one unit to another, across weight and volume when the ingredient has a density"""
+    factor = unit_conversion_factor(from_unit, to_unit, unit_registry.density(ingredient_name))
+    # Incompatible units - return as-is
+    return quantity if factor is None else quantity * factor
+
+
+def convert_from_base_unit(quantity: float, target_unit: str, base_unit: str,
+                           ingredient_name: Optional[str] = None) -> float:
     """Convert from base unit back to target unit"""
-    return convert_to_base_unit(quantity, base_unit, target_unit)
+    return convert_to_base_unit(quantity, base_unit, target_unit, ingredient_name)
 
 
 # Enhanced preparation with unit compatibility check
@@ -1577,25 +4739,16 @@ def prepare_dish_check(
     availability_report = []
     can_prepare = True
     total_estimated_cost = 0.0
+    stock = load_ingredient_stock(db, [ingredient.ingredient_name for ingredient in dish_ingredients])
 
     for ingredient in dish_ingredients:
         required_qty = ingredient.quantity_required * quantity
-        recipe_unit = getattr(ingredient, 'unit', 'gm').strip().lower()
-
-        # Get available inventory
-        inventory_batches = db.query(Inventory).filter(
-            Inventory.name.ilike(ingredient.ingredient_name),
-            Inventory.quantity > 0
-        ).all()
-
-        total_available = 0.0
-        estimated_cost = 0.0
+        recipe_unit = get_recipe_unit(ingredient)
 
-        for batch in inventory_batches:
-            batch_unit = batch.unit.strip().lower()
-            converted_qty = convert_to_base_unit(batch.quantity, batch_unit, recipe_unit)
-            total_available += converted_qty
-            estimated_cost += min(converted_qty, required_qty) * batch.price_per_unit
+        # Average cost per recipe unit across the batches on hand
+        total_available, total_value = stock_availability(stock, ingredient.ingredient_name, recipe_unit)
+        estimated_cost = min(total_available, required_qty) * total_value / total_available \
+            if total_available > 0 else 0.0
 
         ingredient_status = {
             "ingredient": ingredient.ingredient_name,
@@ -1622,19 +4775,78 @@ def prepare_dish_check(
     }
 
 
-@app.post("/upload_prepare_dish_excel")
-async def upload_prepare_dish_excel(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    """Upload Excel file to prepare multiple dishes"""
-    if not file.filename.endswith((".xlsx", ".xls")):
-        raise HTTPException(status_code=400, detail="Invalid file format. Please upload a .xlsx or .xls file.")
+def parse_prepare_dish_row(row, col_index: dict) -> dict:
+    """Turn one preparation sheet row into an order, raises ValueError with the failure reason"""
+    # Extract and validate data
+    dish_name = str(row[col_index["dish_name"]]).strip() if row[col_index["dish_name"]] else ""
+    if not dish_name:
+        raise ValueError("Empty dish name")
 
     try:
-        contents = await file.read()
-        workbook = load_workbook(filename=BytesIO(contents))
-        sheet = workbook.active
+        quantity = float(row[col_index["quantity"]])
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid quantity value '{row[col_index['quantity']]}'")
+    if quantity <= 0:
+        raise ValueError(f"Quantity must be positive, got {quantity}")
+
+    # Enhanced date parsing
+    date_raw = row[col_index["date"]]
+
+    if date_raw is None:
+        # Use current date if not provided
+        preparation_date = datetime.utcnow()
+    elif isinstance(date_raw, datetime):
+        preparation_date = date_raw
+    elif isinstance(date_raw, str):
+        try:
+            date_str = date_raw.strip()
+            if 'T' in date_str:
+                preparation_date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+            elif len(date_str) == 10:
+                preparation_date = datetime.strptime(date_str, "%Y-%m-%d")
+            elif len(date_str) == 19:
+                preparation_date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
+            else:
+                preparation_date = datetime.strptime(date_str, "%Y-%m-%d")
+        except ValueError:
+            raise ValueError(f"Invalid date format '{date_raw}'. Use YYYY-MM-DD")
+    else:
+        try:
+            # Handle Excel date numbers
+            if isinstance(date_raw, (int, float)):
+                excel_epoch = datetime(1900, 1, 1)
+                preparation_date = excel_epoch + timedelta(days=date_raw - 2)
+            else:
+                preparation_date = datetime.utcnow()
+        except:
+            preparation_date = datetime.utcnow()
+
+    # Extract optional fields
+    notes = ""
+    if "notes" in col_index and row[col_index["notes"]]:
+        notes = str(row[col_index["notes"]]).strip()
+
+    batch_id = ""
+    if "batch_id" in col_index and row[col_index["batch_id"]]:
+        batch_id = str(row[col_index["batch_id"]]).strip()
+
+    cost_center = ""
+    if "cost_center" in col_index and row[col_index["cost_center"]]:
+        cost_center = str(row[col_index["cost_center"]]).strip()
+
+    return {
+        "dish_name": dish_name,
+        "quantity": quantity,
+        "preparation_date": preparation_date,
+        "notes": notes,
+        "batch_id": batch_id,
+        "cost_center": cost_center
+    }
 
-        # Parse headers
-        headers = [str(cell.value).strip().lower() if cell.value else "" for cell in sheet[1]]
+
+def import_prepare_dish_workbook(db: Session, path: str, progress=None) -> dict:
+    """Stream a preparation sheet, then prepare every valid row in a single transaction"""
+    with open_excel_rows(path, lowercase_headers=True) as (headers, rows):
         required_columns = {"dish_name", "quantity", "date"}
         optional_columns = {"notes", "batch_id", "cost_center"}  # Optional fields for business tracking
 
@@ -1643,9 +4855,8 @@ async def upload_prepare_dish_excel(file: UploadFile = File(...), db: Session =
         # Validate required columns
         missing = required_columns - set(col_index.keys())
         if missing:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Missing required columns: {', '.join(missing)}. Required: {', '.join(required_columns)}"
+            raise ExcelFormatError(
+                f"Missing required columns: {', '.join(missing)}. Required: {', '.join(required_columns)}"
             )
 
         # Batch processing statistics
@@ -1662,221 +4873,132 @@ async def upload_prepare_dish_excel(file: UploadFile = File(...), db: Session =
         failed_rows = []
         dish_summary = {}
 
-        # Pre-validation: Check all rows first
+        # Pre-validation: Check all rows first, streaming the sheet in chunks
         valid_rows = []
-        for idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
-            processing_stats["total_rows"] += 1
+        chunks = []
+        for chunk_number, chunk in enumerate(chunked(rows, INGEST_CHUNK_SIZE), start=1):
+            for idx, row in chunk:
+                processing_stats["total_rows"] += 1
 
-            try:
                 if not row or all(cell is None for cell in row):
                     processing_stats["skipped_rows"] += 1
                     continue
 
-                # Extract and validate data
-                dish_name = str(row[col_index["dish_name"]]).strip() if row[col_index["dish_name"]] else ""
-                if not dish_name:
-                    failed_rows.append(f"Row {idx}: Empty dish name")
-                    continue
-
                 try:
-                    quantity = float(row[col_index["quantity"]])
-                    if quantity <= 0:
-                        failed_rows.append(f"Row {idx}: Quantity must be positive, got {quantity}")
-                        continue
-                except (ValueError, TypeError):
-                    failed_rows.append(f"Row {idx}: Invalid quantity value '{row[col_index['quantity']]}'")
-                    continue
+                    valid_rows.append({"row_number": idx, **parse_prepare_dish_row(row, col_index)})
+                except ValueError as row_error:
+                    failed_rows.append(f"Row {idx}: {str(row_error)}")
+                except Exception as e:
+                    failed_rows.append(f"Row {idx}: Validation error - {str(e)}")
 
-                # Enhanced date parsing
-                date_str = None
-                date_raw = row[col_index["date"]]
+            report_chunk_progress(chunks, {
+                "chunk": chunk_number,
+                "rows_read": processing_stats["total_rows"],
+                "valid_rows": len(valid_rows),
+                "failed_rows": len(failed_rows)
+            }, progress)
 
-                if date_raw is None:
-                    # Use current date if not provided
-                    preparation_date = datetime.utcnow()
-                elif isinstance(date_raw, datetime):
-                    preparation_date = date_raw
-                elif isinstance(date_raw, str):
-                    try:
-                        date_str = date_raw.strip()
-                        if 'T' in date_str:
-                            preparation_date = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-                        elif len(date_str) == 10:
-                            preparation_date = datetime.strptime(date_str, "%Y-%m-%d")
-                        elif len(date_str) == 19:
-                            preparation_date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
-                        else:
-                            preparation_date = datetime.strptime(date_str, "%Y-%m-%d")
-                    except ValueError:
-                        failed_rows.append(f"Row {idx}: Invalid date format '{date_raw}'. Use YYYY-MM-DD")
-                        continue
-                else:
-                    try:
-                        # Handle Excel date numbers
-                        if isinstance(date_raw, (int, float)):
-                            excel_epoch = datetime(1900, 1, 1)
-                            preparation_date = excel_epoch + timedelta(days=date_raw - 2)
-                        else:
-                            preparation_date = datetime.utcnow()
-                    except:
-                        preparation_date = datetime.utcnow()
-
-                # Extract optional fields
-                notes = ""
-                if "notes" in col_index and row[col_index["notes"]]:
-                    notes = str(row[col_index["notes"]]).strip()
-
-                batch_id = ""
-                if "batch_id" in col_index and row[col_index["batch_id"]]:
-                    batch_id = str(row[col_index["batch_id"]]).strip()
-
-                cost_center = ""
-                if "cost_center" in col_index and row[col_index["cost_center"]]:
-                    cost_center = str(row[col_index["cost_center"]]).strip()
-
-                valid_rows.append({
-                    "row_number": idx,
-                    "dish_name": dish_name,
-                    "quantity": quantity,
-                    "preparation_date": preparation_date,
-                    "notes": notes,
-                    "batch_id": batch_id,
-                    "cost_center": cost_center
-                })
+    if not valid_rows:
+        return {
+            "success": False,
+            "message": "No valid rows found to process",
+            "statistics": processing_stats,
+            "failed_rows": failed_rows
+        }
 
-            except Exception as e:
-                failed_rows.append(f"Row {idx}: Validation error - {str(e)}")
+    # Check and prepare every row with one allocation pass and a single transaction
+    logger.info(f"Preparing {len(valid_rows)} dishes in one batch...")
 
-        if not valid_rows:
-            return {
-                "success": False,
-                "message": "No valid rows found to process",
-                "statistics": processing_stats,
-                "failed_rows": failed_rows
-            }
+    try:
+        result = run_write(db, lambda session: prepare_dish_orders(session, valid_rows), retry_conflicts=True)
+    except HTTPException:
+        raise
+    except Exception as e:
+        # Rollback all changes if batch processing fails
+        db.rollback()
+        raise HTTPException(
+            status_code=500,
+            detail=f"Batch preparation failed: {str(e)}. All changes have been rolled back."
+        )
 
-        # Pre-flight check: Verify all dishes can be prepared
-        print(f"Pre-flight check for {len(valid_rows)} dishes...")
+    if not result["success"]:
+        return {
+            "success": False,
+            "message": "Cannot prepare some dishes due to insufficient inventory",
+            "unavailable_dishes": result["unavailable_dishes"],
+            "suggestion": "Check inventory levels and try again"
+        }
 
-        # Group by dish to optimize checking
-        dish_groups = {}
-        for row_data in valid_rows:
-            dish_name = row_data["dish_name"]
-            if dish_name not in dish_groups:
-                dish_groups[dish_name] = []
-            dish_groups[dish_name].append(row_data)
+    for row_data, preparation in zip(valid_rows, result["prepared"]):
+        processing_stats["successful_preparations"] += 1
+        processing_stats["total_servings"] += row_data["quantity"]
+        processing_stats["total_cost"] += preparation["total_cost"]
+
+        # Track dish summary
+        dish_name = preparation["dish_name"]
+        if dish_name not in dish_summary:
+            dish_summary[dish_name] = {
+                "total_servings": 0,
+                "total_cost": 0,
+                "preparation_count": 0
+            }
 
-        # Check each unique dish
-        unavailable_dishes = []
-        for dish_name, rows in dish_groups.items():
-            total_servings = sum(row["quantity"] for row in rows)
+        dish_summary[dish_name]["total_servings"] += row_data["quantity"]
+        dish_summary[dish_name]["total_cost"] += preparation["total_cost"]
+        dish_summary[dish_name]["preparation_count"] += 1
+
+        successful_preparations.append({
+            "row": row_data["row_number"],
+            "dish": dish_name,
+            "servings": row_data["quantity"],
+            "cost": preparation["total_cost"],
+            "date": row_data["preparation_date"].strftime("%Y-%m-%d"),
+            "notes": row_data["notes"],
+            "batch_id": row_data["batch_id"]
+        })
 
-            try:
-                # Use the check endpoint we created earlier
-                check_result = prepare_dish_check(dish_name, total_servings, db)
-                if not check_result["can_prepare"]:
-                    unavailable_dishes.append({
-                        "dish": dish_name,
-                        "total_servings_requested": total_servings,
-                        "issues": [ing for ing in check_result["ingredients_status"] if not ing["sufficient"]]
-                    })
-            except HTTPException as e:
-                unavailable_dishes.append({
-                    "dish": dish_name,
-                    "error": str(e.detail)
-                })
+    # Generate comprehensive report
+    success_rate = (processing_stats["successful_preparations"] / processing_stats["total_rows"] * 100) if \
+    processing_stats["total_rows"] > 0 else 0
 
-        if unavailable_dishes:
-            return {
-                "success": False,
-                "message": "Cannot prepare some dishes due to insufficient inventory",
-                "unavailable_dishes": unavailable_dishes,
-                "suggestion": "Check inventory levels and try again"
-            }
+    return {
+        "success": True,
+        "message": f"Batch dish preparation completed. {processing_stats['successful_preparations']}/{processing_stats['total_rows']} preparations successful.",
+        "statistics": {
+            **processing_stats,
+            "success_rate_percentage": round(success_rate, 2)
+        },
+        "dish_summary": dish_summary,
+        "successful_preparations": successful_preparations,
+        "failed_rows": failed_rows,
+        "recommendations": generate_preparation_recommendations(dish_summary, failed_rows),
+        "chunks": chunks
+    }
 
-        # All dishes can be prepared, proceed with actual preparation
-        print(f"All checks passed. Preparing {len(valid_rows)} dishes...")
 
-        try:
-            # Process each preparation
-            for row_data in valid_rows:
-                try:
-                    # Call the enhanced prepare_dish function
-                    preparation_result = prepare_dish(
-                        dish_name=row_data["dish_name"],
-                        quantity=row_data["quantity"],
-                        date=row_data["preparation_date"].strftime("%Y-%m-%d"),
-                        db=db
-                    )
-
-                    if preparation_result.get("success"):
-                        processing_stats["successful_preparations"] += 1
-                        processing_stats["total_servings"] += row_data["quantity"]
-                        processing_stats["total_cost"] += preparation_result["preparation_details"].get(
-                            "total_estimated_cost", 0)
-
-                        # Track dish summary
-                        dish_name = row_data["dish_name"]
-                        if dish_name not in dish_summary:
-                            dish_summary[dish_name] = {
-                                "total_servings": 0,
-                                "total_cost": 0,
-                                "preparation_count": 0
-                            }
-
-                        dish_summary[dish_name]["total_servings"] += row_data["quantity"]
-                        dish_summary[dish_name]["total_cost"] += preparation_result["preparation_details"].get(
-                            "total_estimated_cost", 0)
-                        dish_summary[dish_name]["preparation_count"] += 1
-
-                        successful_preparations.append({
-                            "row": row_data["row_number"],
-                            "dish": dish_name,
-                            "servings": row_data["quantity"],
-                            "cost": preparation_result["preparation_details"].get("total_estimated_cost", 0),
-                            "date": row_data["preparation_date"].strftime("%Y-%m-%d"),
-                            "notes": row_data["notes"],
-                            "batch_id": row_data["batch_id"]
-                        })
-                    else:
-                        processing_stats["failed_preparations"] += 1
-                        failed_rows.append(
-                            f"Row {row_data['row_number']}: Preparation failed - {preparation_result.get('message', 'Unknown error')}")
-
-                except HTTPException as e:
-                    processing_stats["failed_preparations"] += 1
-                    failed_rows.append(f"Row {row_data['row_number']}: {e.detail}")
-                except Exception as e:
-                    processing_stats["failed_preparations"] += 1
-                    failed_rows.append(f"Row {row_data['row_number']}: Unexpected error - {str(e)}")
+@app.post("/upload_prepare_dish_excel")
+@idempotent
+def upload_prepare_dish_excel(
+        file: UploadFile = File(...),
+        background: bool = Query(False, description="Queue the import and poll /jobs/{id} instead of waiting"),
+        db: Session = Depends(get_db)
+):
+    """Upload Excel file to prepare multiple dishes"""
+    if not file.filename.endswith((".xlsx", ".xls")):
+        raise HTTPException(status_code=400, detail="Invalid file format. Please upload a .xlsx or .xls file.")
 
-            # Final commit for any remaining transactions
-            db.commit()
+    if background:
+        return submit_import_job(db, "prepare_dishes", file, import_prepare_dish_workbook)
 
-        except Exception as e:
-            # Rollback all changes if batch processing fails
-            db.rollback()
-            raise HTTPException(
-                status_code=500,
-                detail=f"Batch preparation failed: {str(e)}. All changes have been rolled back."
-            )
+    path = spool_upload(file)
+    try:
+        return import_prepare_dish_workbook(db, path)
 
-        # Generate comprehensive report
-        success_rate = (processing_stats["successful_preparations"] / processing_stats["total_rows"] * 100) if \
-        processing_stats["total_rows"] > 0 else 0
+    except ExcelFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        return {
-            "success": True,
-            "message": f"Batch dish preparation completed. {processing_stats['successful_preparations']}/{processing_stats['total_rows']} preparations successful.",
-            "statistics": {
-                **processing_stats,
-                "success_rate_percentage": round(success_rate, 2)
-            },
-            "dish_summary": dish_summary,
-            "successful_preparations": successful_preparations,
-            "failed_rows": failed_rows,
-            "recommendations": generate_preparation_recommendations(dish_summary, failed_rows)
-        }
+    except HTTPException:
+        raise
 
     except Exception as e:
         # Log the full error for debugging
@@ -1891,6 +5013,9 @@ async def upload_prepare_dish_excel(file: UploadFile = File(...), db: Session =
 
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+    finally:
+        os.remove(path)
+
 
 def generate_preparation_recommendations(dish_summary: dict, failed_rows: list) -> list:
     """Generate recommendations based on preparation results"""
@@ -1924,62 +5049,59 @@ def generate_preparation_recommendations(dish_summary: dict, failed_rows: list)
 
 # Additional endpoint for preparation planning
 @app.post("/plan_dish_preparation_excel")
-async def plan_dish_preparation_excel(file: UploadFile = File(...), db: Session = Depends(get_db)):
+def plan_dish_preparation_excel(file: UploadFile = File(...), db: Session = Depends(get_db)):
     """Analyze Excel file and provide preparation feasibility report without actually preparing dishes"""
     if not file.filename.endswith((".xlsx", ".xls")):
         raise HTTPException(status_code=400, detail="Invalid file format. Please upload a .xlsx or .xls file.")
 
+    path = spool_upload(file)
     try:
-        contents = await file.read()
-        workbook = load_workbook(filename=BytesIO(contents))
-        sheet = workbook.active
-
-        headers = [str(cell.value).strip().lower() if cell.value else "" for cell in sheet[1]]
-        required_columns = {"dish_name", "quantity"}
-        col_index = {h: i for i, h in enumerate(headers)}
+        with open_excel_rows(path, lowercase_headers=True) as (headers, rows):
+            required_columns = {"dish_name", "quantity"}
+            col_index = {h: i for i, h in enumerate(headers)}
 
-        missing = required_columns - set(col_index.keys())
-        if missing:
-            raise HTTPException(status_code=400, detail=f"Missing required columns: {', '.join(missing)}")
+            missing = required_columns - set(col_index.keys())
+            if missing:
+                raise HTTPException(status_code=400, detail=f"Missing required columns: {', '.join(missing)}")
 
-        planning_report = []
-        total_estimated_cost = 0.0
-        feasible_count = 0
+            planning_report = []
+            total_estimated_cost = 0.0
+            feasible_count = 0
 
-        for idx, row in enumerate(sheet.iter_rows(min_row=2, values_only=True), start=2):
-            try:
-                if not row or all(cell is None for cell in row):
-                    continue
+            for idx, row in rows:
+                try:
+                    if not row or all(cell is None for cell in row):
+                        continue
 
-                dish_name = str(row[col_index["dish_name"]]).strip()
-                quantity = float(row[col_index["quantity"]])
+                    dish_name = str(row[col_index["dish_name"]]).strip()
+                    quantity = float(row[col_index["quantity"]])
 
-                if not dish_name or quantity <= 0:
-                    continue
+                    if not dish_name or quantity <= 0:
+                        continue
 
-                # Check feasibility
-                check_result = prepare_dish_check(dish_name, quantity, db)
+                    # Check feasibility
+                    check_result = prepare_dish_check(dish_name, quantity, db)
 
-                planning_report.append({
-                    "row": idx,
-                    "dish": dish_name,
-                    "servings": quantity,
-                    "feasible": check_result["can_prepare"],
-                    "estimated_cost": check_result["total_estimated_cost"],
-                    "ingredient_status": check_result["ingredients_status"]
-                })
+                    planning_report.append({
+                        "row": idx,
+                        "dish": dish_name,
+                        "servings": quantity,
+                        "feasible": check_result["can_prepare"],
+                        "estimated_cost": check_result["total_estimated_cost"],
+                        "ingredient_status": check_result["ingredients_status"]
+                    })
 
-                if check_result["can_prepare"]:
-                    feasible_count += 1
-                    total_estimated_cost += check_result["total_estimated_cost"]
+                    if check_result["can_prepare"]:
+                        feasible_count += 1
+                        total_estimated_cost += check_result["total_estimated_cost"]
 
-            except Exception as e:
-                planning_report.append({
-                    "row": idx,
-                    "dish": dish_name if 'dish_name' in locals() else "Unknown",
-                    "feasible": False,
-                    "error": str(e)
-                })
+                except Exception as e:
+                    planning_report.append({
+                        "row": idx,
+                        "dish": dish_name if 'dish_name' in locals() else "Unknown",
+                        "feasible": False,
+                        "error": str(e)
+                    })
 
         return {
             "planning_summary": {
@@ -1993,9 +5115,329 @@ async def plan_dish_preparation_excel(file: UploadFile = File(...), db: Session
                 planning_report) else "Some dishes cannot be prepared due to insufficient inventory"
         }
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Planning analysis failed: {str(e)}")
 
+    finally:
+        os.remove(path)
+
+# --- Menu Feasibility ---
+# Every recipe as a dish x ingredient matrix of per-serving requirements, one column per name_key in
+# a single unit. The matrix only depends on recipes, so it is cached against the dish catalog
+# version; stock is read fresh from ingredient_stock on every request.
+menu_matrix_cache = {
+    "loaded_version": None,
+    "matrix": None
+}
+
+
+def load_menu_matrix(db: Session) -> dict:
+    """Return the cached requirement matrix, rebuilding it when the dish catalog has changed"""
+    version = dish_catalog_version()
+    with dish_catalog_lock:
+        if menu_matrix_cache["loaded_version"] == version:
+            return menu_matrix_cache["matrix"]
+
+    dish_rows = db.query(Dish.id, Dish.name).order_by(Dish.id).all()
+    dish_index = {dish_id: row for row, (dish_id, _) in enumerate(dish_rows)}
+
+    columns = {}  # name_key -> (column, ingredient name, unit)
+    entries = []
+    for dish_id, ingredient_name, quantity_required, unit in db.query(
+            DishIngredient.dish_id, DishIngredient.ingredient_name, DishIngredient.quantity_required,
+            DishIngredient.unit
+    ).order_by(DishIngredient.id).all():
+        name_key = normalize_name_key(ingredient_name)
+        if dish_id not in dish_index or not name_key:
+            continue
+        recipe_unit = (unit or 'gm').strip().lower()
+        # Each column is kept in the base unit of the first recipe that uses the ingredient
+        column, column_name, column_unit = columns.setdefault(
+            name_key, (len(columns), ingredient_name, stock_base_unit(recipe_unit)[0])
+        )
+        entries.append((
+            dish_index[dish_id],
+            column,
+            convert_to_base_unit(quantity_required or 0.0, recipe_unit, column_unit, column_name)
+        ))
+
+    requirements = np.zeros((len(dish_rows), len(columns)))
+    if entries:
+        rows, cols, quantities = zip(*entries)
+        np.add.at(requirements, (list(rows), list(cols)), quantities)  # Repeated ingredients add up
+
+    matrix = {
+        "dish_names": [dish_name for _, dish_name in dish_rows],
+        "keys": list(columns),
+        "names": [name for _, name, _ in columns.values()],
+        "units": [unit for _, _, unit in columns.values()],
+        "requirements": requirements
+    }
+
+    with dish_catalog_lock:
+        menu_matrix_cache.update(matrix=matrix, loaded_version=version)
+
+    return matrix
+
+
+def menu_stock_vector(db: Session, matrix: dict):
+    """On-hand quantity of every matrix column, in the column's unit"""
+    columns = {name_key: column for column, name_key in enumerate(matrix["keys"])}
+    stock = np.zeros(len(columns))
+    for keys in chunked(matrix["keys"], 500):
+        for name_key, base_unit, quantity in db.query(
+                IngredientStock.name_key, IngredientStock.base_unit, IngredientStock.quantity
+        ).filter(IngredientStock.name_key.in_(keys)).all():
+            column = columns[name_key]
+            stock[column] += convert_to_base_unit(quantity, base_unit, matrix["units"][column], matrix["names"][column])
+    return stock
+
+
+@app.get("/menu/feasibility")
+def menu_feasibility(
+        servings: float = Query(1, description="Servings per dish to check shortages for"),
+        db: Session = Depends(get_db)
+):
+    """How many servings of every dish can be made right now, and what is short for `servings` of each"""
+    if servings <= 0:
+        raise HTTPException(status_code=400, detail="Servings must be positive")
+
+    matrix = load_menu_matrix(db)
+    requirements = matrix["requirements"]
+    stock = menu_stock_vector(db, matrix)
+
+    # Servings each ingredient allows, per dish; unused ingredients don't limit anything
+    uses = requirements > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        servings_allowed = np.where(uses, stock / requirements, np.inf)
+    if requirements.shape[1]:
+        limiting = servings_allowed.argmin(axis=1)
+        max_servings = servings_allowed.min(axis=1)
+    else:
+        limiting = np.zeros(len(matrix["dish_names"]), dtype=int)
+        max_servings = np.full(len(matrix["dish_names"]), np.inf)
+    max_servings = np.floor(max_servings + 1e-9)  # Whole servings, forgiving conversion rounding
+
+    shortages = np.where(uses, requirements * servings - stock, 0.0)
+
+    dishes = []
+    for row, dish_name in enumerate(matrix["dish_names"]):
+        has_ingredients = bool(uses[row].any())
+        short_columns = np.flatnonzero(shortages[row] > 0)
+        dishes.append({
+            "dish_name": dish_name,
+            "max_servings": int(max_servings[row]) if has_ingredients else None,
+            "limiting_ingredient": matrix["names"][limiting[row]] if has_ingredients else None,
+            "can_prepare": has_ingredients and not len(short_columns),
+            "shortages": [
+                {
+                    "ingredient": matrix["names"][column],
+                    "required": float(requirements[row, column] * servings),
+                    "available": float(stock[column]),
+                    "unit": matrix["units"][column],
+                    "shortage": float(shortages[row, column])
+                }
+                for column in short_columns
+            ]
+        })
+
+    return {
+        "servings": servings,
+        "total_dishes": len(dishes),
+        "feasible_dishes": sum(1 for dish in dishes if dish["can_prepare"]),
+        "dishes": dishes
+    }
+
+
+# --- Inventory Snapshots ---
+# Every SNAPSHOT_INTERVAL_DAYS (counted from SNAPSHOT_EPOCH) the latest quantity_left of every batch
+# is checkpointed into inventory_snapshot, so a point-in-time question only has to read the log
+# written since the nearest earlier snapshot. Set SNAPSHOT_INTERVAL_DAYS=0 to turn snapshots off.
+SNAPSHOT_INTERVAL_DAYS = int(os.getenv("SNAPSHOT_INTERVAL_DAYS", "7"))
+SNAPSHOT_CHECK_SECONDS = int(os.getenv("SNAPSHOT_CHECK_SECONDS", "3600"))
+SNAPSHOT_EPOCH = datetime(2000, 1, 3)  # A Monday, so weekly snapshots land on Mondays
+
+
+def snapshot_boundary_on_or_before(moment: datetime) -> datetime:
+    interval = timedelta(days=SNAPSHOT_INTERVAL_DAYS)
+    return SNAPSHOT_EPOCH + ((moment - SNAPSHOT_EPOCH) // interval) * interval
+
+
+def latest_logs_between(db: Session, start: Optional[datetime], end: datetime) -> dict:
+    """Latest (quantity_left, log date) per ingredient among logs with start < date <= end"""
+    filters = [InventoryLog.date <= end]
+    if start is not None:
+        filters.append(InventoryLog.date > start)
+
+    # Rank each ingredient's logs in the range, newest first, in one pass over
+    # ix_inventory_log_ingredient_date
+    ranked_logs = db.query(
+        InventoryLog.ingredient_id.label("ingredient_id"),
+        InventoryLog.quantity_left.label("quantity_left"),
+        InventoryLog.date.label("date"),
+        func.row_number().over(
+            partition_by=InventoryLog.ingredient_id,
+            order_by=(InventoryLog.date.desc(), InventoryLog.id.desc())
+        ).label("log_rank")
+    ).filter(*filters).subquery()
+
+    return {
+        ingredient_id: (quantity_left, log_date)
+        for ingredient_id, quantity_left, log_date in db.query(
+            ranked_logs.c.ingredient_id, ranked_logs.c.quantity_left, ranked_logs.c.date
+        ).filter(ranked_logs.c.log_rank == 1)
+    }
+
+
+def stock_levels_on(db: Session, moment: datetime):
+    """Latest (quantity_left, log date) per batch as of `moment`, and the snapshot date it started from"""
+    snapshot_date = db.query(func.max(InventorySnapshot.snapshot_date)).filter(
+        InventorySnapshot.snapshot_date <= moment
+    ).scalar()
+
+    levels = {}
+    if snapshot_date is not None:
+        levels = {
+            ingredient_id: (quantity_left, log_date)
+            for ingredient_id, quantity_left, log_date in db.query(
+                InventorySnapshot.ingredient_id, InventorySnapshot.quantity_left, InventorySnapshot.log_date
+            ).filter(InventorySnapshot.snapshot_date == snapshot_date)
+        }
+
+    # Whatever was logged after the snapshot supersedes it
+    levels.update(latest_logs_between(db, snapshot_date, moment))
+    return levels, snapshot_date
+
+
+def create_inventory_snapshots(db: Session, until: Optional[datetime] = None) -> List[datetime]:
+    """Take every snapshot that is due and missing, each one built from the previous plus the log since"""
+    if SNAPSHOT_INTERVAL_DAYS <= 0:
+        return []
+
+    # Serialize with writers so a backdated log can't slip in between reading and saving
+    lock_inventory_for_update(db)
+
+    interval = timedelta(days=SNAPSHOT_INTERVAL_DAYS)
+    until = snapshot_boundary_on_or_before(until or datetime.utcnow())
+    previous = db.query(func.max(InventorySnapshot.snapshot_date)).scalar()
+
+    if previous is None:
+        first_log_date = db.query(func.min(InventoryLog.date)).scalar()
+        if first_log_date is None:
+            return []
+        boundary = snapshot_boundary_on_or_before(first_log_date) + interval
+        levels = {}
+    else:
+        boundary = previous + interval
+        levels, _ = stock_levels_on(db, previous)
+
+    created = []
+    while boundary <= until:
+        levels.update(latest_logs_between(db, previous, boundary))
+        db.bulk_insert_mappings(InventorySnapshot, [{
+            "snapshot_date": boundary,
+            "ingredient_id": ingredient_id,
+            "quantity_left": quantity_left,
+            "log_date": log_date
+        } for ingredient_id, (quantity_left, log_date) in levels.items()])
+        created.append(boundary)
+        previous = boundary
+        boundary += interval
+
+    return created
+
+
+def invalidate_inventory_snapshots(db: Session, since: datetime):
+    """Drop snapshots that a backdated log falls into, the next snapshot run takes them again"""
+    if since is None:
+        return
+    db.query(InventorySnapshot).filter(
+        InventorySnapshot.snapshot_date >= since
+    ).delete(synchronize_session=False)
+
+
+def analyze_inventory_log(db: Session):
+    """Refresh SQLite's planner statistics, without them it scans the whole log index for short date ranges"""
+    if db.bind.dialect.name == "sqlite":
+        db.execute(text("ANALYZE inventory_log"))
+        db.commit()
+
+
+def run_inventory_snapshots():
+    db = SessionLocal()
+    try:
+        analyze_inventory_log(db)
+        created = create_inventory_snapshots(db)
+        db.commit()
+        if created:
+            logger.info(f"Took {len(created)} inventory snapshot(s), latest {created[-1]}")
+    except IntegrityError:
+        # Another worker took the same snapshots first
+        db.rollback()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Inventory snapshot failed: {e}")
+    finally:
+        db.close()
+
+
+def snapshot_scheduler():
+    while True:
+        run_inventory_snapshots()
+        time.sleep(SNAPSHOT_CHECK_SECONDS)
+
+
+@app.on_event("startup")
+def start_snapshot_scheduler():
+    if SNAPSHOT_INTERVAL_DAYS > 0:
+        threading.Thread(target=snapshot_scheduler, name="inventory-snapshots", daemon=True).start()
+
+
+@app.post("/admin/rebuild-inventory-snapshots")
+def rebuild_inventory_snapshots(
+        confirm: bool = Query(False, description="Set to true to confirm rebuilding all snapshots"),
+        db: Session = Depends(get_db)
+):
+    """Drop every snapshot and take them again from the log, e.g. after changing SNAPSHOT_INTERVAL_DAYS"""
+    if not confirm:
+        return {
+            "message": "Rebuild not confirmed. Set confirm=true to proceed.",
+            "snapshots": db.query(func.count(func.distinct(InventorySnapshot.snapshot_date))).scalar()
+        }
+
+    try:
+        analyze_inventory_log(db)
+        lock_inventory_for_update(db)
+        db.query(InventorySnapshot).delete(synchronize_session=False)
+        created = create_inventory_snapshots(db)
+        db.commit()
+        return {
+            "message": f"Inventory snapshots rebuilt: {len(created)} snapshot(s).",
+            "status": "ok",
+            "interval_days": SNAPSHOT_INTERVAL_DAYS,
+            "latest_snapshot": created[-1].strftime("%Y-%m-%d") if created else None
+        }
+    except Exception as e:
+        db.rollback()
+        return {
+            "message": f"Rebuild error: {str(e)}",
+            "status": "error"
+        }
+
+
+def batch_names(db: Session, batch_ids) -> dict:
+    """(name, unit) of the batches that still exist, keyed by id"""
+    names = {}
+    for chunk in chunked([batch_id for batch_id in batch_ids if batch_id is not None], 500):
+        for batch_id, name, unit in db.query(Inventory.id, Inventory.name, Inventory.unit).filter(
+                Inventory.id.in_(chunk)):
+            names[batch_id] = (name, unit)
+    return names
+
+
 @app.get("/inventory_on_date")
 def inventory_on_date(date: str, db: Session = Depends(get_db)):
     try:
@@ -2003,32 +5445,80 @@ def inventory_on_date(date: str, db: Session = Depends(get_db)):
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
 
-    # Step 1: Get all unique ingredient_ids from logs
-    ingredient_ids = db.query(InventoryLog.ingredient_id).distinct().all()
-    ingredient_ids = [i[0] for i in ingredient_ids]
+    levels, _ = stock_levels_on(db, date_parsed)
+    names = batch_names(db, levels)
 
     response = []
-
-    # Step 2: For each ingredient, get the latest log <= selected date
-    for ingredient_id in ingredient_ids:
-        latest_log = db.query(InventoryLog).filter(
-            InventoryLog.ingredient_id == ingredient_id,
-            InventoryLog.date <= date_parsed
-        ).order_by(InventoryLog.date.desc()).first()
-
-        if latest_log:
-            inventory_item = db.query(Inventory).filter(Inventory.id == ingredient_id).first()
-            response.append({
-                "ingredient_id": ingredient_id,
-                "ingredient_name": inventory_item.name if inventory_item else "Unknown",
-                "unit": inventory_item.unit if inventory_item else "",
-                "quantity_left": latest_log.quantity_left,
-                "log_time": latest_log.date.strftime("%Y-%m-%d %H:%M:%S")
-            })
+    for ingredient_id in sorted(levels, key=lambda batch_id: (batch_id is not None, batch_id or 0)):
+        quantity_left, log_date = levels[ingredient_id]
+        name, unit = names.get(ingredient_id, ("Unknown", ""))
+        response.append({
+            "ingredient_id": ingredient_id,
+            "ingredient_name": name,
+            "unit": unit,
+            "quantity_left": quantity_left,
+            "log_time": log_date.strftime("%Y-%m-%d %H:%M:%S")
+        })
 
     return response
 
 
+@app.get("/stock_valuation")
+def stock_valuation(date: str, db: Session = Depends(get_db)):
+    """Value of the stock on hand at the start of a date, from the nearest snapshot plus the log since"""
+    try:
+        date_parsed = datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
+
+    levels, snapshot_date = stock_levels_on(db, date_parsed)
+    batches = db.query(
+        Inventory.id, Inventory.name, Inventory.unit, Inventory.type,
+        Inventory.quantity, Inventory.price_per_unit, Inventory.total_cost
+    ).filter(Inventory.date_added <= date_parsed).all()
+
+    items = {}
+    value_by_type = defaultdict(float)
+    total_value = 0.0
+
+    for batch_id, name, unit, type_, quantity, price_per_unit, total_cost in batches:
+        if batch_id in levels:
+            quantity_on_hand = levels[batch_id][0]
+        elif price_per_unit:
+            # Untouched up to this date, so everything that was bought is still there
+            quantity_on_hand = (total_cost or 0.0) / price_per_unit
+        else:
+            quantity_on_hand = quantity or 0.0
+
+        value = quantity_on_hand * (price_per_unit or 0.0)
+        total_value += value
+        value_by_type[type_ or ""] += value
+
+        item = items.setdefault((name, unit), {
+            "name": name,
+            "unit": unit,
+            "quantity": 0.0,
+            "value": 0.0,
+            "batches": 0
+        })
+        item["quantity"] += quantity_on_hand
+        item["value"] += value
+        item["batches"] += 1
+
+    for item in items.values():
+        item["quantity"] = round(item["quantity"], 3)
+        item["value"] = round(item["value"], 2)
+
+    return {
+        "date": date,
+        "snapshot_used": snapshot_date.strftime("%Y-%m-%d") if snapshot_date else None,
+        "total_value": round(total_value, 2),
+        "batch_count": len(batches),
+        "value_by_type": {type_: round(value, 2) for type_, value in value_by_type.items()},
+        "items": sorted(items.values(), key=lambda item: item["value"], reverse=True)
+    }
+
+
 class OpenAIPromptRequest(BaseModel):
     prompt: str
 
@@ -2094,6 +5584,100 @@ def get_database_info():
         "engine": str(engine.url).split('@')[0] + '@***' if '@' in str(engine.url) else str(engine.url)
     }
 
+# --- Async Read Path ---
+# Async versions of the hot read endpoints. Their queries are awaited on the async driver with the same
+# statements the sync endpoints run, so the event loop only ever waits on the database. Building a large
+# JSON payload is CPU work and goes to the threadpool. The other endpoints keep running in the threadpool.
+ASYNC_READ_ENDPOINTS = {}  # Sync endpoint -> its async version
+
+
+def async_read_endpoint(sync_endpoint):
+    """Register the decorated coroutine as sync_endpoint's async version. FastAPI sees sync_endpoint's
+    parameters, with db from get_async_db()"""
+    def register(endpoint):
+        sync_signature = signature(sync_endpoint)
+        endpoint.__signature__ = sync_signature.replace(parameters=[
+            parameter.replace(default=Depends(get_async_db), annotation=AsyncSession) if name == "db" else parameter
+            for name, parameter in sync_signature.parameters.items()
+        ])
+        endpoint.__doc__ = sync_endpoint.__doc__
+        ASYNC_READ_ENDPOINTS[sync_endpoint] = endpoint
+        return endpoint
+    return register
+
+
+async def async_table_versions(db: AsyncSession, names) -> tuple:
+    """table_versions() reading a stale cache through db"""
+    versions = cached_table_versions(names)
+    if versions is not None:
+        return versions
+    stored = dict((await db.execute(select(TableVersion.table_name, TableVersion.version))).all())
+    return store_table_versions(stored, names)
+
+
+@async_read_endpoint(get_inventory)
+async def get_inventory_async(request, after_id, limit, only_in_stock, type, start_date, end_date, fields, db):
+    etag = versions_etag(await async_table_versions(db, ("inventory",)))
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    statement = inventory_page_statement(db, after_id, limit, only_in_stock, type, start_date, end_date, fields)
+    rows = [dict(row._mapping) for row in await db.execute(statement)]
+    return await run_in_threadpool(inventory_page_response, rows, limit, etag)
+
+
+@async_read_endpoint(get_inventory_changes)
+async def get_inventory_changes_async(since, limit, db):
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+
+    changes = (await db.execute(inventory_changes_statement(since, limit))).all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if changes:
+        version = changes[-1].id
+    else:
+        version = (await db.execute(select(func.max(InventoryChange.id)))).scalar() or 0
+
+    reset, latest = latest_inventory_actions(changes)
+    upserted = []
+    for ids in chunked(upserted_inventory_ids(latest), 500):
+        upserted.extend(dict(row._mapping) for row in await db.execute(inventory_rows_statement(db, ids)))
+
+    return await run_in_threadpool(JSONResponse, inventory_delta(version, has_more, reset, latest, upserted))
+
+
+@async_read_endpoint(list_dishes)
+async def list_dishes_async(request, db):
+    versions = await async_table_versions(db, CATALOG_TABLES)
+    etag = versions_etag(versions)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+
+    # Same version as dish_catalog_version(), read before the rows
+    version = sum(versions)
+    catalog = cached_dish_catalog(version)
+    if catalog is None:
+        dishes_statement, ingredients_statement = dish_catalog_statements()
+        dish_rows = (await db.execute(dishes_statement)).all()
+        ingredient_rows = (await db.execute(ingredients_statement)).all()
+        catalog = await run_in_threadpool(cache_dish_catalog, version, dish_rows, ingredient_rows)
+    return Response(content=catalog["payload"], media_type="application/json", headers=etag_headers(etag))
+
+
+def use_async_read_endpoints():
+    """Swap each sync read route for its async version, in place so route matching order is unchanged"""
+    for index, route in enumerate(app.router.routes):
+        if isinstance(route, APIRoute) and route.endpoint in ASYNC_READ_ENDPOINTS:
+            app.router.routes[index] = APIRoute(
+                route.path, ASYNC_READ_ENDPOINTS[route.endpoint], methods=route.methods,
+                response_model=route.response_model, name=route.name
+            )
+
+
+if async_engine is not None:
+    use_async_read_endpoints()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)